@@ -0,0 +1,87 @@
+import logging
+from typing import List, Optional, Iterator
+
+from Instrumentation import current_memory_mb, peak_memory_mb, count
+
+# The budget is reduced when the resident set size is above this fraction of the ceiling, leaving headroom for the
+# peak during the forward pass, which is not visible in between batches:
+SHRINK_ABOVE = 0.9
+# The budget is increased when the resident set size is below this fraction of the ceiling:
+GROW_BELOW = 0.7
+SHRINK_FACTOR = 0.5
+GROW_FACTOR = 1.25
+
+
+class AdaptiveBatcher:
+    """
+    Splits texts into batches by a token budget instead of a fixed number of texts, so a batch of long abstracts holds
+    fewer texts than a batch of titles. The budget counts padding: a batch uses its number of texts times the number of
+    tokens in its longest text, which is what determines the memory used by the forward pass.
+
+    If a memory ceiling is set, the resident set size of the process is checked after every batch. The budget is halved
+    when memory gets close to the ceiling, and grows again by 25% per batch when there is room, up to max_token_budget.
+    The budget carries over from one call to the next. Every adjustment is logged.
+
+    :param token_budget: The initial number of (padded) tokens per batch.
+    :param max_memory_mb: The ceiling for the resident set size of the process in MB. If None, the budget is fixed.
+    :param max_token_budget: The largest budget to grow to. Defaults to four times token_budget.
+    :param min_token_budget: The smallest budget to shrink to. A batch always holds at least one text.
+    """
+
+    def __init__(self,
+                 token_budget: int,
+                 max_memory_mb: Optional[float] = None,
+                 max_token_budget: Optional[int] = None,
+                 min_token_budget: int = 512):
+        self.token_budget = token_budget
+        self.max_memory_mb = max_memory_mb
+        self.max_token_budget = max_token_budget if max_token_budget is not None else 4 * token_budget
+        self.min_token_budget = min(min_token_budget, token_budget)
+        if max_memory_mb is not None and current_memory_mb() is None:
+            logging.warning("Cannot determine the memory use of this process (install psutil), so the token budget "
+                            "will not be adjusted to max_memory_mb")
+            self.max_memory_mb = None
+
+    def batches(self, token_counts: List[int]) -> Iterator[List[int]]:
+        """
+        Yields batches of indices into token_counts, longest texts first. Each batch is formed using the budget at the
+        time, so the memory used by the previous batch is taken into account.
+
+        :param token_counts: The number of tokens in each text, including special tokens.
+        """
+        order = sorted(range(len(token_counts)), key=lambda i: -token_counts[i])
+        start = 0
+        while start < len(order):
+            longest = max(token_counts[order[start]], 1)
+            size = max(1, self.token_budget // longest)
+            batch = order[start:start + size]
+            start += len(batch)
+            peak_before = peak_memory_mb()
+            yield batch
+            if self.max_memory_mb is not None:
+                self._adjust(budget_limited=start < len(order), peak_increased=peak_memory_mb() != peak_before)
+
+    def _adjust(self, budget_limited: bool, peak_increased: bool):
+        """
+        :param budget_limited: Whether the batch was limited by the budget, rather than by the number of texts left.
+            Only then does a larger budget make a difference.
+        :param peak_increased: Whether the batch set a new peak resident set size, which means the memory used during
+            the forward pass exceeded the memory seen in between batches.
+        """
+        memory_mb = current_memory_mb()
+        peak_mb = peak_memory_mb()
+        if memory_mb > SHRINK_ABOVE * self.max_memory_mb or (peak_increased and peak_mb is not None and
+                                                             peak_mb > SHRINK_ABOVE * self.max_memory_mb):
+            new_budget = max(self.min_token_budget, int(self.token_budget * SHRINK_FACTOR))
+            direction = "shrink"
+        elif memory_mb < GROW_BELOW * self.max_memory_mb and budget_limited:
+            new_budget = min(self.max_token_budget, int(self.token_budget * GROW_FACTOR))
+            direction = "grow"
+        else:
+            return
+        if new_budget == self.token_budget:
+            return
+        logging.info(f"Token budget changed from {self.token_budget} to {new_budget} tokens per batch (resident set "
+                     f"{memory_mb:.0f} MB, ceiling {self.max_memory_mb:.0f} MB)")
+        count("token_budget_adjustments", direction=direction)
+        self.token_budget = new_budget
@@ -0,0 +1,224 @@
+import datetime
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from multiprocessing.queues import Queue
+from multiprocessing.synchronize import Barrier
+from typing import List, Dict, Any, Optional, Tuple
+
+import pandas as pd
+import yaml
+
+from AutotuneEmbeddingSettings import AutotuneEmbeddingSettings
+from Instrumentation import peak_memory_mb
+from Logging import open_log
+from PubMedSqliteIterator import fetch_pubmed_abstracts_for_embedding
+from TransformerEmbedder import TransformerEmbedder
+
+# The settings in the tuned settings file that override those in SqliteToEmbeddingVectors.yaml:
+TUNED_KEYS = ["embedding_batch_size", "intra_op_threads", "replicas"]
+
+
+def _fetch_sample(settings: AutotuneEmbeddingSettings) -> List[str]:
+    for records in fetch_pubmed_abstracts_for_embedding(settings.sqlite_path, settings.sample_size):
+        return [record[1] for record in records]
+    return []
+
+
+def _get_layouts(settings: AutotuneEmbeddingSettings) -> List[Tuple[int, int]]:
+    """
+    :return: The (replicas, intra_op_threads) combinations to try. Replicas are tried in increasing order, so the model
+    is downloaded (and exported to ONNX) by a single process first.
+    """
+    cpu_count = os.cpu_count() or 1
+    layouts = []
+    for replicas in sorted(settings.replicas):
+        if settings.intra_op_threads is None:
+            if replicas > cpu_count:
+                continue
+            layouts.append((replicas, cpu_count // replicas))
+        else:
+            layouts.extend((replicas, threads) for threads in sorted(settings.intra_op_threads))
+    return layouts
+
+
+def _run_replica(settings: AutotuneEmbeddingSettings,
+                 texts: List[str],
+                 intra_op_threads: int,
+                 barrier: Barrier,
+                 results: Queue):
+    """
+    Embeds the texts once for each batch size, and puts the start time, end time, and peak memory on the results
+    queue. All replicas wait for each other before each run, so they run at the same time.
+    """
+    open_log(settings.log_path)
+    embedder = TransformerEmbedder(model_name=settings.embedding_model,
+                                   embed_document_prompt=settings.embed_document_prompt,
+                                   embed_query_prompt=settings.embed_query_prompt,
+                                   backend=settings.backend,
+                                   quantize=settings.quantize,
+                                   intra_op_threads=intra_op_threads)
+    # Batch sizes are run in increasing order, because the peak memory of a process can only go up:
+    for batch_size in sorted(settings.batch_sizes):
+        embedder.embedding_batch_size = batch_size
+        # Not part of the timing:
+        embedder.embed_documents(texts[:batch_size])
+        barrier.wait()
+        start = time.time()
+        embedder.embed_documents(texts)
+        results.put((batch_size, start, time.time(), peak_memory_mb()))
+
+
+def _benchmark_layout(settings: AutotuneEmbeddingSettings,
+                      texts: List[str],
+                      replicas: int,
+                      intra_op_threads: int) -> List[Dict[str, Any]]:
+    """
+    Starts the replicas in separate processes, each embedding an equal share of the texts.
+
+    :return: One row per batch size, with the documents per second over all replicas, and the peak memory summed over
+    all replicas. If a replica fails, the rows of the batch sizes that did complete are returned.
+    """
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(replicas)
+    results = context.Queue()
+    processes = [context.Process(target=_run_replica,
+                                 args=(settings, texts[i::replicas], intra_op_threads, barrier, results))
+                 for i in range(replicas)]
+    for process in processes:
+        process.start()
+    batch_results: Dict[int, List[Tuple[float, float, Optional[float]]]] = {}
+    expected = replicas * len(settings.batch_sizes)
+    received = 0
+    deadline = time.time() + settings.timeout_seconds
+    try:
+        while received < expected:
+            try:
+                batch_size, start, end, memory = results.get(timeout=5)
+            except queue.Empty:
+                if any(process.exitcode not in [None, 0] for process in processes):
+                    logging.error(f"  A replica failed with {replicas} replicas and {intra_op_threads} threads")
+                    break
+                if time.time() > deadline:
+                    logging.error(f"  Timed out with {replicas} replicas and {intra_op_threads} threads")
+                    break
+                continue
+            batch_results.setdefault(batch_size, []).append((start, end, memory))
+            received += 1
+    finally:
+        for process in processes:
+            if received < expected:
+                process.terminate()
+            process.join()
+
+    rows = []
+    for batch_size, replica_results in sorted(batch_results.items()):
+        if len(replica_results) < replicas:
+            continue
+        seconds = max(end for _, end, _ in replica_results) - min(start for start, _, _ in replica_results)
+        memories = [memory for _, _, memory in replica_results]
+        row = {"embedding_batch_size": batch_size,
+               "intra_op_threads": intra_op_threads,
+               "replicas": replicas,
+               "documents_per_second": len(texts) / seconds,
+               "peak_memory_mb": None if None in memories else sum(memories)}
+        logging.info(f"- {row}")
+        rows.append(row)
+    return rows
+
+
+def autotune(settings: AutotuneEmbeddingSettings) -> pd.DataFrame:
+    """
+    Embeds a sample of articles with every combination of batch size, number of replicas, and threads per replica.
+
+    :return: A data frame with one row per combination.
+    """
+    texts = _fetch_sample(settings)
+    logging.info(f"Autotuning {settings.embedding_model} ({settings.backend}) on a sample of {len(texts)} articles")
+    rows = []
+    for replicas, intra_op_threads in _get_layouts(settings):
+        logging.info(f"Running {replicas} replica(s) with {intra_op_threads} thread(s) each")
+        rows.extend(_benchmark_layout(settings, texts, replicas, intra_op_threads))
+    return pd.DataFrame(rows)
+
+
+def select_best(results: pd.DataFrame, max_memory_mb: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    :return: The configuration with the highest documents per second that stays within the memory limit, or None if
+    there is none.
+    """
+    if max_memory_mb is not None and len(results) > 0:
+        results = results[results["peak_memory_mb"].isna() | (results["peak_memory_mb"] <= max_memory_mb)]
+    if len(results) == 0:
+        return None
+    return results.loc[results["documents_per_second"].idxmax()].to_dict()
+
+
+def write_tuned_settings(settings: AutotuneEmbeddingSettings, best: Dict[str, Any]):
+    tuned_settings = {"embedding_model": settings.embedding_model,
+                      "backend": settings.backend,
+                      "quantize": settings.quantize,
+                      "cpu_count": os.cpu_count(),
+                      "embedding_batch_size": int(best["embedding_batch_size"]),
+                      "intra_op_threads": int(best["intra_op_threads"]),
+                      "replicas": int(best["replicas"]),
+                      "documents_per_second": float(best["documents_per_second"])}
+    temp_file_name = f"{settings.tuned_settings_path}.tmp"
+    with open(temp_file_name, "w") as file:
+        file.write(f"# Written by AutotuneEmbedding on {datetime.datetime.now():%Y-%m-%d %H:%M:%S}\n")
+        yaml.safe_dump(tuned_settings, file, sort_keys=False)
+    os.replace(temp_file_name, settings.tuned_settings_path)
+
+
+def read_tuned_settings(path: str, embedding_model: str, backend: str, quantize: bool) -> Optional[Dict[str, Any]]:
+    """
+    Reads a file written by AutotuneEmbedding. The file is ignored if it was tuned for a different model or backend, or
+    on a host with a different number of CPUs.
+
+    :return: A dictionary with the tuned embedding_batch_size, intra_op_threads, and replicas, or None.
+    """
+    if not os.path.isfile(path):
+        logging.warning(f"Tuned settings file {path} not found, using the settings in the yaml file")
+        return None
+    with open(path) as file:
+        tuned_settings = yaml.safe_load(file)
+    expected = {"embedding_model": embedding_model,
+                "backend": backend,
+                "quantize": quantize,
+                "cpu_count": os.cpu_count()}
+    for key, value in expected.items():
+        if tuned_settings.get(key) != value:
+            logging.warning(f"Ignoring tuned settings file {path}: it was tuned for {key} {tuned_settings.get(key)}, "
+                            f"not {value}")
+            return None
+    return {key: tuned_settings[key] for key in TUNED_KEYS}
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = AutotuneEmbeddingSettings(config)
+    open_log(settings.log_path)
+    os.makedirs(settings.output_folder, exist_ok=True)
+
+    results = autotune(settings)
+    file_name = os.path.join(settings.output_folder, "AutotuneEmbedding.csv")
+    results.to_csv(file_name, index=False)
+    logging.info(f"Results written to {file_name}")
+
+    best = select_best(results, settings.max_memory_mb)
+    if best is None:
+        logging.error("No configuration completed within the memory limit. Tuned settings are not written")
+        return
+    write_tuned_settings(settings, best)
+    logging.info(f"Best configuration: {best}. Written to {settings.tuned_settings_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,47 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+from TransformerEmbedder import TORCH_BACKEND, ONNX_BACKEND
+
+
+@dataclass
+class AutotuneEmbeddingSettings:
+    sqlite_path: str
+    output_folder: str
+    log_path: str
+    tuned_settings_path: str
+    embedding_model: str
+    embed_document_prompt: Optional[str]
+    embed_query_prompt: Optional[str]
+    backend: str
+    quantize: bool
+    sample_size: int
+    batch_sizes: List[int]
+    replicas: List[int]
+    intra_op_threads: Optional[List[int]] = None
+    max_memory_mb: Optional[float] = None
+    timeout_seconds: float = 3600
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        model = config["model"]
+        for key, value in model.items():
+            setattr(self, key, value)
+        autotune = config["autotune"]
+        for key, value in autotune.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.backend not in [TORCH_BACKEND, ONNX_BACKEND]:
+            raise ValueError(f"model.backend must be '{TORCH_BACKEND}' or '{ONNX_BACKEND}', not '{self.backend}'")
+        if self.quantize and self.backend != ONNX_BACKEND:
+            raise ValueError(f"model.quantize is only supported by the '{ONNX_BACKEND}' backend")
+        if len(self.batch_sizes) == 0 or len(self.replicas) == 0:
+            raise ValueError("autotune.batch_sizes and autotune.replicas must not be empty")
+        if min(self.replicas) < 1:
+            raise ValueError("autotune.replicas must be at least 1")
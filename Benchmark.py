@@ -0,0 +1,358 @@
+import datetime
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from typing import List, Dict, Any, Optional
+
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from psycopg import sql
+
+from BenchmarkSettings import BenchmarkSettings
+from EvaluateVectorStore import summarize_latencies
+from Instrumentation import peak_memory_mb
+from LoadVectorsInStore import get_vector_type, create_vector_table, upsert_vectors_from_parquet
+from Logging import open_log
+from PubMedSqliteIterator import fetch_pubmed_abstracts_by_pmid_range
+from PubMedXmlToSqlite import create_tables, insert_records, parse_pubmed_xml, extract_sequence_number
+from ShardManifest import ShardManifest, shard_file_name
+from SqliteToEmbeddingVectors import embed_and_store, create_shard_entry
+from SyntheticPubMed import SyntheticPubMedSettings, generate_corpus
+from TransformerEmbedder import TransformerEmbedder
+
+load_dotenv()
+
+# Stages are compared on these metrics. For all of them, higher values are worse:
+_COMPARED_METRICS = ["seconds_per_1000_items", "peak_memory_mb", "latency_p95_ms"]
+
+
+def _xml_folder(settings: BenchmarkSettings) -> str:
+    return os.path.join(settings.work_folder, "xml")
+
+
+def _sqlite_path(settings: BenchmarkSettings) -> str:
+    return os.path.join(settings.work_folder, "PubMed.sqlite")
+
+
+def _parquet_folder(settings: BenchmarkSettings) -> str:
+    return os.path.join(settings.work_folder, "vectors")
+
+
+def _connect_to_postgres() -> psycopg.Connection:
+    if os.getenv("POSTGRES_SERVER") is None:
+        raise Exception("Must set environmental variables POSTGRES_SERVER, POSTGRES_USER, POSTGRES_PASSWORD, and "
+                        "POSTGRES_DATABASE to benchmark the vector store.")
+    conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                           user=os.getenv("POSTGRES_USER"),
+                           password=os.getenv("POSTGRES_PASSWORD"),
+                           dbname=os.getenv("POSTGRES_DATABASE"))
+    register_vector(conn)
+    return conn
+
+
+def _benchmark_xml_to_sqlite(settings: BenchmarkSettings) -> Dict[str, Any]:
+    con = sqlite3.connect(_sqlite_path(settings))
+    create_tables(con)
+    items = 0
+    parse_seconds = 0.0
+    start = time.perf_counter()
+    for file_name in sorted(f for f in os.listdir(_xml_folder(settings)) if f.endswith(".xml.gz")):
+        parse_start = time.perf_counter()
+        records = parse_pubmed_xml(os.path.join(_xml_folder(settings), file_name))
+        parse_seconds += time.perf_counter() - parse_start
+        insert_records(con, records, extract_sequence_number(file_name))
+        con.commit()
+        items += len(records.pmids)
+    seconds = time.perf_counter() - start
+    con.close()
+    return {"items": items, "seconds": seconds, "parse_seconds": parse_seconds}
+
+
+def _benchmark_embed(settings: BenchmarkSettings) -> Dict[str, Any]:
+    start = time.perf_counter()
+    embedder = TransformerEmbedder(model_name=settings.embedding_model,
+                                   embed_document_prompt=settings.embed_document_prompt,
+                                   embed_query_prompt=settings.embed_query_prompt,
+                                   embedding_batch_size=settings.embedding_batch_size)
+    model_load_seconds = time.perf_counter() - start
+    os.makedirs(_parquet_folder(settings), exist_ok=True)
+    # The same PMID-range shards and manifest as SqliteToEmbeddingVectors, including the checksums:
+    manifest = ShardManifest(_parquet_folder(settings))
+    items = 0
+    start = time.perf_counter()
+    for pmid_start, pmid_end, records in fetch_pubmed_abstracts_by_pmid_range(_sqlite_path(settings),
+                                                                              settings.pmids_per_shard):
+        shard_name = shard_file_name(pmid_start, pmid_end)
+        entry = create_shard_entry(settings, pmid_start, pmid_end, records)
+        embed_and_store(embedder, None, records, os.path.join(_parquet_folder(settings), shard_name))
+        manifest.add(shard_name, entry)
+        manifest.save()
+        items += len(records)
+    return {"items": items, "seconds": time.perf_counter() - start, "model_load_seconds": model_load_seconds}
+
+
+def _benchmark_load(settings: BenchmarkSettings) -> Dict[str, Any]:
+    conn = _connect_to_postgres()
+    vector_type = get_vector_type(settings.store_type)
+    create_vector_table(conn, settings.schema, settings.table, vector_type, settings.dimensions)
+    conn.commit()
+    items = 0
+    start = time.perf_counter()
+    manifest = ShardManifest(_parquet_folder(settings))
+    for shard_name in manifest.get_shard_names():
+        if not manifest.is_valid(shard_name):
+            raise ValueError(f"'{shard_name}' is missing or does not match the manifest. Run the embed stage again")
+        file_name = os.path.join(_parquet_folder(settings), shard_name)
+        items += upsert_vectors_from_parquet(conn, settings.schema, settings.table, vector_type, file_name, [])
+    seconds = time.perf_counter() - start
+    conn.close()
+    return {"items": items, "seconds": seconds}
+
+
+def _index_name(settings: BenchmarkSettings) -> str:
+    return f"idx_{settings.table}_embedding"
+
+
+def _benchmark_index(settings: BenchmarkSettings) -> Dict[str, Any]:
+    conn = _connect_to_postgres()
+    conn.autocommit = True
+    items = conn.execute(sql.SQL("SELECT COUNT(*) FROM {schema}.{table}").format(
+        schema=sql.Identifier(settings.schema),
+        table=sql.Identifier(settings.table))).fetchone()[0]
+    start = time.perf_counter()
+    conn.execute(sql.SQL("CREATE INDEX {index} ON {schema}.{table} USING hnsw (embedding {operator_class})").format(
+        index=sql.Identifier(_index_name(settings)),
+        schema=sql.Identifier(settings.schema),
+        table=sql.Identifier(settings.table),
+        operator_class=sql.SQL(f"{get_vector_type(settings.store_type)}_cosine_ops")))
+    seconds = time.perf_counter() - start
+    conn.execute(sql.SQL("ANALYZE {schema}.{table}").format(schema=sql.Identifier(settings.schema),
+                                                            table=sql.Identifier(settings.table)))
+    conn.close()
+    return {"items": items, "seconds": seconds}
+
+
+def _benchmark_search(settings: BenchmarkSettings) -> Dict[str, Any]:
+    # Article titles make reasonable queries. Taking every n-th title keeps the queries the same across runs:
+    con = sqlite3.connect(_sqlite_path(settings))
+    titles = [row[0] for row in con.execute("SELECT title FROM pubmed_articles WHERE title IS NOT NULL ORDER BY pmid")]
+    con.close()
+    queries = titles[::max(1, len(titles) // settings.query_count)][:settings.query_count]
+
+    embedder = TransformerEmbedder(model_name=settings.embedding_model,
+                                   embed_document_prompt=settings.embed_document_prompt,
+                                   embed_query_prompt=settings.embed_query_prompt,
+                                   embedding_batch_size=settings.embedding_batch_size)
+    start = time.perf_counter()
+    query_embeddings = embedder.embed_queries(queries)
+    query_embedding_seconds = time.perf_counter() - start
+
+    conn = _connect_to_postgres()
+    conn.autocommit = True
+    conn.execute(sql.SQL("SET hnsw.ef_search = {ef_search}").format(ef_search=sql.Literal(settings.ef_search)))
+    statement = sql.SQL("SELECT pmid FROM {schema}.{table} ORDER BY embedding <=> %s LIMIT {k}").format(
+        schema=sql.Identifier(settings.schema),
+        table=sql.Identifier(settings.table),
+        k=sql.Literal(settings.k))
+    latencies = []
+    start = time.perf_counter()
+    for query_embedding in query_embeddings:
+        embedding_str = f"[{','.join(map(str, query_embedding.tolist()))}]"
+        query_start = time.perf_counter()
+        conn.execute(statement, (embedding_str,)).fetchall()
+        latencies.append(time.perf_counter() - query_start)
+    seconds = time.perf_counter() - start
+    conn.close()
+    return {"items": len(queries),
+            "seconds": seconds,
+            "query_embedding_seconds": query_embedding_seconds,
+            **summarize_latencies(latencies)}
+
+
+_STAGE_FUNCTIONS = {
+    BenchmarkSettings.XML_TO_SQLITE: _benchmark_xml_to_sqlite,
+    BenchmarkSettings.EMBED: _benchmark_embed,
+    BenchmarkSettings.LOAD: _benchmark_load,
+    BenchmarkSettings.INDEX: _benchmark_index,
+    BenchmarkSettings.SEARCH: _benchmark_search,
+}
+
+
+def _run_stage(stage: str, settings: BenchmarkSettings) -> Dict[str, Any]:
+    """
+    Runs one stage in a worker process, so the peak memory is that of the stage alone.
+    """
+    result = _STAGE_FUNCTIONS[stage](settings)
+    result["items_per_second"] = result["items"] / result["seconds"] if result["seconds"] > 0 else 0.0
+    result["seconds_per_1000_items"] = 1000 * result["seconds"] / result["items"] if result["items"] > 0 else 0.0
+    result["peak_memory_mb"] = peak_memory_mb()
+    return result
+
+
+def _reset(settings: BenchmarkSettings):
+    """
+    Removes the output of earlier runs of the stages that will be benchmarked, so every run starts from the same state.
+    """
+    if BenchmarkSettings.XML_TO_SQLITE in settings.stages:
+        for file_name in glob.glob(f"{_sqlite_path(settings)}*"):
+            os.remove(file_name)
+    if BenchmarkSettings.EMBED in settings.stages:
+        shutil.rmtree(_parquet_folder(settings), ignore_errors=True)
+    if BenchmarkSettings.LOAD in settings.stages:
+        logging.info(f"Dropping table {settings.schema}.{settings.table}")
+        conn = _connect_to_postgres()
+        conn.execute(sql.SQL("DROP TABLE IF EXISTS {schema}.{table}").format(schema=sql.Identifier(settings.schema),
+                                                                             table=sql.Identifier(settings.table)))
+        conn.commit()
+        conn.close()
+    elif BenchmarkSettings.INDEX in settings.stages:
+        # The table is kept, but the index must be built again:
+        logging.info(f"Dropping index {settings.schema}.{_index_name(settings)}")
+        conn = _connect_to_postgres()
+        conn.execute(sql.SQL("DROP INDEX IF EXISTS {schema}.{index}").format(
+            schema=sql.Identifier(settings.schema),
+            index=sql.Identifier(_index_name(settings))))
+        conn.commit()
+        conn.close()
+
+
+def _get_environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True,
+                                text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"git_commit": commit or None,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count()}
+
+
+def _find_previous_baseline(settings: BenchmarkSettings, current_file_name: str) -> Optional[str]:
+    if settings.compare_to is not None:
+        return settings.compare_to
+    file_names = sorted(f for f in glob.glob(os.path.join(settings.baseline_folder, "Benchmark_*.json"))
+                        if os.path.abspath(f) != os.path.abspath(current_file_name))
+    return file_names[-1] if len(file_names) > 0 else None
+
+
+def compare_baselines(previous: Dict[str, Any], current: Dict[str, Any], regression_threshold: float) -> List[str]:
+    """
+    Compares the stage metrics of two benchmark runs, and logs the relative changes.
+
+    :param previous: The earlier run, as stored in its JSON file.
+    :param current: The current run.
+    :param regression_threshold: The relative increase (for example 0.1 for 10%) in time or memory above which a change
+    is reported as a regression.
+    :return: A list of descriptions of regressions. Empty if there are none.
+    """
+    if previous["corpus"] != current["corpus"] or previous["model"] != current["model"]:
+        logging.warning("The corpus or model differs from the baseline, so results may not be comparable")
+    regressions = []
+    for stage, metrics in current["stages"].items():
+        if stage not in previous["stages"]:
+            continue
+        for metric in _COMPARED_METRICS:
+            old_value = previous["stages"][stage].get(metric)
+            new_value = metrics.get(metric)
+            if old_value is None or new_value is None or old_value == 0:
+                continue
+            change = (new_value - old_value) / old_value
+            description = f"{stage} {metric}: {old_value:.2f} -> {new_value:.2f} ({change:+.1%})"
+            if change > regression_threshold:
+                regressions.append(description)
+                logging.warning(f"Regression: {description}")
+            else:
+                logging.info(description)
+    return regressions
+
+
+def run_benchmark(settings: BenchmarkSettings) -> Dict[str, Any]:
+    """
+    Generates a synthetic corpus, and runs each stage on it, recording throughput and peak memory per stage.
+
+    :return: The benchmark results, as written to the JSON baseline file.
+    """
+    os.makedirs(settings.work_folder, exist_ok=True)
+    os.makedirs(settings.baseline_folder, exist_ok=True)
+    _reset(settings)
+    corpus_settings = SyntheticPubMedSettings(settings.synthetic)
+    start = time.perf_counter()
+    if BenchmarkSettings.XML_TO_SQLITE in settings.stages:
+        shutil.rmtree(_xml_folder(settings), ignore_errors=True)
+        counts = generate_corpus(corpus_settings, _xml_folder(settings))
+    else:
+        counts = None
+    generate_seconds = time.perf_counter() - start
+
+    results = {"created": datetime.datetime.now().isoformat(timespec="seconds"),
+               "environment": _get_environment(),
+               "corpus": asdict(corpus_settings),
+               "model": {"embedding_model": settings.embedding_model,
+                         "embedding_batch_size": settings.embedding_batch_size,
+                         "store_type": settings.store_type},
+               "generate_seconds": generate_seconds,
+               "stages": {}}
+    for stage in settings.stages:
+        logging.info(f"Benchmarking stage '{stage}'")
+        # A new process per stage, so the peak memory of one stage does not carry over to the next:
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=open_log,
+                                 initargs=(settings.log_path,)) as executor:
+            result = executor.submit(_run_stage, stage, settings).result()
+        peak_memory = "unknown" if result["peak_memory_mb"] is None else f"{result['peak_memory_mb']:.0f} MB"
+        logging.info(f"- {result['items']} items in {result['seconds']:.1f} seconds "
+                     f"({result['items_per_second']:.1f} per second), peak memory {peak_memory}")
+        results["stages"][stage] = result
+        if stage == BenchmarkSettings.XML_TO_SQLITE:
+            con = sqlite3.connect(_sqlite_path(settings))
+            row_count = con.execute("SELECT COUNT(*) FROM pubmed_articles").fetchone()[0]
+            con.close()
+            if row_count != counts["expected_rows"]:
+                raise ValueError(f"Expected {counts['expected_rows']} articles in SQLite, but found {row_count}")
+    return results
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = BenchmarkSettings(config)
+    open_log(settings.log_path)
+
+    results = run_benchmark(settings)
+    file_name = os.path.join(settings.baseline_folder,
+                             f"Benchmark_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    previous_file_name = _find_previous_baseline(settings, file_name)
+    with open(file_name, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Results written to {file_name}")
+
+    if previous_file_name is not None:
+        logging.info(f"Comparing to {previous_file_name}")
+        with open(previous_file_name) as f:
+            previous = json.load(f)
+        regressions = compare_baselines(previous, results, settings.regression_threshold)
+        logging.info(f"{len(regressions)} regression(s) found")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,55 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+
+@dataclass
+class BenchmarkSettings:
+    work_folder: str
+    baseline_folder: str
+    log_path: str
+    compare_to: Optional[str]
+    regression_threshold: float
+    synthetic: Dict[str, Any]
+    embedding_model: str
+    embed_document_prompt: Optional[str]
+    embed_query_prompt: Optional[str]
+    embedding_batch_size: int
+    dimensions: int
+    store_type: str
+    schema: str
+    table: str
+    stages: List[str]
+    pmids_per_shard: int
+    query_count: int
+    k: int
+    ef_search: int
+
+    XML_TO_SQLITE = "xml_to_sqlite"
+    EMBED = "embed"
+    LOAD = "load"
+    INDEX = "index"
+    SEARCH = "search"
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        self.synthetic = config.get("synthetic") or {}
+        model = config["model"]
+        for key, value in model.items():
+            setattr(self, key, value)
+        vector_store = config["vector_store"]
+        for key, value in vector_store.items():
+            setattr(self, key, value)
+        benchmark = config["benchmark"]
+        for key, value in benchmark.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        stages = [self.XML_TO_SQLITE, self.EMBED, self.LOAD, self.INDEX, self.SEARCH]
+        for stage in self.stages:
+            if stage not in stages:
+                raise ValueError(f"benchmark.stages must contain only {stages}, not '{stage}'")
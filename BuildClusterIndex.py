@@ -0,0 +1,37 @@
+import logging
+import sys
+import time
+from typing import List
+
+import yaml
+
+from BuildClusterIndexSettings import BuildClusterIndexSettings
+from ClusterIndex import build_cluster_index, ClusterIndex
+from Logging import open_log
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = BuildClusterIndexSettings(config)
+    open_log(settings.log_path)
+
+    start = time.perf_counter()
+    build_cluster_index(parquet_folder=settings.parquet_folder,
+                        index_folder=settings.index_folder,
+                        cluster_count=settings.cluster_count,
+                        sample_size=settings.sample_size,
+                        iterations=settings.iterations,
+                        vector_dtype=settings.vector_dtype,
+                        max_buffer_mb=settings.max_buffer_mb,
+                        seed=settings.seed)
+    statistics = ClusterIndex(settings.index_folder).get_statistics()
+    logging.info(f"Built the cluster index in {time.perf_counter() - start:.0f} seconds: "
+                 f"{statistics['index_size_mb']:.0f} MB on disk, {statistics['memory_mb']:.1f} MB in memory")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
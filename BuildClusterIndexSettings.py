@@ -0,0 +1,32 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+from ClusterIndex import FLOAT16, FLOAT32
+
+
+@dataclass
+class BuildClusterIndexSettings:
+    parquet_folder: str
+    index_folder: str
+    log_path: str
+    cluster_count: int
+    sample_size: int
+    iterations: int
+    vector_dtype: str
+    max_buffer_mb: float
+    seed: int = 0
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        index = config["index"]
+        for key, value in index.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.vector_dtype not in [FLOAT32, FLOAT16]:
+            raise ValueError(f"index.vector_dtype must be '{FLOAT32}' or '{FLOAT16}', not '{self.vector_dtype}'")
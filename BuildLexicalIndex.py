@@ -0,0 +1,47 @@
+import logging
+import sqlite3
+import sys
+import time
+from typing import List
+
+import yaml
+
+from BuildLexicalIndexSettings import BuildLexicalIndexSettings
+from EvaluateVectorStore import evaluate_lexical_index
+from LexicalIndex import create_full_text_index, create_postings
+from Logging import open_log
+from RetrievalEvaluation import create_evaluator
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = BuildLexicalIndexSettings(config)
+    open_log(settings.log_path)
+
+    con = sqlite3.connect(settings.sqlite_path)
+    start = time.perf_counter()
+    create_full_text_index(con, settings.column_weights)
+    con.close()
+    logging.info(f"Built the full-text index in {time.perf_counter() - start:.0f} seconds")
+
+    logging.info(f"Writing the posting lists to {settings.index_path}")
+    start = time.perf_counter()
+    create_postings(sqlite_path=settings.sqlite_path,
+                    index_path=settings.index_path,
+                    postings_per_term=settings.postings_per_term,
+                    num_workers=settings.num_workers)
+    logging.info(f"Wrote the posting lists in {time.perf_counter() - start:.0f} seconds")
+
+    if settings.evaluator is not None:
+        results = evaluate_lexical_index(create_evaluator(settings.evaluator), settings.index_path)
+        logging.info(f"Searched the topics of {settings.evaluator}: p50 {results['latency_p50_ms']:.1f} ms, "
+                     f"p95 {results['latency_p95_ms']:.1f} ms, P@10 {results['P@10']:.3f}, "
+                     f"NDCG@1000 {results['NDCG@1000']:.3f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,23 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+
+@dataclass
+class BuildLexicalIndexSettings:
+    sqlite_path: str
+    index_path: str
+    log_path: str
+    postings_per_term: int
+    column_weights: Optional[Dict[str, float]] = None
+    num_workers: Optional[int] = None
+    evaluator: Optional[str] = None
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        index = config["index"]
+        for key, value in index.items():
+            setattr(self, key, value)
@@ -0,0 +1,337 @@
+import json
+import logging
+import os
+import shutil
+from typing import List, Tuple, Iterator, Dict, Any
+
+import numpy as np
+import pyarrow.parquet as pq
+from numpy import ndarray
+
+from Instrumentation import timer
+from LoadVectorsInStore import read_embeddings
+from ShardManifest import ShardManifest
+
+INDEX_FILE_NAME = "ClusterIndex.json"
+CENTROIDS_FILE_NAME = "Centroids.npy"
+
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+
+
+def cluster_file_name(cluster: int) -> str:
+    return f"Cluster_{cluster:05d}.bin"
+
+
+def get_record_dtype(dimensions: int, vector_dtype: str) -> np.dtype:
+    """
+    :return: The layout of a record in a cluster file: the PMID followed by the vector.
+    """
+    return np.dtype([("pmid", "<i8"), ("embedding", f"<{'f4' if vector_dtype == FLOAT32 else 'f2'}", (dimensions,))])
+
+
+def normalize(embeddings: ndarray) -> ndarray:
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-12)
+
+
+def get_parquet_files(parquet_folder: str) -> List[str]:
+    """
+    :return: The paths of the shards in the manifest of the folder, or of all Parquet files if there is no manifest.
+    """
+    manifest = ShardManifest(parquet_folder)
+    file_names = manifest.get_shard_names()
+    if not manifest.exists():
+        logging.warning(f"No manifest found in '{parquet_folder}', using all Parquet files in it")
+        file_names = sorted([f for f in os.listdir(parquet_folder) if f.endswith(".parquet")])
+    return [os.path.join(parquet_folder, file_name) for file_name in file_names]
+
+
+def iterate_vectors(file_paths: List[str]) -> Iterator[Tuple[ndarray, ndarray]]:
+    """
+    Reads the shards one row group at a time, so memory use does not depend on the size of the corpus.
+
+    :return: An iterator over tuples of PMIDs and normalized float32 embeddings.
+    """
+    for file_path in file_paths:
+        parquet_file = pq.ParquetFile(file_path)
+        for row_group_idx in range(parquet_file.num_row_groups):
+            with timer("parquet_read") as read_timer:
+                row_group = parquet_file.read_row_group(row_group_idx)
+                read_timer.items = row_group.num_rows
+            yield row_group.column("pmid").to_numpy().astype(np.int64), normalize(read_embeddings(row_group))
+
+
+def sample_vectors(file_paths: List[str], sample_size: int, rng: np.random.Generator) -> ndarray:
+    """
+    Draws a random sample of vectors from the shards, taking the same fraction from every shard.
+    """
+    total_rows = sum(pq.ParquetFile(file_path).metadata.num_rows for file_path in file_paths)
+    fraction = min(1.0, sample_size / total_rows)
+    samples = []
+    for _, embeddings in iterate_vectors(file_paths):
+        samples.append(embeddings[rng.random(len(embeddings)) < fraction])
+    return np.concatenate(samples)
+
+
+def assign_clusters(embeddings: ndarray, centroids: ndarray) -> ndarray:
+    """
+    :return: The index of the nearest (highest inner product) centroid of each vector.
+    """
+    return np.argmax(embeddings @ centroids.T, axis=1).astype(np.int32)
+
+
+def train_centroids(sample: ndarray,
+                    cluster_count: int,
+                    iterations: int,
+                    rng: np.random.Generator,
+                    batch_size: int = 65536) -> ndarray:
+    """
+    Spherical k-means: the centroids are normalized after every iteration, so clusters are formed by cosine similarity.
+    Empty clusters get a random vector from the sample as their new centroid.
+    """
+    if len(sample) < cluster_count:
+        raise ValueError(f"The sample has {len(sample)} vectors, fewer than the {cluster_count} clusters")
+    centroids = sample[rng.choice(len(sample), cluster_count, replace=False)].copy()
+    for iteration in range(iterations):
+        with timer("kmeans_iteration", items=len(sample)):
+            sums = np.zeros_like(centroids)
+            counts = np.zeros(cluster_count, dtype=np.int64)
+            for start in range(0, len(sample), batch_size):
+                batch = sample[start:start + batch_size]
+                assignments = assign_clusters(batch, centroids)
+                order = np.argsort(assignments, kind="stable")
+                clusters, starts = np.unique(assignments[order], return_index=True)
+                sums[clusters] += np.add.reduceat(batch[order], starts)
+                counts += np.bincount(assignments, minlength=cluster_count)
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+            centroids = normalize(sums)
+        logging.info(f"- K-means iteration {iteration + 1} of {iterations}: {int(empty.sum())} empty clusters, largest "
+                     f"cluster has {counts.max()} of {len(sample)} vectors")
+    return centroids
+
+
+class _ClusterWriter:
+    """
+    Appends records to the cluster files. Records are buffered in memory, and all buffers are written when they exceed
+    max_buffer_mb, so each cluster file is written in a few large appends, and no more than one file is open at a time.
+    """
+
+    def __init__(self, folder: str, record_dtype: np.dtype, cluster_count: int, max_buffer_mb: float):
+        self.folder = folder
+        self.record_dtype = record_dtype
+        self.max_buffer_bytes = max_buffer_mb * 2 ** 20
+        self.buffers: List[List[ndarray]] = [[] for _ in range(cluster_count)]
+        self.buffered_bytes = 0
+        self.sizes = np.zeros(cluster_count, dtype=np.int64)
+
+    def add(self, pmids: ndarray, embeddings: ndarray, assignments: ndarray):
+        records = np.empty(len(pmids), dtype=self.record_dtype)
+        records["pmid"] = pmids
+        records["embedding"] = embeddings
+        order = np.argsort(assignments, kind="stable")
+        clusters, starts = np.unique(assignments[order], return_index=True)
+        for cluster, cluster_records in zip(clusters.tolist(), np.split(records[order], starts[1:])):
+            self.buffers[cluster].append(cluster_records)
+        self.sizes += np.bincount(assignments, minlength=len(self.sizes))
+        self.buffered_bytes += records.nbytes
+        if self.buffered_bytes > self.max_buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        with timer("cluster_write", items=self.buffered_bytes // self.record_dtype.itemsize):
+            for cluster, buffer in enumerate(self.buffers):
+                if len(buffer) == 0:
+                    continue
+                with open(os.path.join(self.folder, cluster_file_name(cluster)), "ab") as file:
+                    for records in buffer:
+                        file.write(records.tobytes())
+                buffer.clear()
+        self.buffered_bytes = 0
+
+
+def build_cluster_index(parquet_folder: str,
+                        index_folder: str,
+                        cluster_count: int = 4096,
+                        sample_size: int = 300000,
+                        iterations: int = 10,
+                        vector_dtype: str = FLOAT16,
+                        max_buffer_mb: float = 256,
+                        seed: int = 0):
+    """
+    Builds a disk-resident IVF (inverted file) index from the Parquet shards. The vectors are clustered with k-means,
+    and rewritten into one contiguous file per cluster, so a search only has to read the files of the clusters nearest
+    to the query. The index is built in a temporary folder, which replaces the index folder when it is complete.
+
+    :param cluster_count: The number of clusters. Around the square root of the number of vectors is a good start.
+    :param sample_size: The number of vectors the centroids are trained on. The sample is held in memory as float32.
+    :param vector_dtype: 'float16' or 'float32'. The precision of the vectors in the cluster files.
+    :param max_buffer_mb: The maximum size of the records held in memory before they are written to the cluster files.
+    """
+    if vector_dtype not in [FLOAT32, FLOAT16]:
+        raise ValueError(f"vector_dtype must be '{FLOAT32}' or '{FLOAT16}', not '{vector_dtype}'")
+    rng = np.random.default_rng(seed)
+    file_paths = get_parquet_files(parquet_folder)
+    logging.info(f"Sampling {sample_size} vectors from {len(file_paths)} shards")
+    sample = sample_vectors(file_paths, sample_size, rng)
+    logging.info(f"Training {cluster_count} centroids on {len(sample)} vectors")
+    centroids = train_centroids(sample, cluster_count, iterations, rng)
+    del sample
+
+    temp_folder = f"{index_folder}.tmp"
+    if os.path.isdir(temp_folder):
+        shutil.rmtree(temp_folder)
+    os.makedirs(temp_folder)
+    record_dtype = get_record_dtype(centroids.shape[1], vector_dtype)
+    writer = _ClusterWriter(temp_folder, record_dtype, cluster_count, max_buffer_mb)
+    logging.info("Assigning the vectors to clusters")
+    for pmids, embeddings in iterate_vectors(file_paths):
+        with timer("cluster_assign", items=len(pmids)):
+            assignments = assign_clusters(embeddings, centroids)
+        writer.add(pmids, embeddings, assignments)
+    writer.flush()
+
+    np.save(os.path.join(temp_folder, CENTROIDS_FILE_NAME), centroids.astype(np.float32))
+    with open(os.path.join(temp_folder, INDEX_FILE_NAME), "w") as file:
+        json.dump({"dimensions": int(centroids.shape[1]),
+                   "vector_dtype": vector_dtype,
+                   "cluster_sizes": writer.sizes.tolist()}, file)
+    if os.path.isdir(index_folder):
+        shutil.rmtree(index_folder)
+    os.replace(temp_folder, index_folder)
+    sizes = writer.sizes
+    logging.info(f"Wrote {sizes.sum()} vectors in {cluster_count} clusters (median {np.median(sizes):.0f}, largest "
+                 f"{sizes.max()}, {int((sizes == 0).sum())} empty)")
+
+
+class ClusterIndex:
+    """
+    Searches the index built by build_cluster_index. Only the centroids are kept in memory. A search ranks the
+    centroids, and scans the nprobe nearest clusters, which are memory-mapped. The operating system is asked to read
+    all of them ahead before the first is scanned, so the reads overlap with each other and with the scanning.
+
+    :param index_folder: The folder holding the index.
+    """
+
+    def __init__(self, index_folder: str):
+        self.folder = index_folder
+        with open(os.path.join(index_folder, INDEX_FILE_NAME)) as file:
+            index = json.load(file)
+        self.centroids = np.load(os.path.join(index_folder, CENTROIDS_FILE_NAME))
+        self.cluster_sizes = np.array(index["cluster_sizes"], dtype=np.int64)
+        self.record_dtype = get_record_dtype(index["dimensions"], index["vector_dtype"])
+
+    def memory_mb(self) -> float:
+        """
+        :return: The memory held by the index itself, not counting the memory-mapped cluster files.
+        """
+        return (self.centroids.nbytes + self.cluster_sizes.nbytes) / 2 ** 20
+
+    def get_clusters(self, query_embedding: ndarray, nprobe: int) -> ndarray:
+        """
+        :return: The nprobe clusters nearest to the query, nearest first. Empty clusters are skipped.
+        """
+        similarities = self.centroids @ query_embedding
+        similarities[self.cluster_sizes == 0] = -np.inf
+        nprobe = min(nprobe, int((self.cluster_sizes > 0).sum()))
+        clusters = np.argpartition(-similarities, nprobe - 1)[:nprobe]
+        return clusters[np.argsort(-similarities[clusters])]
+
+    def bytes_read(self, clusters: ndarray) -> int:
+        return int(self.cluster_sizes[clusters].sum()) * self.record_dtype.itemsize
+
+    def _read_ahead(self, clusters: ndarray):
+        if not hasattr(os, "posix_fadvise"):
+            # Not available on Windows, which already reads ahead when memory-mapped files are read sequentially:
+            return
+        for cluster in clusters.tolist():
+            fd = os.open(os.path.join(self.folder, cluster_file_name(cluster)), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def _open_cluster(self, cluster: int) -> ndarray:
+        return np.memmap(os.path.join(self.folder, cluster_file_name(cluster)),
+                         dtype=self.record_dtype,
+                         mode="r",
+                         shape=(int(self.cluster_sizes[cluster]),))
+
+    def search(self, query_embedding: ndarray, k: int, nprobe: int) -> List[Tuple[int, float]]:
+        """
+        :param query_embedding: The query vector, transformed the same way as the documents.
+        :return: The PMIDs and cosine similarities of the k most similar vectors in the nprobe nearest clusters, most
+        similar first.
+        """
+        query_embedding = normalize(np.asarray(query_embedding, dtype=np.float32))
+        clusters = self.get_clusters(query_embedding, nprobe)
+        self._read_ahead(clusters)
+        pmids = []
+        similarities = []
+        candidate_count = 0
+        for cluster in clusters.tolist():
+            records = self._open_cluster(cluster)
+            cluster_similarities = records["embedding"].astype(np.float32) @ query_embedding
+            if len(cluster_similarities) > k:
+                top = np.argpartition(-cluster_similarities, k - 1)[:k]
+                pmids.append(records["pmid"][top])
+                similarities.append(cluster_similarities[top])
+            else:
+                pmids.append(np.array(records["pmid"]))
+                similarities.append(cluster_similarities)
+            del records
+            candidate_count += len(pmids[-1])
+            # Merged as we go, so memory stays proportional to k when k is large, for example in deep searches:
+            if candidate_count > 2 * k:
+                merged = _top_k_arrays(np.concatenate(pmids), np.concatenate(similarities), k)
+                pmids = [merged[0]]
+                similarities = [merged[1]]
+                candidate_count = k
+        return _top_k(np.concatenate(pmids), np.concatenate(similarities), k)
+
+    def exact_search(self, query_embeddings: ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        """
+        Scans all clusters once for a batch of queries. Used as ground truth for the recall of search().
+
+        :return: For each query, the PMIDs and cosine similarities of the k most similar vectors, most similar first.
+        """
+        query_embeddings = normalize(np.asarray(query_embeddings, dtype=np.float32))
+        pmids = [[] for _ in range(len(query_embeddings))]
+        similarities = [[] for _ in range(len(query_embeddings))]
+        for cluster in np.flatnonzero(self.cluster_sizes).tolist():
+            records = self._open_cluster(cluster)
+            cluster_similarities = query_embeddings @ records["embedding"].astype(np.float32).T
+            cluster_pmids = np.array(records["pmid"])
+            for i, query_similarities in enumerate(cluster_similarities):
+                if len(query_similarities) > k:
+                    top = np.argpartition(-query_similarities, k - 1)[:k]
+                    pmids[i].append(cluster_pmids[top])
+                    similarities[i].append(query_similarities[top])
+                else:
+                    pmids[i].append(cluster_pmids)
+                    similarities[i].append(query_similarities)
+            del records
+        return [_top_k(np.concatenate(query_pmids), np.concatenate(query_similarities), k)
+                for query_pmids, query_similarities in zip(pmids, similarities)]
+
+    def get_statistics(self) -> Dict[str, Any]:
+        sizes = self.cluster_sizes
+        return {"vector_count": int(sizes.sum()),
+                "cluster_count": len(sizes),
+                "median_cluster_size": float(np.median(sizes)),
+                "max_cluster_size": int(sizes.max()),
+                "index_size_mb": float(sizes.sum() * self.record_dtype.itemsize / 2 ** 20),
+                "memory_mb": self.memory_mb()}
+
+
+def _top_k_arrays(pmids: ndarray, similarities: ndarray, k: int) -> Tuple[ndarray, ndarray]:
+    if len(similarities) > k:
+        top = np.argpartition(-similarities, k - 1)[:k]
+        return pmids[top], similarities[top]
+    return pmids, similarities
+
+
+def _top_k(pmids: ndarray, similarities: ndarray, k: int) -> List[Tuple[int, float]]:
+    pmids, similarities = _top_k_arrays(pmids, similarities, k)
+    order = np.lexsort((pmids, -similarities))
+    return list(zip(pmids[order].tolist(), similarities[order].tolist()))
@@ -0,0 +1,146 @@
+import logging
+import os
+import sys
+import time
+from typing import List, Dict, Any
+
+import numpy as np
+import pandas as pd
+import yaml
+from tqdm import tqdm
+
+from ClusterIndex import ClusterIndex
+from ClusterIndexBenchmarkSettings import ClusterIndexBenchmarkSettings
+from EfSearchBenchmark import compute_recall
+from EmbeddingTransform import load_transform
+from EvaluateVectorStore import summarize_latencies
+from Instrumentation import get_instrumentation, current_memory_mb
+from Logging import open_log
+from RetrievalEvaluation import create_evaluator
+from TransformerEmbedder import TransformerEmbedder
+
+
+def benchmark_evaluator(index: ClusterIndex,
+                        settings: ClusterIndexBenchmarkSettings,
+                        embedder: TransformerEmbedder,
+                        evaluator_name: str) -> List[Dict[str, Any]]:
+    """
+    Runs the queries of the evaluator for every combination of nprobe and k. The timed searches run before the exact
+    search, which reads the whole index. Latencies depend on how much of the index is in the operating system cache,
+    so the number of MB read per query is reported as well.
+
+    :return: A list of dictionaries, one per combination, with latency percentiles (in milliseconds), the MB read per
+    query, recall relative to exact search, and the IR metrics of the evaluator.
+    """
+    evaluator = create_evaluator(evaluator_name)
+    query_id_to_query = evaluator.get_query_id_to_query()
+    query_ids = list(query_id_to_query.keys())
+    logging.info(f"Embedding {len(query_ids)} queries for {evaluator_name}")
+    query_embeddings = embedder.embed_queries([query_id_to_query[query_id] for query_id in query_ids])
+
+    rows = []
+    runs = []
+    for nprobe in settings.nprobe_values:
+        for k in settings.k_values:
+            logging.info(f"- nprobe = {nprobe}, k = {k}")
+            latencies = []
+            mb_read = []
+            query_id_to_pmids = {}
+            for query_id, query_embedding in tqdm(zip(query_ids, query_embeddings),
+                                                  total=len(query_ids),
+                                                  desc=f"nprobe={nprobe}, k={k}"):
+                start = time.perf_counter()
+                results = index.search(query_embedding, k=k, nprobe=nprobe)
+                latencies.append(time.perf_counter() - start)
+                get_instrumentation().observe("search", latencies[-1], items=1, index="cluster")
+                mb_read.append(index.bytes_read(index.get_clusters(query_embedding, nprobe)) / 2 ** 20)
+                query_id_to_pmids[query_id] = [pmid for pmid, _ in results]
+            rows.append({"evaluator": evaluator_name,
+                         "nprobe": nprobe,
+                         "k": k,
+                         **summarize_latencies(latencies),
+                         "mb_read_per_query": float(np.mean(mb_read))})
+            runs.append(query_id_to_pmids)
+
+    max_k = max(settings.k_values)
+    logging.info(f"Running exact search at k = {max_k}")
+    exact_results = index.exact_search(query_embeddings, max_k)
+    query_id_to_exact_pmids = {query_id: [pmid for pmid, _ in results]
+                               for query_id, results in zip(query_ids, exact_results)}
+    for row, query_id_to_pmids in zip(rows, runs):
+        row["recall"] = compute_recall(query_id_to_pmids, query_id_to_exact_pmids, row["k"])
+        row.update(evaluator.evaluate(query_id_to_pmids))
+        logging.info(f"nprobe = {row['nprobe']}, k = {row['k']}: p95 latency {row['latency_p95_ms']:.1f} ms, "
+                     f"{row['mb_read_per_query']:.1f} MB read per query, recall {row['recall']:.4f}")
+    return rows
+
+
+def plot_results(results: pd.DataFrame, file_name: str):
+    """
+    Plots recall against p95 latency, with one line per evaluator and k, and each point labeled with its nprobe.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(9, 6))
+    for (evaluator_name, k), group in results.groupby(["evaluator", "k"]):
+        group = group.sort_values("nprobe")
+        ax.plot(group["latency_p95_ms"], group["recall"], marker="o", label=f"{evaluator_name}, k={k}")
+        for _, row in group.iterrows():
+            ax.annotate(str(row["nprobe"]),
+                        (row["latency_p95_ms"], row["recall"]),
+                        textcoords="offset points",
+                        xytext=(4, -10),
+                        fontsize=7)
+    ax.set_xscale("log")
+    ax.set_xlabel("p95 latency (ms)")
+    ax.set_ylabel("Recall relative to exact search")
+    ax.set_title("Cluster index nprobe tradeoff (points labeled with nprobe)")
+    ax.grid(True, which="both", alpha=0.3)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(file_name, dpi=150)
+    plt.close(fig)
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = ClusterIndexBenchmarkSettings(config)
+    open_log(settings.log_path)
+    os.makedirs(settings.output_folder, exist_ok=True)
+
+    # Measured before the model is loaded, which happens when the first queries are embedded:
+    memory_before = current_memory_mb()
+    index = ClusterIndex(settings.index_folder)
+    statistics = index.get_statistics()
+    memory_after = current_memory_mb()
+    if memory_before is not None:
+        statistics["process_memory_increase_mb"] = memory_after - memory_before
+    logging.info(f"Loaded the cluster index: {statistics}")
+
+    transform = None if settings.parquet_folder is None else load_transform(settings.parquet_folder)
+    embedder = TransformerEmbedder(model_name=settings.embedding_model, transform=transform)
+
+    rows = []
+    for evaluator_name in settings.evaluators:
+        rows.extend(benchmark_evaluator(index, settings, embedder, evaluator_name))
+
+    results = pd.DataFrame(rows)
+    for key, value in statistics.items():
+        results[key] = value
+    index_name = os.path.basename(os.path.normpath(settings.index_folder))
+    csv_file_name = os.path.join(settings.output_folder, f"ClusterIndexBenchmark_{index_name}.csv")
+    results.to_csv(csv_file_name, index=False)
+    logging.info(f"Results written to '{csv_file_name}'")
+    plot_file_name = os.path.join(settings.output_folder, f"ClusterIndexBenchmark_{index_name}.png")
+    plot_results(results, plot_file_name)
+    logging.info(f"Plot written to '{plot_file_name}'")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
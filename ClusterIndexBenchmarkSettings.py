@@ -0,0 +1,27 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+
+@dataclass
+class ClusterIndexBenchmarkSettings:
+    index_folder: str
+    output_folder: str
+    log_path: str
+    embedding_model: str
+    evaluators: List[str]
+    nprobe_values: List[int]
+    k_values: List[int]
+    parquet_folder: Optional[str] = None
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        model = config["model"]
+        for key, value in model.items():
+            setattr(self, key, value)
+        benchmark = config["benchmark"]
+        for key, value in benchmark.items():
+            setattr(self, key, value)
@@ -0,0 +1,116 @@
+import logging
+import os
+import sys
+import time
+from typing import List, Dict
+
+import numpy as np
+import pandas as pd
+import yaml
+from numpy import ndarray
+
+from CompareEmbeddingBackendsSettings import CompareEmbeddingBackendsSettings
+from EvaluateVectorStore import evaluate_vector_store
+from Logging import open_log
+from PubMedSqliteIterator import fetch_pubmed_abstracts_for_embedding
+from RetrievalEvaluation import create_evaluator
+from TransformerEmbedder import TransformerEmbedder, TORCH_BACKEND
+
+# The retrieval metrics that are reported:
+_METRICS = ["map", "recip_rank", "P@10", "NDCG@10", "NDCG@100"]
+
+
+def _fetch_sample(settings: CompareEmbeddingBackendsSettings) -> List[str]:
+    for records in fetch_pubmed_abstracts_for_embedding(settings.sqlite_path, settings.sample_size):
+        return [record[1] for record in records]
+    return []
+
+
+def compute_cosine_agreement(reference: ndarray, embeddings: ndarray) -> Dict[str, float]:
+    """
+    Computes the cosine similarity between each pair of vectors of the same document.
+
+    :return: A dictionary with the mean, minimum, and first percentile of the cosine similarities.
+    """
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    cosines = np.sum(reference * embeddings, axis=1)
+    return {"cosine_mean": float(np.mean(cosines)),
+            "cosine_min": float(np.min(cosines)),
+            "cosine_p1": float(np.percentile(cosines, 1))}
+
+
+def compare_backends(settings: CompareEmbeddingBackendsSettings) -> pd.DataFrame:
+    """
+    Embeds a sample of articles with each backend, and compares throughput, agreement with the first (reference)
+    backend, and retrieval metrics.
+
+    :return: A data frame with one row per backend.
+    """
+    texts = _fetch_sample(settings)
+    logging.info(f"Embedding a sample of {len(texts)} articles with each backend")
+    rows = []
+    reference = None
+    reference_row = None
+    for backend in settings.backends:
+        logging.info(f"Backend {backend['name']}")
+        embedder = TransformerEmbedder(model_name=settings.embedding_model,
+                                       embed_document_prompt=settings.embed_document_prompt,
+                                       embed_query_prompt=settings.embed_query_prompt,
+                                       embedding_batch_size=settings.embedding_batch_size,
+                                       backend=backend.get("backend", TORCH_BACKEND),
+                                       quantize=backend.get("quantize", False),
+                                       intra_op_threads=backend.get("intra_op_threads"))
+        # Not part of the timing:
+        embedder.embed_documents(texts[:settings.embedding_batch_size])
+
+        start = time.perf_counter()
+        embeddings = embedder.embed_documents(texts)
+        seconds = time.perf_counter() - start
+        row = {"name": backend["name"],
+               "backend": embedder.backend,
+               "quantize": embedder.quantize,
+               "documents_per_second": len(texts) / seconds}
+        if reference is None:
+            reference = embeddings
+        else:
+            row.update(compute_cosine_agreement(reference, embeddings))
+
+        if settings.table_name is not None:
+            for evaluator_name in settings.evaluators:
+                results = evaluate_vector_store(create_evaluator(evaluator_name),
+                                                table_name=settings.table_name,
+                                                model_name=settings.embedding_model,
+                                                embedder=embedder)
+                for metric in _METRICS:
+                    row[f"{evaluator_name}_{metric}"] = results[metric]
+                    if reference_row is not None:
+                        row[f"{evaluator_name}_{metric}_change"] = (results[metric] -
+                                                                    reference_row[f"{evaluator_name}_{metric}"])
+        if reference_row is None:
+            reference_row = row
+        else:
+            row["speedup"] = row["documents_per_second"] / reference_row["documents_per_second"]
+        logging.info(f"- {row}")
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = CompareEmbeddingBackendsSettings(config)
+    open_log(settings.log_path)
+    os.makedirs(settings.output_folder, exist_ok=True)
+
+    results = compare_backends(settings)
+    file_name = os.path.join(settings.output_folder, "CompareEmbeddingBackends.csv")
+    results.to_csv(file_name, index=False)
+    logging.info(f"Results written to {file_name}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
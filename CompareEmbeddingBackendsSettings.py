@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+from TransformerEmbedder import TORCH_BACKEND, ONNX_BACKEND
+
+
+@dataclass
+class CompareEmbeddingBackendsSettings:
+    sqlite_path: str
+    output_folder: str
+    log_path: str
+    embedding_model: str
+    embed_document_prompt: Optional[str]
+    embed_query_prompt: Optional[str]
+    embedding_batch_size: int
+    sample_size: int
+    backends: List[Dict[str, Any]]
+    table_name: Optional[str]
+    evaluators: List[str]
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        model = config["model"]
+        for key, value in model.items():
+            setattr(self, key, value)
+        comparison = config["comparison"]
+        for key, value in comparison.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        names = [backend["name"] for backend in self.backends]
+        if len(set(names)) != len(names):
+            raise ValueError("comparison.backends must have unique names")
+        for backend in self.backends:
+            backend_type = backend.get("backend", TORCH_BACKEND)
+            if backend_type not in [TORCH_BACKEND, ONNX_BACKEND]:
+                raise ValueError(f"backend must be '{TORCH_BACKEND}' or '{ONNX_BACKEND}', not '{backend_type}'")
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional, TypeVar, Any
+
+import requests
+
+from Instrumentation import count
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class HttpStatusError(Exception):
+    """
+    Raised when a remote endpoint returns an unexpected HTTP status code.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @staticmethod
+    def from_response(response: requests.Response) -> "HttpStatusError":
+        retry_after = response.headers.get("Retry-After")
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        return HttpStatusError(f"error: {response.status_code}, details: {response.text}",
+                               status_code=response.status_code,
+                               retry_after=retry_after)
+
+
+class TokenBucket:
+    """
+    A thread-safe token-bucket rate limiter. Tokens are added at a fixed rate up to a maximum (the burst size), and each
+    request takes one token, waiting until one is available.
+    """
+
+    def __init__(self, rate_per_second: float, burst: int = 1):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate_per_second)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate_per_second
+            time.sleep(wait)
+
+
+def call_with_retries(function: Callable[[], T],
+                      limiter: Optional[TokenBucket] = None,
+                      max_retries: int = 5,
+                      initial_backoff: float = 1.0,
+                      max_backoff: float = 60.0) -> T:
+    """
+    Calls a function that sends a request to a remote endpoint, respecting the rate limit, and retrying with exponential
+    backoff (with jitter) on connection errors and on HTTP status codes that indicate a temporary problem.
+
+    :param function: The function to call. Should raise an HttpStatusError when the request fails.
+    :param limiter: An optional TokenBucket. A token is taken before every attempt, including retries.
+    :param max_retries: The maximum number of retries before the last error is raised.
+    :param initial_backoff: The wait in seconds before the first retry. Doubles with every retry.
+    :param max_backoff: The maximum wait in seconds between retries.
+    :return: The return value of the function.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return function()
+        except (HttpStatusError, requests.ConnectionError, requests.Timeout) as e:
+            if isinstance(e, HttpStatusError) and e.status_code not in RETRYABLE_STATUS_CODES:
+                raise
+            if attempt >= max_retries:
+                raise
+            backoff = min(max_backoff, initial_backoff * 2 ** attempt)
+            backoff = backoff * (0.5 + random.random() / 2)
+            if isinstance(e, HttpStatusError) and e.retry_after is not None:
+                backoff = max(backoff, e.retry_after)
+            logging.warning(f"Request failed ({e}), retrying in {backoff:.1f} seconds")
+            count("request_retries")
+            time.sleep(backoff)
+            attempt += 1
+
+
+class ResponseCache:
+    """
+    A cache of responses from remote endpoints in a single SQLite file. Entries are keyed by a hash of the request, so
+    changing a prompt automatically results in a new entry. Can be shared between threads.
+    """
+
+    def __init__(self, sqlite_path: str):
+        self._connection = sqlite3.connect(sqlite_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS response_cache (
+                request_hash TEXT PRIMARY KEY,
+                namespace TEXT,
+                response TEXT
+            )
+        """)
+        self._connection.commit()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_hash(namespace: str, request: Any) -> str:
+        request_json = json.dumps(request, sort_keys=True)
+        return hashlib.sha256(f"{namespace}\n{request_json}".encode("utf-8")).hexdigest()
+
+    def get(self, namespace: str, request: Any) -> Optional[Any]:
+        key = self.request_hash(namespace, request)
+        with self._lock:
+            row = self._connection.execute("SELECT response FROM response_cache WHERE request_hash = ?",
+                                           (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, namespace: str, request: Any, response: Any):
+        key = self.request_hash(namespace, request)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO response_cache (request_hash, namespace, response) "
+                                     "VALUES (?, ?, ?)",
+                                     (key, namespace, json.dumps(response)))
+            self._connection.commit()
+
+    def get_or_compute(self, namespace: str, request: Any, compute: Callable[[], Any]) -> Any:
+        response = self.get(namespace, request)
+        if response is None:
+            response = compute()
+            self.put(namespace, request, response)
+        return response
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,73 +1,52 @@
+import logging
+import multiprocessing
 import os
 import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Any
 
 import psycopg
+import yaml
 from psycopg import sql
 from dotenv import load_dotenv
 
-load_dotenv()
-
-
-# Configuration
-sqlite_db = '/Users/schuemie/Data/PubMed.sqlite'  # Path to SQLite database
-chunk_size = 100000  # Number of rows per chunk for large tables
-
-# Connect to SQLite
-sqlite_conn = sqlite3.connect(sqlite_db)
-sqlite_cursor = sqlite_conn.cursor()
-
-# Connect to PostgreSQL
-postgres_conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
-                                user=os.getenv("POSTGRES_USER"),
-                                password=os.getenv("POSTGRES_PASSWORD"),
-                                dbname=os.getenv("POSTGRES_DATABASE"))
-postgres_cursor = postgres_conn.cursor()
-postgres_cursor.execute(f"SET SEARCH_PATH={os.getenv('POSTGRES_SCHEMA')};")
-
-def create_table_in_postgres(table_name, columns):
-    """
-    Creates a table in PostgreSQL using the schema from SQLite.
-    """
-    postgres_cursor.execute(f"DROP TABLE IF EXISTS {table_name} CASCADE")
-    column_defs = ', '.join(f"{col['name']} {col['type']}" for col in columns)
-    create_table_query = f"CREATE TABLE {table_name} ({column_defs})"
-    postgres_cursor.execute(create_table_query)
-    postgres_conn.commit()
-    print(f"Created table {table_name} in PostgreSQL.")
+from CopySqliteToPostgresSettings import CopySqliteToPostgresSettings
+from Instrumentation import timer
+from Logging import open_log
 
+load_dotenv()
 
-def transfer_table_data(table_name, columns):
-    """
-    Transfers data from an SQLite table to PostgreSQL in chunks using fetchmany().
-    """
-    column_names = ', '.join([col['name'] for col in columns])
-    placeholders = ', '.join(['%s'] * len(columns))
-
-    # Prepare the PostgreSQL INSERT query
-    insert_query = sql.SQL(f"INSERT INTO {table_name} ({column_names}) VALUES ({placeholders})")
+# Tables with a pmid primary key and a file_number column, which can be synced incrementally:
+INCREMENTAL_TABLES = ["pubmed_articles", "deleted_pmids"]
+SYNC_STATE_TABLE = "sync_state"
 
-    # Read and transfer data in chunks
-    sqlite_cursor.execute(f"SELECT * FROM {table_name}")
-    total_rows = 0
-    while True:
-        rows = sqlite_cursor.fetchmany(chunk_size)  # Fetch the next chunk of rows
+# Types used when creating the Postgres tables, and the corresponding types for binary COPY:
+_POSTGRES_TO_COPY_TYPE = {
+    "INTEGER": "int4",
+    "BIGINT": "int8",
+    "TEXT": "text",
+    "BYTEA": "bytea",
+    "DOUBLE PRECISION": "float8",
+}
 
-        if not rows:  # Break the loop when no more rows are available
-            break
 
-        # Insert rows into PostgreSQL
-        postgres_cursor.executemany(insert_query.as_string(postgres_conn), rows)
-        postgres_conn.commit()
-        total_rows = total_rows + len(rows)
-        print(f"Copied {total_rows} rows to table {table_name}.")
+def _connect_to_postgres(autocommit: bool = False) -> psycopg.Connection:
+    conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                           user=os.getenv("POSTGRES_USER"),
+                           password=os.getenv("POSTGRES_PASSWORD"),
+                           dbname=os.getenv("POSTGRES_DATABASE"),
+                           autocommit=autocommit)
+    conn.execute(sql.SQL("SET SEARCH_PATH = {schema}").format(schema=sql.Identifier(os.getenv("POSTGRES_SCHEMA"))))
+    return conn
 
 
-def get_column_types_from_sqlite(table_name):
+def get_column_types_from_sqlite(sqlite_conn: sqlite3.Connection, table_name: str) -> List[Dict[str, Any]]:
     """
     Fetches column names and types from the SQLite table and converts them to PostgreSQL-compatible types.
     """
-    sqlite_cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = sqlite_cursor.fetchall()
+    columns = sqlite_conn.execute(f"PRAGMA table_info({table_name})").fetchall()
 
     column_defs = []
     for column in columns:
@@ -86,35 +65,320 @@ def get_column_types_from_sqlite(table_name):
         else:
             postgres_type = 'TEXT'  # Default to TEXT for unrecognized types
 
-        column_defs.append({'name': column_name, 'type': postgres_type})
+        column_defs.append({'name': column_name, 'type': postgres_type, 'primary_key': column[5] > 0})
 
     return column_defs
 
 
-def transfer_all_tables():
+def create_table_in_postgres(postgres_conn: psycopg.Connection, table_name: str, columns: List[Dict[str, Any]]):
+    """
+    Creates a table in PostgreSQL using the schema from SQLite. Constraints and indexes are not created here, because
+    loading is much faster without them. See create_indexes_in_postgres.
+    """
+    postgres_conn.execute(sql.SQL("DROP TABLE IF EXISTS {table} CASCADE").format(table=sql.Identifier(table_name)))
+    column_defs = sql.SQL(", ").join(
+        sql.SQL("{name} {type}").format(name=sql.Identifier(col['name']), type=sql.SQL(col['type'])) for col in columns
+    )
+    postgres_conn.execute(sql.SQL("CREATE TABLE {table} ({column_defs})").format(table=sql.Identifier(table_name),
+                                                                                column_defs=column_defs))
+    logging.info(f"Created table {table_name} in PostgreSQL.")
+
+
+def create_indexes_in_postgres(postgres_conn: psycopg.Connection, table_name: str, columns: List[Dict[str, Any]]):
+    """
+    Creates the primary key (if the SQLite table has one) and, for tables with a publication_date column, an index on
+    that column. Then updates the planner statistics.
+    """
+    pk_columns = [col['name'] for col in columns if col['primary_key']]
+    if len(pk_columns) > 0:
+        logging.info(f"Creating primary key on {table_name}")
+        postgres_conn.execute(sql.SQL("ALTER TABLE {table} ADD PRIMARY KEY ({columns})").format(
+            table=sql.Identifier(table_name),
+            columns=sql.SQL(", ").join(sql.Identifier(col) for col in pk_columns)
+        ))
+    if "publication_date" in [col['name'] for col in columns]:
+        logging.info(f"Creating publication_date index on {table_name}")
+        postgres_conn.execute(sql.SQL("CREATE INDEX {index} ON {table} (publication_date)").format(
+            index=sql.Identifier(f"idx_pd_{table_name}"),
+            table=sql.Identifier(table_name)
+        ))
+    postgres_conn.execute(sql.SQL("ANALYZE {table}").format(table=sql.Identifier(table_name)))
+
+
+def _copy_rows(sqlite_conn: sqlite3.Connection,
+               postgres_cursor: psycopg.Cursor,
+               target_table: str,
+               columns: List[Dict[str, Any]],
+               query: str,
+               parameters: Tuple,
+               fetch_size: int) -> int:
+    """
+    Streams the results of a SQLite query into a Postgres table using binary COPY.
+
+    :return: The number of rows copied.
+    """
+    statement = sql.SQL("COPY {table} ({columns}) FROM STDIN WITH (FORMAT BINARY)").format(
+        table=sql.Identifier(target_table),
+        columns=sql.SQL(", ").join(sql.Identifier(col['name']) for col in columns)
+    )
+    sqlite_cursor = sqlite_conn.execute(query, parameters)
+    row_count = 0
+    with timer("copy", table=target_table) as copy_timer, postgres_cursor.copy(statement) as copy:
+        copy.set_types([_POSTGRES_TO_COPY_TYPE[col['type']] for col in columns])
+        while True:
+            rows = sqlite_cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                copy.write_row(row)
+            row_count = row_count + len(rows)
+        copy_timer.items = row_count
+    return row_count
+
+
+def copy_rowid_range(sqlite_path: str,
+                     table_name: str,
+                     columns: List[Dict[str, Any]],
+                     start_rowid: int,
+                     end_rowid: int,
+                     fetch_size: int) -> Tuple[int, int, float]:
+    """
+    Copies the rows with start_rowid <= rowid < end_rowid from SQLite to Postgres using binary COPY. For the
+    pubmed_articles table the rowid is the PMID. Runs in a worker process, using its own connections.
+
+    :return: A tuple of the worker's process ID, the number of rows copied, and the time it took in seconds.
+    """
+    start_time = time.perf_counter()
+    sqlite_conn = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+    postgres_conn = _connect_to_postgres()
+    column_names = [col['name'] for col in columns]
+    with postgres_conn.cursor() as cursor:
+        row_count = _copy_rows(sqlite_conn=sqlite_conn,
+                               postgres_cursor=cursor,
+                               target_table=table_name,
+                               columns=columns,
+                               query=f"SELECT {', '.join(column_names)} FROM {table_name} WHERE rowid >= ? AND rowid < ?",
+                               parameters=(start_rowid, end_rowid),
+                               fetch_size=fetch_size)
+    postgres_conn.commit()
+    postgres_conn.close()
+    sqlite_conn.close()
+    seconds = time.perf_counter() - start_time
+    logging.info(f"Worker {os.getpid()} copied {row_count} rows of {table_name} with rowid {start_rowid} to "
+                 f"{end_rowid - 1} ({row_count / max(seconds, 1e-9):.0f} rows per second)")
+    return os.getpid(), row_count, seconds
+
+
+def transfer_table_data(settings: CopySqliteToPostgresSettings,
+                        executor: ProcessPoolExecutor,
+                        sqlite_conn: sqlite3.Connection,
+                        table_name: str,
+                        columns: List[Dict[str, Any]]):
+    """
+    Transfers data from an SQLite table to PostgreSQL. The table is split into rowid ranges that are copied in parallel.
+    """
+    min_rowid, max_rowid = sqlite_conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table_name}").fetchone()
+    if min_rowid is None:
+        logging.info(f"Table {table_name} is empty")
+        return
+    ranges = [(start, min(start + settings.rows_per_range, max_rowid + 1))
+              for start in range(min_rowid, max_rowid + 1, settings.rows_per_range)]
+    logging.info(f"Copying {table_name} in {len(ranges)} ranges using {settings.num_workers} workers")
+
+    start_time = time.perf_counter()
+    futures = [executor.submit(copy_rowid_range,
+                               settings.sqlite_path,
+                               table_name,
+                               columns,
+                               start,
+                               end,
+                               settings.fetch_size) for start, end in ranges]
+    worker_rows = {}
+    worker_seconds = {}
+    for future in futures:
+        pid, row_count, seconds = future.result()
+        worker_rows[pid] = worker_rows.get(pid, 0) + row_count
+        worker_seconds[pid] = worker_seconds.get(pid, 0) + seconds
+    seconds = time.perf_counter() - start_time
+    total_rows = sum(worker_rows.values())
+    for pid in worker_rows:
+        logging.info(f"- Worker {pid}: {worker_rows[pid]} rows, "
+                     f"{worker_rows[pid] / max(worker_seconds[pid], 1e-9):.0f} rows per second")
+    logging.info(f"Copied {total_rows} rows to table {table_name} in {seconds:.0f} seconds "
+                 f"({total_rows / max(seconds, 1e-9):.0f} rows per second)")
+
+
+def transfer_all_tables(settings: CopySqliteToPostgresSettings):
     """
     Copies all tables from the SQLite database to the PostgreSQL database.
     """
-    sqlite_cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tables = sqlite_cursor.fetchall()
+    sqlite_conn = sqlite3.connect(f"file:{settings.sqlite_path}?mode=ro", uri=True)
+    postgres_conn = _connect_to_postgres(autocommit=True)
+    tables = sqlite_conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+
+    with ProcessPoolExecutor(max_workers=settings.num_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=open_log,
+                             initargs=(settings.log_path,)) as executor:
+        for (table_name,) in tables:
+            logging.info(f"Transferring table: {table_name}")
+
+            # Get columns and create table in PostgreSQL
+            columns = get_column_types_from_sqlite(sqlite_conn, table_name)
+            create_table_in_postgres(postgres_conn, table_name, columns)
+
+            # Transfer data in parallel, then create indexes:
+            transfer_table_data(settings, executor, sqlite_conn, table_name, columns)
+            create_indexes_in_postgres(postgres_conn, table_name, columns)
+
+    record_sync_state(postgres_conn, get_max_file_number(sqlite_conn))
+    sqlite_conn.close()
+    postgres_conn.close()
+
+
+def get_max_file_number(sqlite_conn: sqlite3.Connection) -> int:
+    """
+    :return: The highest file number that has been applied to the SQLite database.
+    """
+    existing_tables = {row[0] for row in sqlite_conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    max_file_number = 0
+    for table_name in INCREMENTAL_TABLES:
+        if table_name in existing_tables:
+            value = sqlite_conn.execute(f"SELECT MAX(file_number) FROM {table_name}").fetchone()[0]
+            if value is not None:
+                max_file_number = max(max_file_number, value)
+    return max_file_number
+
+
+def record_sync_state(postgres_conn: psycopg.Connection, max_file_number: int):
+    """
+    Records the highest file number that has been synced to Postgres (the watermark).
+    """
+    postgres_conn.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            max_file_number INTEGER,
+            synced_at TIMESTAMPTZ
+        )
+    """).format(table=sql.Identifier(SYNC_STATE_TABLE)))
+    postgres_conn.execute(sql.SQL("""
+        INSERT INTO {table} (id, max_file_number, synced_at)
+        VALUES (1, %s, now())
+        ON CONFLICT (id) DO UPDATE SET max_file_number = EXCLUDED.max_file_number, synced_at = EXCLUDED.synced_at
+    """).format(table=sql.Identifier(SYNC_STATE_TABLE)), (max_file_number,))
+    logging.info(f"Postgres is now in sync up to file number {max_file_number}")
+
+
+def _upsert_from_staging(postgres_conn: psycopg.Connection,
+                         table_name: str,
+                         staging_table: str,
+                         columns: List[Dict[str, Any]]) -> int:
+    update_columns = [col['name'] for col in columns if col['name'] != "pmid"]
+    statement = sql.SQL("""
+        INSERT INTO {table} ({columns})
+        SELECT {columns} FROM {staging}
+        ON CONFLICT (pmid) DO UPDATE SET {updates}
+    """).format(
+        table=sql.Identifier(table_name),
+        staging=sql.Identifier(staging_table),
+        columns=sql.SQL(", ").join(sql.Identifier(col['name']) for col in columns),
+        updates=sql.SQL(", ").join(sql.SQL("{col} = EXCLUDED.{col}").format(col=sql.Identifier(col))
+                                   for col in update_columns)
+    )
+    return postgres_conn.execute(statement).rowcount
+
+
+def sync_incremental(settings: CopySqliteToPostgresSettings):
+    """
+    Brings Postgres up to date with SQLite by only copying rows from files that are newer than the watermark recorded
+    in the last sync. New and updated articles are copied into a staging table and merged with an upsert. Deleted
+    articles are removed. All changes, including the new watermark, are committed in a single transaction.
+    """
+    sqlite_conn = sqlite3.connect(f"file:{settings.sqlite_path}?mode=ro", uri=True)
+    postgres_conn = _connect_to_postgres(autocommit=True)
+    try:
+        try:
+            watermark = postgres_conn.execute(sql.SQL("SELECT max_file_number FROM {table}").format(
+                table=sql.Identifier(SYNC_STATE_TABLE))).fetchone()
+        except psycopg.errors.UndefinedTable:
+            watermark = None
+        if watermark is None:
+            raise Exception("No sync state found in Postgres. Run CopySqliteToPostgres in full mode first.")
+        watermark = watermark[0]
+        # Files applied to SQLite while syncing are left for the next sync:
+        max_file_number = get_max_file_number(sqlite_conn)
+        if max_file_number <= watermark:
+            logging.info(f"Postgres is already in sync up to file number {watermark}")
+            return
+        logging.info(f"Syncing files {watermark + 1} to {max_file_number}")
 
-    for (table_name,) in tables:
-        print(f"Transferring table: {table_name}")
+        start_time = time.perf_counter()
+        staging_tables = {}
+        with postgres_conn.transaction():
+            for table_name in INCREMENTAL_TABLES:
+                columns = get_column_types_from_sqlite(sqlite_conn, table_name)
+                postgres_conn.execute(sql.SQL("""
+                    CREATE TABLE IF NOT EXISTS {table} ({column_defs})
+                """).format(table=sql.Identifier(table_name),
+                            column_defs=sql.SQL(", ").join(
+                                sql.SQL("{name} {type}{pk}").format(name=sql.Identifier(col['name']),
+                                                                    type=sql.SQL(col['type']),
+                                                                    pk=sql.SQL(" PRIMARY KEY" if col['primary_key'] else ""))
+                                for col in columns)))
+                staging_table = f"staging_{table_name}"
+                staging_tables[table_name] = staging_table
+                postgres_conn.execute(sql.SQL("CREATE TEMPORARY TABLE {staging} (LIKE {table}) ON COMMIT DROP").format(
+                    staging=sql.Identifier(staging_table),
+                    table=sql.Identifier(table_name)
+                ))
+                column_names = [col['name'] for col in columns]
+                with postgres_conn.cursor() as cursor:
+                    row_count = _copy_rows(sqlite_conn=sqlite_conn,
+                                           postgres_cursor=cursor,
+                                           target_table=staging_table,
+                                           columns=columns,
+                                           query=f"SELECT {', '.join(column_names)} FROM {table_name} "
+                                                 f"WHERE file_number > ? AND file_number <= ?",
+                                           parameters=(watermark, max_file_number),
+                                           fetch_size=settings.fetch_size)
+                logging.info(f"- Copied {row_count} new rows of {table_name} to staging")
+                row_count = _upsert_from_staging(postgres_conn, table_name, staging_table, columns)
+                logging.info(f"- Upserted {row_count} rows into {table_name}")
 
-        # Get columns and create table in PostgreSQL
-        columns = get_column_types_from_sqlite(table_name)
-        create_table_in_postgres(table_name, columns)
+            # Propagate deletions, and forget deletions of articles that have since been added again:
+            row_count = postgres_conn.execute(sql.SQL("""
+                DELETE FROM pubmed_articles
+                USING {staging}
+                WHERE pubmed_articles.pmid = {staging}.pmid
+            """).format(staging=sql.Identifier(staging_tables["deleted_pmids"]))).rowcount
+            logging.info(f"- Deleted {row_count} rows from pubmed_articles")
+            postgres_conn.execute(sql.SQL("""
+                DELETE FROM deleted_pmids
+                USING {staging}
+                WHERE deleted_pmids.pmid = {staging}.pmid
+            """).format(staging=sql.Identifier(staging_tables["pubmed_articles"])))
+            record_sync_state(postgres_conn, max_file_number)
+        postgres_conn.execute("ANALYZE pubmed_articles")
+        logging.info(f"Incremental sync took {time.perf_counter() - start_time:.0f} seconds")
+    finally:
+        sqlite_conn.close()
+        postgres_conn.close()
 
-        # Transfer data in chunks
-        transfer_table_data(table_name, columns)
 
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = CopySqliteToPostgresSettings(config)
+    open_log(settings.log_path)
 
-# Run the transfer
-transfer_all_tables()
+    if settings.mode == settings.FULL:
+        transfer_all_tables(settings)
+    else:
+        sync_incremental(settings)
 
-# Close connections
-sqlite_conn.close()
-postgres_conn.close()
 
-# CREATE UNIQUE INDEX idx_pmid_pubmed_articles ON pubmed.pubmed_articles (pmid);
-# CREATE INDEX idx_pd_pubmed_articles ON pubmed.pubmed_articles (publication_date);
\ No newline at end of file
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
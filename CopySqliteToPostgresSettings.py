@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+
+@dataclass
+class CopySqliteToPostgresSettings:
+    sqlite_path: str
+    log_path: str
+    num_workers: int
+    rows_per_range: int
+    fetch_size: int
+    mode: str
+
+    FULL = "full"
+    INCREMENTAL = "incremental"
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        processing = config["processing"]
+        for key, value in processing.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.mode not in [self.FULL, self.INCREMENTAL]:
+            raise ValueError(f"processing.mode must be '{self.FULL}' or '{self.INCREMENTAL}'")
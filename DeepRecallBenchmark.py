@@ -0,0 +1,141 @@
+import logging
+import os
+import sys
+import time
+from typing import List, Dict, Any
+
+import pandas as pd
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from tqdm import tqdm
+
+from ClusterIndex import ClusterIndex
+from DeepRecallBenchmarkSettings import DeepRecallBenchmarkSettings
+from EmbeddingTransform import load_transform
+from EvaluateVectorStore import summarize_latencies
+from Instrumentation import get_instrumentation
+from LexicalIndex import LexicalIndex
+from Logging import open_log
+from PaginatedSearch import VectorStorePager, ClusterIndexPager, LexicalIndexPager, POSTGRES, CLUSTER, LEXICAL
+from RetrievalEvaluation import RetrievalEvaluator, create_evaluator
+from TransformerEmbedder import TransformerEmbedder
+
+load_dotenv()
+
+
+def compute_recall_at_depths(evaluator: RetrievalEvaluator,
+                             query_id_to_pmids: Dict[int, List[int]],
+                             depths: List[int]) -> Dict[str, float]:
+    """
+    :return: For each depth, the fraction of all relevant articles (over all queries) that are retrieved in the top
+    depth results. This is the recall that matters for systematic reviews, where every relevant article is screened.
+    """
+    recalls = {}
+    for depth in depths:
+        metrics = evaluator.evaluate({query_id: pmids[:depth] for query_id, pmids in query_id_to_pmids.items()})
+        recalls[f"recall@{depth}"] = metrics["num_rel_ret"] / metrics["num_rel"] if metrics["num_rel"] > 0 else 0.0
+    return recalls
+
+
+def benchmark_evaluator(pager,
+                        settings: DeepRecallBenchmarkSettings,
+                        embedder: TransformerEmbedder,
+                        evaluator_name: str) -> Dict[str, Any]:
+    """
+    Retrieves max_results articles for each query of the evaluator, one page at a time.
+
+    :param pager: A VectorStorePager, ClusterIndexPager, or LexicalIndexPager.
+    :param embedder: The embedder for the queries. None for the lexical engine, which searches the query text.
+    :return: A dictionary with the latency of the first page and of all pages (in milliseconds), the recall at each
+    depth, and the IR metrics of the evaluator.
+    """
+    evaluator = create_evaluator(evaluator_name)
+    query_id_to_query = evaluator.get_query_id_to_query()
+    query_ids = list(query_id_to_query.keys())
+    queries = [query_id_to_query[query_id] for query_id in query_ids]
+    if embedder is not None:
+        logging.info(f"Embedding {len(query_ids)} queries for {evaluator_name}")
+        queries = embedder.embed_queries(queries)
+
+    first_page_latencies = []
+    latencies = []
+    query_id_to_pmids = {}
+    for query_id, query in tqdm(zip(query_ids, queries), total=len(query_ids), desc=evaluator_name):
+        pmids = []
+        start = time.perf_counter()
+        for page in pager.search_pages(query, page_size=settings.page_size, max_results=settings.max_results):
+            if len(pmids) == 0:
+                first_page_latencies.append(time.perf_counter() - start)
+            pmids.extend(pmid for pmid, _ in page)
+        latencies.append(time.perf_counter() - start)
+        get_instrumentation().observe("deep_search", latencies[-1], items=len(pmids), engine=settings.engine)
+        query_id_to_pmids[query_id] = pmids
+
+    first_page = summarize_latencies(first_page_latencies)
+    row = {"evaluator": evaluator_name,
+           "engine": settings.engine,
+           "page_size": settings.page_size,
+           "max_results": settings.max_results,
+           "mean_results": sum(len(pmids) for pmids in query_id_to_pmids.values()) / len(query_id_to_pmids),
+           "first_page_p50_ms": first_page["latency_p50_ms"],
+           "first_page_p95_ms": first_page["latency_p95_ms"],
+           **summarize_latencies(latencies),
+           **compute_recall_at_depths(evaluator, query_id_to_pmids, settings.depths)}
+    row.update(evaluator.evaluate(query_id_to_pmids))
+    recalls = ", ".join(f"{depth}: {row[f'recall@{depth}']:.4f}" for depth in settings.depths)
+    logging.info(f"{evaluator_name}: first page p95 {row['first_page_p95_ms']:.1f} ms, all pages p95 "
+                 f"{row['latency_p95_ms']:.1f} ms, recall at depth {recalls}")
+    return row
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = DeepRecallBenchmarkSettings(config)
+    open_log(settings.log_path)
+    os.makedirs(settings.output_folder, exist_ok=True)
+
+    conn = None
+    embedder = None
+    if settings.engine == LEXICAL:
+        pager = LexicalIndexPager(LexicalIndex(settings.lexical_index_path))
+        target_name = os.path.splitext(os.path.basename(settings.lexical_index_path))[0]
+    else:
+        transform = None if settings.parquet_folder is None else load_transform(settings.parquet_folder)
+        embedder = TransformerEmbedder(model_name=settings.embedding_model, transform=transform)
+        if settings.engine == POSTGRES:
+            conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                                   user=os.getenv("POSTGRES_USER"),
+                                   password=os.getenv("POSTGRES_PASSWORD"),
+                                   dbname=os.getenv("POSTGRES_DATABASE"),
+                                   autocommit=True)
+            register_vector(conn)
+            pager = VectorStorePager(conn=conn,
+                                     schema=settings.schema,
+                                     table=settings.table,
+                                     ef_search=settings.ef_search,
+                                     max_scan_tuples=settings.max_scan_tuples,
+                                     scan_mem_multiplier=settings.scan_mem_multiplier)
+            target_name = settings.table
+        elif settings.engine == CLUSTER:
+            pager = ClusterIndexPager(ClusterIndex(settings.index_folder), nprobe=settings.nprobe)
+            target_name = os.path.basename(os.path.normpath(settings.index_folder))
+
+    rows = []
+    for evaluator_name in settings.evaluators:
+        rows.append(benchmark_evaluator(pager, settings, embedder, evaluator_name))
+    if conn is not None:
+        conn.close()
+
+    csv_file_name = os.path.join(settings.output_folder, f"DeepRecallBenchmark_{settings.engine}_{target_name}.csv")
+    pd.DataFrame(rows).to_csv(csv_file_name, index=False)
+    logging.info(f"Results written to '{csv_file_name}'")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
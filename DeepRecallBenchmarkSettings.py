@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+from PaginatedSearch import ENGINES, POSTGRES, CLUSTER, LEXICAL
+
+
+@dataclass
+class DeepRecallBenchmarkSettings:
+    output_folder: str
+    log_path: str
+    embedding_model: str
+    engine: str
+    evaluators: List[str]
+    page_size: int
+    max_results: int
+    depths: List[int]
+    parquet_folder: Optional[str] = None
+    schema: Optional[str] = None
+    table: Optional[str] = None
+    ef_search: int = 1000
+    max_scan_tuples: Optional[int] = None
+    scan_mem_multiplier: float = 1
+    index_folder: Optional[str] = None
+    nprobe: int = 64
+    lexical_index_path: Optional[str] = None
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        model = config["model"]
+        for key, value in model.items():
+            setattr(self, key, value)
+        search = config["search"]
+        for key, value in search.items():
+            setattr(self, key, value)
+        benchmark = config["benchmark"]
+        for key, value in benchmark.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.engine not in ENGINES:
+            raise ValueError(f"search.engine must be in {ENGINES}, not '{self.engine}'")
+        if self.engine == POSTGRES and (self.schema is None or self.table is None):
+            raise ValueError(f"search.schema and search.table are required for the '{POSTGRES}' engine")
+        if self.engine == CLUSTER and self.index_folder is None:
+            raise ValueError(f"search.index_folder is required for the '{CLUSTER}' engine")
+        if self.engine == LEXICAL and self.lexical_index_path is None:
+            raise ValueError(f"search.lexical_index_path is required for the '{LEXICAL}' engine")
+        if max(self.depths) > self.max_results:
+            raise ValueError("benchmark.depths can not exceed benchmark.max_results")
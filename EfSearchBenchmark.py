@@ -0,0 +1,187 @@
+import logging
+import os
+import sys
+import time
+from typing import List, Dict
+
+import numpy as np
+import pandas as pd
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from psycopg import sql
+from tqdm import tqdm
+
+from EfSearchBenchmarkSettings import EfSearchBenchmarkSettings
+from EvaluateVectorStore import summarize_latencies
+from Instrumentation import get_instrumentation
+from Logging import open_log
+from Profiling import Profiler, open_profiler
+from RetrievalEvaluation import RetrievalEvaluator, TrecCovidEvaluator, BioASQTrain2024Evaluator
+from TransformerEmbedder import TransformerEmbedder
+
+load_dotenv()
+
+
+def _search(conn: psycopg.Connection,
+            settings: EfSearchBenchmarkSettings,
+            query_embedding: List[float],
+            k: int) -> List[int]:
+    statement = sql.SQL("SELECT pmid FROM {schema}.{table} ORDER BY embedding <=> %s LIMIT {k}").format(
+        schema=sql.Identifier(settings.schema),
+        table=sql.Identifier(settings.table),
+        k=sql.Literal(k)
+    )
+    embedding_str = f"[{','.join(map(str, query_embedding))}]"
+    result = conn.execute(statement, (embedding_str,))
+    return [row[0] for row in result.fetchall()]
+
+
+def _exact_search(conn: psycopg.Connection,
+                  settings: EfSearchBenchmarkSettings,
+                  query_id_to_embedding: Dict[int, List[float]],
+                  k: int) -> Dict[int, List[int]]:
+    """
+    Brute-force search used as ground truth. Disabling index scans forces Postgres to compute the distance to every
+    vector, so this is slow, and is therefore only done once per query at the largest k.
+    """
+    query_id_to_pmids = {}
+    with conn.transaction():
+        conn.execute("SET LOCAL enable_indexscan = off")
+        conn.execute("SET LOCAL enable_bitmapscan = off")
+        for query_id, query_embedding in tqdm(query_id_to_embedding.items(), desc="Exact search"):
+            query_id_to_pmids[query_id] = _search(conn, settings, query_embedding, k)
+    return query_id_to_pmids
+
+
+def compute_recall(query_id_to_pmids: Dict[int, List[int]],
+                   query_id_to_exact_pmids: Dict[int, List[int]],
+                   k: int) -> float:
+    recalls = []
+    for query_id, exact_pmids in query_id_to_exact_pmids.items():
+        exact_pmids = set(exact_pmids[:k])
+        if len(exact_pmids) == 0:
+            continue
+        retrieved = set(query_id_to_pmids.get(query_id, [])[:k])
+        recalls.append(len(retrieved & exact_pmids) / len(exact_pmids))
+    return float(np.mean(recalls))
+
+
+def benchmark_evaluator(conn: psycopg.Connection,
+                        settings: EfSearchBenchmarkSettings,
+                        embedder: TransformerEmbedder,
+                        evaluator_name: str,
+                        evaluator: RetrievalEvaluator,
+                        profiler: Profiler) -> List[Dict[str, float]]:
+    """
+    Runs the queries of the evaluator for every combination of ef_search and k. Each combination is a batch for the
+    profiler.
+
+    :return: A list of dictionaries, one per combination, with latency percentiles (in milliseconds), recall relative to
+    exact search, and the IR metrics of the evaluator.
+    """
+    query_id_to_query = evaluator.get_query_id_to_query()
+    logging.info(f"Embedding {len(query_id_to_query)} queries for {evaluator_name}")
+    query_id_to_embedding = {query_id: embedder.embed_query(query) for query_id, query in query_id_to_query.items()}
+
+    max_k = max(settings.k_values)
+    logging.info(f"Running exact search at k = {max_k}")
+    query_id_to_exact_pmids = _exact_search(conn, settings, query_id_to_embedding, max_k)
+
+    rows = []
+    for ef_search in settings.ef_search_values:
+        conn.execute(sql.SQL("SET hnsw.ef_search = {ef_search}").format(ef_search=sql.Literal(ef_search)))
+        for k in settings.k_values:
+            with profiler.batch():
+                logging.info(f"- ef_search = {ef_search}, k = {k}")
+                latencies = []
+                query_id_to_pmids = {}
+                for query_id, query_embedding in tqdm(query_id_to_embedding.items(), desc=f"ef={ef_search}, k={k}"):
+                    start = time.perf_counter()
+                    query_id_to_pmids[query_id] = _search(conn, settings, query_embedding, k)
+                    latencies.append(time.perf_counter() - start)
+                    get_instrumentation().observe("search", latencies[-1], items=1, table=settings.table)
+                row = {
+                    "evaluator": evaluator_name,
+                    "ef_search": ef_search,
+                    "k": k,
+                    **summarize_latencies(latencies),
+                    "mean_returned": float(np.mean([len(pmids) for pmids in query_id_to_pmids.values()])),
+                    "recall": compute_recall(query_id_to_pmids, query_id_to_exact_pmids, k)
+                }
+                row.update(evaluator.evaluate(query_id_to_pmids))
+                logging.info(f"  p95 latency: {row['latency_p95_ms']:.1f} ms, recall: {row['recall']:.4f}")
+                rows.append(row)
+    return rows
+
+
+def plot_results(results: pd.DataFrame, file_name: str):
+    """
+    Plots recall against p95 latency, with one line per evaluator and k, and each point labeled with its ef_search.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(9, 6))
+    for (evaluator_name, k), group in results.groupby(["evaluator", "k"]):
+        group = group.sort_values("ef_search")
+        ax.plot(group["latency_p95_ms"], group["recall"], marker="o", label=f"{evaluator_name}, k={k}")
+        for _, row in group.iterrows():
+            ax.annotate(str(row["ef_search"]),
+                        (row["latency_p95_ms"], row["recall"]),
+                        textcoords="offset points",
+                        xytext=(4, -10),
+                        fontsize=7)
+    ax.set_xscale("log")
+    ax.set_xlabel("p95 latency (ms)")
+    ax.set_ylabel("Recall relative to exact search")
+    ax.set_title("HNSW ef_search tradeoff (points labeled with ef_search)")
+    ax.grid(True, which="both", alpha=0.3)
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(file_name, dpi=150)
+    plt.close(fig)
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = EfSearchBenchmarkSettings(config)
+    open_log(settings.log_path)
+    os.makedirs(settings.output_folder, exist_ok=True)
+
+    conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                           user=os.getenv("POSTGRES_USER"),
+                           password=os.getenv("POSTGRES_PASSWORD"),
+                           dbname=os.getenv("POSTGRES_DATABASE"),
+                           autocommit=True)
+    register_vector(conn)
+    embedder = TransformerEmbedder(model_name=settings.embedding_model, warm_up=True)
+    profiler = open_profiler("EfSearchBenchmark", config.get("profiling"))
+
+    rows = []
+    for evaluator_name in settings.evaluators:
+        if evaluator_name == settings.TREC_COVID:
+            evaluator = TrecCovidEvaluator()
+        else:
+            evaluator = BioASQTrain2024Evaluator(use_sample=settings.bioasq_use_sample)
+        rows.extend(benchmark_evaluator(conn, settings, embedder, evaluator_name, evaluator, profiler))
+    conn.close()
+    profiler.close()
+
+    results = pd.DataFrame(rows)
+    csv_file_name = os.path.join(settings.output_folder, f"EfSearchBenchmark_{settings.table}.csv")
+    results.to_csv(csv_file_name, index=False)
+    logging.info(f"Results written to '{csv_file_name}'")
+    plot_file_name = os.path.join(settings.output_folder, f"EfSearchBenchmark_{settings.table}.png")
+    plot_results(results, plot_file_name)
+    logging.info(f"Plot written to '{plot_file_name}'")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
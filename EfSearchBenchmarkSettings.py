@@ -0,0 +1,37 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+
+@dataclass
+class EfSearchBenchmarkSettings:
+    output_folder: str
+    log_path: str
+    schema: str
+    table: str
+    embedding_model: str
+    evaluators: List[str]
+    bioasq_use_sample: bool
+    ef_search_values: List[int]
+    k_values: List[int]
+
+    TREC_COVID = "trec_covid"
+    BIOASQ = "bioasq"
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        vector_store = config["vector_store"]
+        for key, value in vector_store.items():
+            setattr(self, key, value)
+        benchmark = config["benchmark"]
+        for key, value in benchmark.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        for evaluator in self.evaluators:
+            if evaluator not in [self.TREC_COVID, self.BIOASQ]:
+                raise ValueError(f"benchmark.evaluators must contain only '{self.TREC_COVID}' or '{self.BIOASQ}'")
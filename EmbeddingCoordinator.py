@@ -0,0 +1,110 @@
+import glob
+import logging
+import os
+import sys
+import time
+from typing import List, Dict, Any
+
+import yaml
+
+from EmbeddingWorker import open_work_queue
+from Logging import open_log
+from PubMedSqliteIterator import fetch_pubmed_abstracts_by_pmid_range
+from ShardLeaseQueue import ShardLeaseQueue, PENDING, LEASED, DONE
+from ShardManifest import ShardManifest, shard_file_name, compute_source_checksum
+from SqliteToEmbeddingVectors import create_embedder, get_transform
+from SqliteToEmbeddingVectorsSettings import SqliteToEmbeddingVectorsSettings
+
+
+def create_shards(settings: SqliteToEmbeddingVectorsSettings, queue: ShardLeaseQueue):
+    """
+    Splits the corpus into PMID-range shards, and makes the work queue match them. Shards that are already done are
+    kept, unless their articles, the model, or the prompt changed.
+    """
+    queue.create_table()
+    shards = []
+    for pmid_start, pmid_end, records in fetch_pubmed_abstracts_by_pmid_range(settings.sqlite_path,
+                                                                              settings.pmids_per_shard):
+        shard_id = (pmid_start - 1) // settings.pmids_per_shard
+        shards.append((shard_id, pmid_start, pmid_end, len(records), compute_source_checksum(records)))
+    counts = queue.sync_shards(shards, settings.embedding_model, settings.embed_document_prompt)
+    logging.info(f"Corpus has {len(shards)} shards. Added {counts['added']}, reset {counts['reset']}, and removed "
+                 f"{counts['removed']} shards")
+
+
+def wait_for_workers(settings: SqliteToEmbeddingVectorsSettings, queue: ShardLeaseQueue):
+    """
+    Logs the progress of the workers until all shards are done.
+    """
+    start = time.time()
+    start_done = queue.get_status_counts()[DONE]
+    while True:
+        counts = queue.get_status_counts()
+        total = counts[PENDING] + counts[LEASED] + counts[DONE]
+        shards_per_hour = (counts[DONE] - start_done) / max(time.time() - start, 1e-9) * 3600
+        logging.info(f"{counts[DONE]} of {total} shards done, {counts[LEASED]} leased, {counts[PENDING]} pending "
+                     f"({shards_per_hour:.0f} shards per hour)")
+        if counts[PENDING] == 0 and counts[LEASED] == 0:
+            break
+        time.sleep(settings.poll_seconds)
+
+
+def summarize_workers(queue: ShardLeaseQueue) -> Dict[str, Dict[str, Any]]:
+    """
+    :return: For each worker the number of shards and articles it embedded, and its articles per second.
+    """
+    workers = {}
+    for worker, row_count, seconds, _ in queue.get_completed():
+        summary = workers.setdefault(worker, {"shards": 0, "articles": 0, "seconds": 0.0})
+        summary["shards"] += 1
+        summary["articles"] += row_count
+        summary["seconds"] += seconds
+    for summary in workers.values():
+        summary["articles_per_second"] = summary["articles"] / max(summary["seconds"], 1e-9)
+    return workers
+
+
+def write_manifest(settings: SqliteToEmbeddingVectorsSettings, queue: ShardLeaseQueue):
+    """
+    Writes the manifest of the shards completed by the workers, so LoadVectorsInStore can load them. Shards that are no
+    longer in the queue are deleted.
+    """
+    manifest = ShardManifest(settings.parquet_folder)
+    shards = {}
+    for _, _, _, entry in queue.get_completed():
+        shards[shard_file_name(entry["pmid_start"], entry["pmid_end"])] = entry
+    for shard_name in list(manifest.shards.keys()):
+        if shard_name not in shards:
+            manifest.remove(shard_name)
+    manifest.shards = shards
+    manifest.save()
+    for file_name in glob.glob(os.path.join(settings.parquet_folder, "*.part")):
+        # Left behind by workers that died or lost their lease:
+        os.remove(file_name)
+    logging.info(f"Manifest with {len(shards)} shards written to {manifest.file_name}")
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = SqliteToEmbeddingVectorsSettings(config)
+    open_log(settings.log_path)
+    os.makedirs(settings.parquet_folder, exist_ok=True)
+
+    # Created before any shard is handed out, so all workers use the same transform. The model is only loaded for PCA:
+    get_transform(settings, create_embedder(settings, warm_up=False))
+    queue = open_work_queue(settings)
+    create_shards(settings, queue)
+    wait_for_workers(settings, queue)
+    for worker, summary in summarize_workers(queue).items():
+        logging.info(f"- {worker}: {summary['shards']} shards, {summary['articles']} articles, "
+                     f"{summary['articles_per_second']:.1f} articles per second")
+    write_manifest(settings, queue)
+    queue.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
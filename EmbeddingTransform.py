@@ -0,0 +1,138 @@
+import json
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+TRUNCATE = "truncate"
+PCA = "pca"
+
+FLOAT32 = "float32"
+FLOAT16 = "float16"
+INT8 = "int8"
+
+# Written next to the Parquet files, so the queries can be transformed the same way as the documents:
+TRANSFORM_FILE_NAME = "EmbeddingTransform.npz"
+
+# The name of the Parquet column holding the per-vector scales of int8 embeddings:
+SCALE_COLUMN = "scale"
+
+
+class EmbeddingTransform:
+    """
+    Reduces the dimensions and precision of embedding vectors. The same transform must be applied to the documents and
+    the queries, so it is saved next to the document vectors.
+
+    Truncation keeps the first dimensions, which only works well for models trained with Matryoshka representation
+    learning (for example snowflake-arctic-embed-m-v1.5). For other models, a PCA projection fitted on a sample of
+    document vectors keeps more of the information. In both cases the reduced vectors are normalized again.
+
+    :param method: "truncate", "pca", or None to keep all dimensions.
+    :param dimensions: The number of dimensions after reduction. Ignored if method is None.
+    :param output_dtype: "float32", "float16", or "int8". int8 vectors are stored with one scale per vector.
+    :param mean: The mean of the sample the PCA was fitted on. Only used for PCA.
+    :param components: The principal components, one per row. Only used for PCA.
+    """
+
+    def __init__(self,
+                 method: Optional[str] = None,
+                 dimensions: Optional[int] = None,
+                 output_dtype: str = FLOAT32,
+                 mean: Optional[ndarray] = None,
+                 components: Optional[ndarray] = None):
+        if method not in [None, TRUNCATE, PCA]:
+            raise ValueError(f"method must be '{TRUNCATE}', '{PCA}', or empty, not '{method}'")
+        if method is not None and dimensions is None:
+            raise ValueError("dimensions must be set when reducing dimensions")
+        if output_dtype not in [FLOAT32, FLOAT16, INT8]:
+            raise ValueError(f"output_dtype must be '{FLOAT32}', '{FLOAT16}', or '{INT8}', not '{output_dtype}'")
+        if method == PCA and components is None:
+            raise ValueError("A PCA transform must be fitted first. Use EmbeddingTransform.fit()")
+        self.method = method
+        self.dimensions = dimensions
+        self.output_dtype = output_dtype
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def fit(cls,
+            embeddings: ndarray,
+            method: Optional[str] = None,
+            dimensions: Optional[int] = None,
+            output_dtype: str = FLOAT32) -> "EmbeddingTransform":
+        """
+        Creates a transform. For PCA, the projection is fitted on the provided sample of document embeddings.
+        """
+        if method != PCA:
+            return cls(method, dimensions, output_dtype)
+        if dimensions > min(embeddings.shape):
+            raise ValueError(f"Cannot fit {dimensions} PCA components on a sample of shape {embeddings.shape}")
+        embeddings = embeddings.astype(np.float64)
+        mean = embeddings.mean(axis=0)
+        _, _, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+        return cls(method, dimensions, output_dtype, mean.astype(np.float32), vt[:dimensions].astype(np.float32))
+
+    def reduce(self, embeddings: ndarray) -> ndarray:
+        """
+        Reduces the dimensions of the embeddings, keeping float32 precision. Works on a single vector or a matrix.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.method is None:
+            return embeddings
+        if self.method == TRUNCATE:
+            embeddings = embeddings[..., :self.dimensions]
+        else:
+            embeddings = (embeddings - self.mean) @ self.components.T
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def encode(self, embeddings: ndarray) -> Tuple[ndarray, Optional[ndarray]]:
+        """
+        Reduces the dimensions and precision of document embeddings for storage.
+
+        :return: A tuple of the embeddings in the output dtype, and the per-vector scales (None unless int8).
+        """
+        embeddings = self.reduce(embeddings)
+        if self.output_dtype == FLOAT16:
+            return embeddings.astype(np.float16), None
+        if self.output_dtype == INT8:
+            scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+            values = np.clip(np.rint(embeddings / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+            return values, scales.astype(np.float32)
+        return embeddings, None
+
+    @staticmethod
+    def decode(embeddings: ndarray, scales: Optional[ndarray] = None) -> ndarray:
+        """
+        Converts stored embeddings back to float32.
+        """
+        embeddings = embeddings.astype(np.float32)
+        if scales is not None:
+            embeddings *= scales[:, np.newaxis]
+        return embeddings
+
+    def save(self, file_name: str):
+        settings = {"method": self.method, "dimensions": self.dimensions, "output_dtype": self.output_dtype}
+        arrays = {} if self.mean is None else {"mean": self.mean, "components": self.components}
+        temp_file_name = f"{file_name}.tmp.npz"
+        np.savez(temp_file_name, settings=np.array(json.dumps(settings)), **arrays)
+        os.replace(temp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name: str) -> "EmbeddingTransform":
+        with np.load(file_name) as data:
+            settings = json.loads(str(data["settings"]))
+            return cls(settings["method"],
+                       settings["dimensions"],
+                       settings["output_dtype"],
+                       data["mean"] if "mean" in data else None,
+                       data["components"] if "components" in data else None)
+
+
+def load_transform(parquet_folder: str) -> Optional[EmbeddingTransform]:
+    """
+    :return: The transform saved next to the Parquet files in the folder, or None if the vectors were not transformed.
+    """
+    file_name = os.path.join(parquet_folder, TRANSFORM_FILE_NAME)
+    return EmbeddingTransform.load(file_name) if os.path.isfile(file_name) else None
@@ -0,0 +1,125 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from typing import List
+
+import yaml
+
+from EmbeddingTransform import load_transform, FLOAT32
+from Logging import open_log
+from PubMedSqliteIterator import fetch_pubmed_abstracts_in_pmid_range
+from ShardLeaseQueue import ShardLeaseQueue, open_shard_lease_queue, PENDING, LEASED, DONE
+from ShardManifest import shard_file_name, add_file_details
+from SqliteToEmbeddingVectors import (create_embedder, embed_and_store, create_shard_entry, apply_tuned_settings,
+                                      open_token_cache)
+from SqliteToEmbeddingVectorsSettings import SqliteToEmbeddingVectorsSettings
+
+
+def open_work_queue(settings: SqliteToEmbeddingVectorsSettings) -> ShardLeaseQueue:
+    return open_shard_lease_queue(settings.queue_backend, settings.queue_table, settings.queue_sqlite_path)
+
+
+class _Heartbeat(threading.Thread):
+    """
+    Renews the lease on a shard while it is being embedded. Uses its own connection to the queue.
+    """
+
+    def __init__(self, settings: SqliteToEmbeddingVectorsSettings, shard_id: int, worker: str):
+        super().__init__(daemon=True)
+        self.settings = settings
+        self.shard_id = shard_id
+        self.worker = worker
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        queue = open_work_queue(self.settings)
+        while not self._stopped.wait(self.settings.heartbeat_seconds):
+            if not queue.heartbeat(self.shard_id, self.worker, self.settings.lease_seconds):
+                logging.warning(f"Lost the lease on shard {self.shard_id}")
+                self.lost = True
+                break
+        queue.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_worker(settings: SqliteToEmbeddingVectorsSettings, worker: str) -> int:
+    """
+    Leases shards from the work queue and embeds them until all shards are done. The vectors of a shard are written to
+    a file only this worker uses, which is renamed to the shard file name if the worker still holds the lease.
+
+    :param worker: A name for this worker that is unique over all machines.
+    :return: The number of shards this worker completed.
+    """
+    queue = open_work_queue(settings)
+    # Workers can be started before the coordinator has created the shards:
+    queue.create_table()
+    embedder = create_embedder(settings)
+    token_cache = open_token_cache(settings)
+    transform = None
+
+    completed_count = 0
+    while True:
+        shard = queue.claim(worker, settings.lease_seconds)
+        if shard is None:
+            counts = queue.get_status_counts()
+            if counts[DONE] > 0 and counts[PENDING] == 0 and counts[LEASED] == 0:
+                break
+            # Shards leased by other workers are handed out again if their lease expires:
+            time.sleep(settings.poll_seconds)
+            continue
+        if transform is None and (settings.dimension_reduction is not None or settings.output_dtype != FLOAT32):
+            # The coordinator creates the transform before it creates the shards:
+            transform = load_transform(settings.parquet_folder)
+            if transform is None:
+                raise ValueError(f"No EmbeddingTransform found in {settings.parquet_folder}. Was it created by "
+                                 f"EmbeddingCoordinator?")
+        shard_id, pmid_start, pmid_end, _ = shard
+        logging.info(f"- Processing shard {shard_id}, PMIDs {pmid_start} to {pmid_end}")
+        start = time.perf_counter()
+        file_name = os.path.join(settings.parquet_folder, shard_file_name(pmid_start, pmid_end))
+        worker_file_name = f"{file_name}.{worker}.part"
+        heartbeat = _Heartbeat(settings, shard_id, worker)
+        heartbeat.start()
+        try:
+            records = fetch_pubmed_abstracts_in_pmid_range(settings.sqlite_path, pmid_start, pmid_end)
+            entry = create_shard_entry(settings, pmid_start, pmid_end, records)
+            tokens = token_cache.get(entry) if token_cache is not None else None
+            embed_and_store(embedder, transform, records, worker_file_name, tokens)
+        finally:
+            heartbeat.stop()
+        if heartbeat.lost or not queue.heartbeat(shard_id, worker, settings.lease_seconds):
+            logging.warning(f"  Discarding shard {shard_id}, because another worker has taken it over")
+            os.remove(worker_file_name)
+            continue
+        os.replace(worker_file_name, file_name)
+        entry = add_file_details(file_name, entry)
+        if queue.complete(shard_id, worker, time.perf_counter() - start, entry):
+            completed_count += 1
+    queue.close()
+    logging.info(f"Worker {worker} completed {completed_count} shards")
+    return completed_count
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = SqliteToEmbeddingVectorsSettings(config)
+    open_log(settings.log_path)
+    if settings.autotune_path is not None:
+        apply_tuned_settings(settings)
+
+    run_worker(settings, f"{socket.gethostname()}-{os.getpid()}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
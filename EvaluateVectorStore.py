@@ -1,24 +1,76 @@
+import asyncio
 import json
 import os
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from time import sleep
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 from xml.etree import ElementTree
 
+import numpy as np
 import psycopg
 import requests
-from pgvector.psycopg import register_vector
+from pgvector.psycopg import register_vector, register_vector_async
+from psycopg_pool import AsyncConnectionPool
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+from ConcurrentRequests import HttpStatusError, TokenBucket, ResponseCache, call_with_retries
+from Instrumentation import timer, get_instrumentation
+from LexicalIndex import LexicalIndex, reciprocal_rank_fusion, VECTOR, HYBRID
+from Profiling import open_profiler
 from TransformerEmbedder import TransformerEmbedder
 from RetrievalEvaluation import RetrievalEvaluator, TrecCovidEvaluator, BioASQTrain2024Evaluator
+from SearchTracing import open_search_tracer, EMBED, ANN_SEARCH, LEXICAL_SEARCH
 
 load_dotenv()
 
+PUBMED_ESEARCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
 
-def evaluate_vector_store(evaluator: RetrievalEvaluator, table_name: str, model_name: str) -> Dict[str, float]:
+DEFAULT_PROMPT_TEMPLATE = """
+        Write a PubMed search query that retrieves literature relevant to the research question below. Avoid using overly generic terms or MeSH terms. Use ‘OR’ operators to cover relevant synonyms and variations, and minimize the use of restrictive ‘AND’ clauses. Return only the query, so I can send it directly to PubMed.
+
+        Research question: %s
+
+        Pubmed query:
+        """
+
+DEFAULT_SYSTEM_PROMPT = """
+        You are an expert assistant in scientific writing and literature search, specifically for PubMed queries. Your task is to generate search queries to retrieve relevant literature from PubMed based for a given research question.
+
+        Guidelines:
+
+            1.	Do not use MeSH terms. Instead, focus on natural language keywords and key concepts that are central to the argument.
+            2.	Avoid overly generic terms or phrases. Ensure the terms are specific to the argument, while still using ‘OR’ combinations to account for relevant synonyms and variations.
+            3.	While creating specific queries, minimize the use of restrictive ‘AND’ operators. Focus on creating balanced, concept-driven queries that remain broad enough to capture relevant literature but without becoming too general.
+
+        The goal is to generate focused, specific PubMed search queries that retrieve relevant literature without being too restrictive or too generic.
+        """
+
+
+def evaluate_vector_store(evaluator: RetrievalEvaluator,
+                          table_name: str,
+                          model_name: str,
+                          embedder: Optional[TransformerEmbedder] = None,
+                          search_mode: str = VECTOR,
+                          lexical_index_path: Optional[str] = None) -> Dict[str, float]:
+    """
+    Evaluates a vector store by embedding each query and retrieving the 1,000 most similar articles.
+
+    :param embedder: The embedder used for the queries. If None, an embedder is created for the model.
+    :param search_mode: 'vector', or 'hybrid' to combine the vector search results with the 1,000 best BM25 matches in
+        the lexical index using reciprocal-rank fusion.
+    :param lexical_index_path: The posting lists written by BuildLexicalIndex. Required for the 'hybrid' search mode.
+    """
+    if search_mode not in [VECTOR, HYBRID]:
+        raise ValueError(f"Search mode must be '{VECTOR}' or '{HYBRID}', not '{search_mode}'")
+    lexical_index = None
+    if search_mode == HYBRID:
+        if lexical_index_path is None:
+            raise ValueError(f"The '{HYBRID}' search mode requires the path to the lexical index")
+        lexical_index = LexicalIndex(lexical_index_path)
     conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
                            user=os.getenv("POSTGRES_USER"),
                            password=os.getenv("POSTGRES_PASSWORD"),
@@ -26,25 +78,170 @@ def evaluate_vector_store(evaluator: RetrievalEvaluator, table_name: str, model_
     register_vector(conn)
     conn.execute("SET hnsw.ef_search = 1000")
 
-    embedder = TransformerEmbedder(model_name=model_name)
+    if embedder is None:
+        embedder = TransformerEmbedder(model_name=model_name, warm_up=True)
+    # Profiling can only be switched on using the environmental variables, with each query as a batch:
+    profiler = open_profiler("evaluate_vector_store")
+    # Slow searches are logged and explained. Metrics are only written if RAGPLAYGROUND_SEARCH_METRICS is set:
+    tracer = open_search_tracer(table=table_name)
 
     query_id_to_query = evaluator.get_query_id_to_query()
     query_id_to_pmids = {}
     for query_id, query in tqdm(query_id_to_query.items()):
-        query_embedding = embedder.embed_query(query)
-        sql = f"""
-                SELECT pmid
-                FROM pubmed.{table_name}
-                ORDER BY embedding <=> %s
-                LIMIT 1000;
-                """
-        embedding_str = f"[{','.join(map(str, query_embedding))}]"
-        result = conn.execute(sql, (embedding_str, ))
-        similar_rows = result.fetchall()
-        pmids = [row[0] for row in similar_rows]
-        query_id_to_pmids[query_id] = pmids
+        with profiler.batch():
+            trace = tracer.start()
+            with trace.phase(EMBED):
+                query_embedding = embedder.embed_query(query)
+            sql = f"""
+                    SELECT pmid
+                    FROM pubmed.{table_name}
+                    ORDER BY embedding <=> %s
+                    LIMIT 1000;
+                    """
+            embedding_str = f"[{','.join(map(str, query_embedding))}]"
+            with timer("search", items=1, table=table_name), trace.phase(ANN_SEARCH):
+                result = conn.execute(sql, (embedding_str, ))
+                similar_rows = result.fetchall()
+            pmids = [row[0] for row in similar_rows]
+            if lexical_index is not None:
+                with timer("lexical_search", items=1), trace.phase(LEXICAL_SEARCH):
+                    lexical_pmids = [pmid for pmid, _ in lexical_index.search(query, limit=1000)]
+                pmids = [pmid for pmid, _ in reciprocal_rank_fusion([pmids, lexical_pmids], limit=1000)]
+            tracer.finish(trace, conn, sql, (embedding_str, ))
+            query_id_to_pmids[query_id] = pmids
+    profiler.close()
+    tracer.write_metrics()
+    if lexical_index is not None:
+        lexical_index.close()
     return evaluator.evaluate(query_id_to_pmids)
 
+
+def evaluate_lexical_index(evaluator: RetrievalEvaluator, lexical_index_path: str) -> Dict[str, float]:
+    """
+    Evaluates the lexical index built by BuildLexicalIndex by retrieving the 1,000 best BM25 matches for each query. A
+    local alternative to evaluate_llm_pubmed_queries, which needs no LLM and is not rate limited.
+
+    :param lexical_index_path: The posting lists written by BuildLexicalIndex.
+    :return: The metrics, and the per-query search latencies.
+    """
+    lexical_index = LexicalIndex(lexical_index_path)
+    query_id_to_pmids = {}
+    latencies = []
+    for query_id, query in evaluator.get_query_id_to_query().items():
+        start = time.perf_counter()
+        rows = lexical_index.search(query, limit=1000)
+        latencies.append(time.perf_counter() - start)
+        get_instrumentation().observe("lexical_search", latencies[-1], items=1)
+        query_id_to_pmids[query_id] = [pmid for pmid, _ in rows]
+    lexical_index.close()
+    results = evaluator.evaluate(query_id_to_pmids)
+    results.update(summarize_latencies(latencies))
+    return results
+
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, float]:
+    """
+    Summarizes per-query latencies.
+
+    :param latencies: A list of latencies in seconds.
+    :return: A dictionary with the mean and p50/p95/p99 latencies in milliseconds.
+    """
+    latencies = np.array(latencies) * 1000
+    return {"latency_mean_ms": float(np.mean(latencies)),
+            "latency_p50_ms": float(np.percentile(latencies, 50)),
+            "latency_p95_ms": float(np.percentile(latencies, 95)),
+            "latency_p99_ms": float(np.percentile(latencies, 99))}
+
+
+async def _search_vector_store_concurrently(query_ids: List[int],
+                                            query_embeddings: np.ndarray,
+                                            table_name: str,
+                                            max_concurrency: int,
+                                            ef_search: int) -> Tuple[Dict[int, List[int]], List[float]]:
+    async def configure(conn: psycopg.AsyncConnection):
+        await register_vector_async(conn)
+        await conn.execute(f"SET hnsw.ef_search = {int(ef_search)}")
+
+    sql = f"""
+            SELECT pmid
+            FROM pubmed.{table_name}
+            ORDER BY embedding <=> %s
+            LIMIT 1000;
+            """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with AsyncConnectionPool(kwargs={"host": os.getenv("POSTGRES_SERVER"),
+                                           "user": os.getenv("POSTGRES_USER"),
+                                           "password": os.getenv("POSTGRES_PASSWORD"),
+                                           "dbname": os.getenv("POSTGRES_DATABASE"),
+                                           "autocommit": True},
+                                   min_size=max_concurrency,
+                                   max_size=max_concurrency,
+                                   configure=configure,
+                                   open=False) as pool:
+        await pool.wait()
+
+        async def search(query_embedding: np.ndarray) -> Tuple[List[int], float]:
+            embedding_str = f"[{','.join(map(str, query_embedding.tolist()))}]"
+            async with semaphore:
+                async with pool.connection() as conn:
+                    start = time.perf_counter()
+                    result = await conn.execute(sql, (embedding_str,))
+                    similar_rows = await result.fetchall()
+                    latency = time.perf_counter() - start
+            get_instrumentation().observe("search", latency, items=1, table=table_name)
+            return [row[0] for row in similar_rows], latency
+
+        results = await asyncio.gather(*[search(query_embedding) for query_embedding in query_embeddings])
+    query_id_to_pmids = {query_id: pmids for query_id, (pmids, _) in zip(query_ids, results)}
+    latencies = [latency for _, latency in results]
+    return query_id_to_pmids, latencies
+
+
+def evaluate_vector_store_concurrent(evaluator: RetrievalEvaluator,
+                                     table_name: str,
+                                     model_name: str,
+                                     max_concurrency: int = 8,
+                                     ef_search: int = 1000) -> Dict[str, float]:
+    """
+    Same as evaluate_vector_store, but embeds all queries in a single batched call, and runs the vector searches
+    concurrently on a pool of connections. The returned metrics also include the embedding time, the per-query search
+    latencies, and the search throughput.
+
+    :param max_concurrency: The maximum number of searches running at the same time, which is also the size of the
+    connection pool.
+    """
+    embedder = TransformerEmbedder(model_name=model_name, warm_up=True)
+
+    query_id_to_query = evaluator.get_query_id_to_query()
+    query_ids = list(query_id_to_query.keys())
+    # Profiling can only be switched on using the environmental variables, with embedding and searching as batches:
+    profiler = open_profiler("evaluate_vector_store_concurrent")
+    start = time.perf_counter()
+    with profiler.batch():
+        query_embeddings = embedder.embed_queries([query_id_to_query[query_id] for query_id in query_ids])
+    embedding_seconds = time.perf_counter() - start
+
+    if os.name == "nt":
+        # psycopg's async mode does not support the default ProactorEventLoop on Windows:
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    start = time.perf_counter()
+    with profiler.batch():
+        query_id_to_pmids, latencies = asyncio.run(_search_vector_store_concurrently(query_ids=query_ids,
+                                                                                     query_embeddings=query_embeddings,
+                                                                                     table_name=table_name,
+                                                                                     max_concurrency=max_concurrency,
+                                                                                     ef_search=ef_search))
+    search_seconds = time.perf_counter() - start
+    profiler.close()
+
+    results = evaluator.evaluate(query_id_to_pmids)
+    results["embedding_seconds"] = embedding_seconds
+    results["search_seconds"] = search_seconds
+    results["queries_per_second"] = len(query_ids) / search_seconds
+    results.update(summarize_latencies(latencies))
+    return results
+
+
 def _get_gpt4_response(prompt, system_prompt=None):
     # Construct the messages for the API request
     if system_prompt is None:
@@ -76,21 +273,23 @@ def _get_gpt4_response(prompt, system_prompt=None):
     }
 
     # Send the request to the GPT-4 API
-    response = requests.request("POST", url=api_endpoint, headers=headers, data=json.dumps(payload))
+    response = requests.request("POST", url=api_endpoint, headers=headers, data=json.dumps(payload), timeout=120)
 
     if response.status_code == 200:
         return response.json()['choices'][0]['message']['content']
     else:
-        raise Exception(f"error: {response.status_code}, details: {response.text}")
+        raise HttpStatusError.from_response(response)
 
 def _search_pubmed(query, return_max=10, sort="relevance"):
-    # Prepare the PubMed API URL
-    url_template = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&retmax={}&sort={}&term={}"
-    encoded_query = urllib.parse.quote(query)
-    url = url_template.format(return_max, sort, encoded_query)
+    # Prepare the PubMed API URL. The URL can be overridden, for example to point to a local stub server:
+    url = os.environ.get("PUBMED_ESEARCH_URL", PUBMED_ESEARCH_URL)
+    params = {"db": "pubmed", "retmax": return_max, "sort": sort, "term": query}
+    if os.environ.get("NCBI_API_KEY") is not None:
+        params["api_key"] = os.environ.get("NCBI_API_KEY")
+    url = f"{url}?{urllib.parse.urlencode(params, quote_via=urllib.parse.quote)}"
 
     # Send the GET request to PubMed
-    response = requests.get(url)
+    response = requests.get(url, timeout=120)
 
     if response.status_code == 200:
         # Parse the XML response
@@ -101,6 +300,8 @@ def _search_pubmed(query, return_max=10, sort="relevance"):
             return [int(pmid.text) for pmid in id_list.findall('.//Id')]
         else:
             return []
+    else:
+        raise HttpStatusError.from_response(response)
 
 def evaluate_llm_pubmed_queries(evaluator: RetrievalEvaluator,
                                 cache_folder: str,
@@ -109,26 +310,10 @@ def evaluate_llm_pubmed_queries(evaluator: RetrievalEvaluator,
     os.makedirs(cache_folder, exist_ok=True)
 
     if prompt_template is None:
-        prompt_template = """
-        Write a PubMed search query that retrieves literature relevant to the research question below. Avoid using overly generic terms or MeSH terms. Use ‘OR’ operators to cover relevant synonyms and variations, and minimize the use of restrictive ‘AND’ clauses. Return only the query, so I can send it directly to PubMed.
-
-        Research question: %s
-
-        Pubmed query:
-        """
+        prompt_template = DEFAULT_PROMPT_TEMPLATE
 
     if system_prompt is None:
-        system_prompt = """
-        You are an expert assistant in scientific writing and literature search, specifically for PubMed queries. Your task is to generate search queries to retrieve relevant literature from PubMed based for a given research question.
-
-        Guidelines:
-
-            1.	Do not use MeSH terms. Instead, focus on natural language keywords and key concepts that are central to the argument.
-            2.	Avoid overly generic terms or phrases. Ensure the terms are specific to the argument, while still using ‘OR’ combinations to account for relevant synonyms and variations.
-            3.	While creating specific queries, minimize the use of restrictive ‘AND’ operators. Focus on creating balanced, concept-driven queries that remain broad enough to capture relevant literature but without becoming too general.
-
-        The goal is to generate focused, specific PubMed search queries that retrieve relevant literature without being too restrictive or too generic.
-        """
+        system_prompt = DEFAULT_SYSTEM_PROMPT
 
     last_query_time = datetime.now()
     query_id_to_query = evaluator.get_query_id_to_query()
@@ -159,6 +344,67 @@ def evaluate_llm_pubmed_queries(evaluator: RetrievalEvaluator,
         query_id_to_pmids[query_id] = pmids
     return evaluator.evaluate(query_id_to_pmids)
 
+
+def evaluate_llm_pubmed_queries_concurrent(evaluator: RetrievalEvaluator,
+                                           cache_path: str,
+                                           prompt_template: Optional[str] = None,
+                                           system_prompt: Optional[str] = None,
+                                           llm_requests_per_second: float = 2.0,
+                                           pubmed_requests_per_second: float = 3.0,
+                                           max_workers: int = 8,
+                                           max_retries: int = 5) -> Dict[str, float]:
+    """
+    Same as evaluate_llm_pubmed_queries, but processes topics concurrently. Each endpoint has its own token-bucket rate
+    limiter, so total time is determined by the remote rate limits. Failed requests are retried with exponential
+    backoff. LLM responses and PubMed results are cached in a single SQLite file, keyed by a hash of the request.
+
+    The endpoints are taken from the GENAI_GPT4_ENDPOINT and PUBMED_ESEARCH_URL environmental variables, so the runner
+    can be tested against a local stub server.
+
+    :param cache_path: Path to the SQLite cache file.
+    :param llm_requests_per_second: The maximum rate of requests to the LLM.
+    :param pubmed_requests_per_second: The maximum rate of requests to PubMed. NCBI allows 3 per second, or 10 per
+    second when an NCBI_API_KEY is set.
+    :param max_workers: The number of topics processed at the same time.
+    :param max_retries: The maximum number of retries per request.
+    """
+    if prompt_template is None:
+        prompt_template = DEFAULT_PROMPT_TEMPLATE
+
+    if system_prompt is None:
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+
+    cache = ResponseCache(cache_path)
+    llm_limiter = TokenBucket(rate_per_second=llm_requests_per_second)
+    pubmed_limiter = TokenBucket(rate_per_second=pubmed_requests_per_second)
+
+    def process_topic(query: str) -> List[int]:
+        prompt = prompt_template % query
+        pubmed_query = cache.get_or_compute(
+            namespace="llm",
+            request={"prompt": prompt, "system_prompt": system_prompt},
+            compute=lambda: call_with_retries(lambda: _get_gpt4_response(prompt, system_prompt),
+                                              limiter=llm_limiter,
+                                              max_retries=max_retries))
+        return cache.get_or_compute(
+            namespace="pubmed",
+            request={"query": pubmed_query, "return_max": 1000},
+            compute=lambda: call_with_retries(lambda: _search_pubmed(pubmed_query, return_max=1000),
+                                              limiter=pubmed_limiter,
+                                              max_retries=max_retries))
+
+    query_id_to_query = evaluator.get_query_id_to_query()
+    query_id_to_pmids = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_topic, query): query_id for query_id, query in query_id_to_query.items()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            query_id_to_pmids[futures[future]] = future.result()
+    cache.close()
+    # Restore the topic order, so results do not depend on the order in which requests completed:
+    query_id_to_pmids = {query_id: query_id_to_pmids[query_id] for query_id in query_id_to_query}
+    return evaluator.evaluate(query_id_to_pmids)
+
+
 if __name__ == "__main__":
 
     """
@@ -195,6 +441,11 @@ if __name__ == "__main__":
     #  'NDCG@30': 0.6389619597101399, 'NDCG@100': 0.4786779034498604, 'NDCG@200': 0.39673378054478114,
     #  'NDCG@500': 0.3625217339643562, 'NDCG@1000': 0.3617809747524116}
 
+    # results = evaluate_vector_store_concurrent(TrecCovidEvaluator(),
+    #                                            table_name="vectors_snowflake_arctic_m",
+    #                                            model_name="Snowflake/snowflake-arctic-embed-m-v1.5",
+    #                                            max_concurrency=8)
+
     # results = evaluate_llm_pubmed_queries(TrecCovidEvaluator(), "e:/temp/retrievalevalcache")
     # {'num_ret': 3045, 'num_rel': 11482, 'num_rel_ret': 939, 'num_q': 47, 'map': 0.0408806802726849, 'gm_map': nan,
     #  'bpref': 0.08420444884099436, 'Rprec': 0.08530745214318296, 'recip_rank': 0.4980882663874562,
@@ -233,7 +484,16 @@ if __name__ == "__main__":
     #  'NDCG@30': 0.3086030265566418, 'NDCG@100': 0.34954064096926074, 'NDCG@200': 0.37217871567165545,
     #  'NDCG@500': 0.3943900085240318, 'NDCG@1000': 0.40202841078889046}
 
+    # Evaluating on all BioASQ questions is only feasible when running the searches concurrently:
+    # results = evaluate_vector_store_concurrent(BioASQTrain2024Evaluator(use_sample=False),
+    #                                            table_name="vectors_snowflake_arctic_m",
+    #                                            model_name="Snowflake/snowflake-arctic-embed-m-v1.5",
+    #                                            max_concurrency=8)
+
     # results = evaluate_llm_pubmed_queries(BioASQTrain2024Evaluator(use_sample=True), "e:/temp/retrievalevalcache_bioasq")
+
+    # results = evaluate_llm_pubmed_queries_concurrent(BioASQTrain2024Evaluator(use_sample=True),
+    #                                                  "e:/temp/retrievalevalcache_bioasq.sqlite")
     # {'num_ret': 30718, 'num_rel': 864, 'num_rel_ret': 304, 'num_q': 88, 'map': 0.07484124848343826, 'gm_map': nan,
     #  'bpref': 0.01964275139502872, 'Rprec': 0.07437739808702727, 'recip_rank': 0.11660581082663732,
     #  'P@5': 0.05454545454545456, 'P@10': 0.04318181818181818, 'P@15': 0.031060606060606063,
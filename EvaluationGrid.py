@@ -0,0 +1,292 @@
+import glob
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict
+from typing import List, Dict, Optional, Any, Tuple
+
+import pandas as pd
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from psycopg import sql
+
+from EmbeddingTransform import load_transform
+from EvaluateVectorStore import summarize_latencies
+from EvaluationGridSettings import EvaluationGridSettings
+from Instrumentation import get_instrumentation
+from LexicalIndex import LexicalIndex, reciprocal_rank_fusion, get_index_id, VECTOR, LEXICAL, HYBRID
+from Logging import open_log
+from Profiling import open_profiler
+from RetrievalEvaluation import create_evaluator
+from RunStore import RunStore, RunConfig
+from TransformerEmbedder import TransformerEmbedder
+
+load_dotenv()
+
+# Models are expensive to load, so each worker process keeps the ones it has loaded:
+_embedders: Dict[Tuple[str, Optional[str]], TransformerEmbedder] = {}
+
+
+def _get_embedder(model_name: str, parquet_folder: Optional[str] = None) -> TransformerEmbedder:
+    """
+    :param parquet_folder: The folder the document vectors were written to. If it holds an EmbeddingTransform, the
+    queries are transformed the same way.
+    """
+    key = (model_name, parquet_folder)
+    if key not in _embedders:
+        transform = None if parquet_folder is None else load_transform(parquet_folder)
+        _embedders[key] = TransformerEmbedder(model_name=model_name, transform=transform)
+    return _embedders[key]
+
+
+def _get_storage_sizes(conn: psycopg.Connection, table_name: str, parquet_folder: Optional[str]) -> Dict[str, float]:
+    """
+    :return: The size of the vector table and its indexes in Postgres, and the size of the Parquet files, in MB.
+    """
+    table = f"pubmed.{table_name}"
+    table_size, index_size = conn.execute("SELECT pg_table_size(%s), pg_indexes_size(%s)", (table, table)).fetchone()
+    sizes = {"table_size_mb": table_size / 2 ** 20, "index_size_mb": index_size / 2 ** 20}
+    if parquet_folder is not None:
+        sizes["parquet_size_mb"] = sum(os.path.getsize(file_name) for file_name in
+                                       glob.glob(os.path.join(parquet_folder, "*.parquet"))) / 2 ** 20
+    return sizes
+
+
+def _search_lexical_index(query_ids: List[int],
+                          query_id_to_query: Dict[int, str],
+                          lexical_index_path: str,
+                          limit: int) -> Tuple[Dict[int, List[int]], Dict[int, List[float]], List[float]]:
+    """
+    :return: A tuple of 3: the ranked PMIDs and the BM25 scores per query, and the latency of each search.
+    """
+    lexical_index = LexicalIndex(lexical_index_path)
+    query_id_to_pmids = {}
+    query_id_to_scores = {}
+    latencies = []
+    for query_id in query_ids:
+        start = time.perf_counter()
+        rows = lexical_index.search(query_id_to_query[query_id], limit=limit)
+        latencies.append(time.perf_counter() - start)
+        get_instrumentation().observe("lexical_search", latencies[-1], items=1)
+        query_id_to_pmids[query_id] = [row[0] for row in rows]
+        query_id_to_scores[query_id] = [row[1] for row in rows]
+    lexical_index.close()
+    return query_id_to_pmids, query_id_to_scores, latencies
+
+
+def _run_lexical_config(config: RunConfig,
+                        run_store_folder: str,
+                        lexical_index_path: str,
+                        profiling: Optional[Dict[str, Any]] = None) -> List[RunConfig]:
+    """
+    Executes a run on the lexical index only. Runs in a worker process.
+    """
+    store = RunStore(run_store_folder)
+    profiler = open_profiler("EvaluationGrid", profiling)
+    query_id_to_query = create_evaluator(config.evaluator).get_query_id_to_query()
+    logging.info(f"Running {config} (hash {config.config_hash()})")
+    with profiler.batch():
+        start = time.perf_counter()
+        query_id_to_pmids, query_id_to_scores, latencies = _search_lexical_index(list(query_id_to_query.keys()),
+                                                                                 query_id_to_query,
+                                                                                 lexical_index_path,
+                                                                                 config.limit)
+        timing = {"search_seconds": time.perf_counter() - start}
+        timing.update(summarize_latencies(latencies))
+        store.save(config, query_id_to_pmids, query_id_to_scores, timing)
+    profiler.close()
+    return [config]
+
+
+def _run_configs(configs: List[RunConfig],
+                 run_store_folder: str,
+                 profiling: Optional[Dict[str, Any]] = None,
+                 parquet_folder: Optional[str] = None,
+                 lexical_index_path: Optional[str] = None) -> List[RunConfig]:
+    """
+    Executes runs that share the same evaluator, model, and table, so the queries only need to be embedded once. Runs
+    in a worker process. Each run is a batch for the profiler. The storage sizes and the number of dimensions are
+    stored with the timing of each run.
+
+    :param lexical_index_path: The posting lists written by BuildLexicalIndex. Required for hybrid runs, which fuse the
+        vector search results with the lexical search results. The lexical index is only searched once for all hybrid
+        runs.
+    """
+    if configs[0].search_mode == LEXICAL:
+        return _run_lexical_config(configs[0], run_store_folder, lexical_index_path, profiling)
+    evaluator_name = configs[0].evaluator
+    model_name = configs[0].model_name
+    table_name = configs[0].table_name
+    store = RunStore(run_store_folder)
+    profiler = open_profiler("EvaluationGrid", profiling)
+
+    query_id_to_query = create_evaluator(evaluator_name).get_query_id_to_query()
+    query_ids = list(query_id_to_query.keys())
+    embedder = _get_embedder(model_name, parquet_folder)
+    start = time.perf_counter()
+    query_embeddings = embedder.embed_queries([query_id_to_query[query_id] for query_id in query_ids])
+    embedding_seconds = time.perf_counter() - start
+    lexical_results = None
+    if any(config.search_mode == HYBRID for config in configs):
+        lexical_results = _search_lexical_index(query_ids,
+                                                query_id_to_query,
+                                                lexical_index_path,
+                                                max(config.limit for config in configs))
+
+    conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                           user=os.getenv("POSTGRES_USER"),
+                           password=os.getenv("POSTGRES_PASSWORD"),
+                           dbname=os.getenv("POSTGRES_DATABASE"),
+                           autocommit=True)
+    register_vector(conn)
+    storage_sizes = _get_storage_sizes(conn, table_name, parquet_folder)
+    for config in configs:
+        logging.info(f"Running {config} (hash {config.config_hash()})")
+        with profiler.batch():
+            conn.execute(sql.SQL("SET hnsw.ef_search = {ef_search}").format(ef_search=sql.Literal(config.ef_search)))
+            statement = sql.SQL("""
+                SELECT pmid, 1 - (embedding <=> %s) AS similarity
+                FROM pubmed.{table}
+                ORDER BY embedding <=> %s
+                LIMIT {limit}
+                """).format(table=sql.Identifier(table_name), limit=sql.Literal(config.limit))
+            query_id_to_pmids = {}
+            query_id_to_scores = {}
+            latencies = []
+            start = time.perf_counter()
+            for query_id, query_embedding in zip(query_ids, query_embeddings):
+                embedding_str = f"[{','.join(map(str, query_embedding.tolist()))}]"
+                query_start = time.perf_counter()
+                rows = conn.execute(statement, (embedding_str, embedding_str)).fetchall()
+                latencies.append(time.perf_counter() - query_start)
+                get_instrumentation().observe("search", latencies[-1], items=1, table=table_name)
+                query_id_to_pmids[query_id] = [row[0] for row in rows]
+                query_id_to_scores[query_id] = [row[1] for row in rows]
+            search_seconds = time.perf_counter() - start
+            if config.search_mode == HYBRID:
+                lexical_query_id_to_pmids, _, lexical_latencies = lexical_results
+                # The latency of a hybrid search is that of both searches, plus the fusion:
+                for i, query_id in enumerate(query_ids):
+                    fusion_start = time.perf_counter()
+                    rows = reciprocal_rank_fusion([query_id_to_pmids[query_id], lexical_query_id_to_pmids[query_id]],
+                                                  limit=config.limit)
+                    latencies[i] += lexical_latencies[i] + time.perf_counter() - fusion_start
+                    query_id_to_pmids[query_id] = [row[0] for row in rows]
+                    query_id_to_scores[query_id] = [row[1] for row in rows]
+                search_seconds += sum(lexical_latencies)
+            timing = {"embedding_seconds": embedding_seconds,
+                      "search_seconds": search_seconds,
+                      "dimensions": query_embeddings.shape[1]}
+            timing.update(summarize_latencies(latencies))
+            timing.update(storage_sizes)
+            store.save(config, query_id_to_pmids, query_id_to_scores, timing)
+    conn.close()
+    profiler.close()
+    return configs
+
+
+def run_grid(settings: EvaluationGridSettings) -> List[RunConfig]:
+    """
+    Executes all runs in the grid that are not yet in the run store, spread over worker processes.
+
+    :return: The configurations of all runs in the grid.
+    """
+    store = RunStore(settings.run_store_folder)
+    all_configs = []
+    tasks = []
+    vector_search_modes = [search_mode for search_mode in settings.search_modes if search_mode != LEXICAL]
+    # Lexical and hybrid runs are computed again when the lexical index is rebuilt:
+    lexical_index = "" if settings.search_modes == [VECTOR] else get_index_id(settings.lexical_index_path)
+    for evaluator_name in settings.evaluators:
+        if LEXICAL in settings.search_modes:
+            # Lexical runs do not depend on the vector store or ef_search:
+            config = RunConfig(evaluator=evaluator_name,
+                               model_name="",
+                               table_name="",
+                               ef_search=0,
+                               limit=settings.limit,
+                               search_mode=LEXICAL,
+                               lexical_index=lexical_index)
+            all_configs.append(config)
+            if not store.contains(config):
+                tasks.append(([config], None))
+        for vector_store in settings.vector_stores:
+            configs = [RunConfig(evaluator=evaluator_name,
+                                 model_name=vector_store["model_name"],
+                                 table_name=vector_store["table_name"],
+                                 ef_search=ef_search,
+                                 limit=settings.limit,
+                                 search_mode=search_mode,
+                                 lexical_index="" if search_mode == VECTOR else lexical_index)
+                       for ef_search in settings.ef_search_values for search_mode in vector_search_modes]
+            all_configs.extend(configs)
+            configs = [config for config in configs if not store.contains(config)]
+            if len(configs) > 0:
+                tasks.append((configs, vector_store.get("parquet_folder")))
+    new_count = sum(len(configs) for configs, _ in tasks)
+    logging.info(f"Grid has {len(all_configs)} runs, of which {new_count} are not yet in the run store")
+
+    if len(tasks) > 0:
+        # Using spawn because forking a process that has loaded PyTorch is not safe:
+        with ProcessPoolExecutor(max_workers=settings.max_workers,
+                                 mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=open_log,
+                                 initargs=(settings.log_path,)) as executor:
+            futures = [executor.submit(_run_configs,
+                                       configs,
+                                       settings.run_store_folder,
+                                       settings.profiling,
+                                       parquet_folder,
+                                       settings.lexical_index_path) for configs, parquet_folder in tasks]
+            for future in as_completed(futures):
+                for config in future.result():
+                    logging.info(f"Finished {config}")
+    return all_configs
+
+
+def compute_grid_metrics(settings: EvaluationGridSettings, configs: List[RunConfig]) -> pd.DataFrame:
+    """
+    Computes the evaluation metrics from the stored runs, without querying the vector store again.
+
+    :return: A data frame with one row per run, with the configuration, the timing, and the metrics.
+    """
+    store = RunStore(settings.run_store_folder)
+    evaluators = {}
+    rows = []
+    for config in configs:
+        stored_run = store.load(config)
+        if stored_run is None:
+            logging.warning(f"Run {config} is missing from the run store")
+            continue
+        if config.evaluator not in evaluators:
+            evaluators[config.evaluator] = create_evaluator(config.evaluator)
+        row = {"config_hash": config.config_hash()}
+        row.update(asdict(config))
+        row.update(stored_run.timing)
+        row.update(evaluators[config.evaluator].evaluate_encoded(stored_run.run))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = EvaluationGridSettings(config)
+    open_log(settings.log_path)
+
+    configs = run_grid(settings)
+    results = compute_grid_metrics(settings, configs)
+    results.to_csv(settings.results_path, index=False)
+    logging.info(f"Metrics for {len(results)} runs written to '{settings.results_path}'")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
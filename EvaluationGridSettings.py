@@ -0,0 +1,43 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+from LexicalIndex import SEARCH_MODES, VECTOR
+
+
+@dataclass
+class EvaluationGridSettings:
+    run_store_folder: str
+    results_path: str
+    log_path: str
+    evaluators: List[str]
+    vector_stores: List[Dict[str, str]]
+    ef_search_values: List[int]
+    limit: int
+    max_workers: int
+    profiling: Optional[Dict[str, Any]]
+    search_modes: Optional[List[str]] = None
+    lexical_index_path: Optional[str] = None
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        grid = config["grid"]
+        for key, value in grid.items():
+            setattr(self, key, value)
+        processing = config["processing"]
+        for key, value in processing.items():
+            setattr(self, key, value)
+        self.profiling = config.get("profiling")
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.search_modes is None:
+            self.search_modes = [VECTOR]
+        for search_mode in self.search_modes:
+            if search_mode not in SEARCH_MODES:
+                raise ValueError(f"grid.search_modes must be in {SEARCH_MODES}, not '{search_mode}'")
+        if self.search_modes != [VECTOR] and self.lexical_index_path is None:
+            raise ValueError("system.lexical_index_path is required for the lexical and hybrid search modes")
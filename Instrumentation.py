@@ -0,0 +1,256 @@
+import atexit
+import bisect
+import datetime
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from typing import Dict, Optional, Tuple, List
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+METRIC_PREFIX = "ragplayground"
+
+# Upper bounds (in seconds) of the histogram buckets:
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.items = 0
+
+    def observe(self, seconds: float, items: int):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.items += items
+
+
+class Timer:
+    """
+    Returned by Instrumentation.timer(). The number of items processed can be set inside the with block, when it is
+    not known beforehand.
+    """
+
+    def __init__(self, instrumentation: "Instrumentation", name: str, items: int, labels: Dict[str, str]):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.items = items
+        self.labels = labels
+        self.seconds = 0.0
+
+    def __enter__(self) -> "Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self._start
+        if exc_type is None:
+            self.instrumentation.observe(self.name, self.seconds, self.items, **self.labels)
+
+
+class Instrumentation:
+    """
+    Collects timings and counters of the processing steps (parse, insert, fetch, tokenize, embed, parquet_write, copy,
+    search). Every observation is appended as a JSON object to an events file (one object per line), and a snapshot of
+    all metrics is written in the Prometheus text format, with a histogram of durations and a throughput (items per
+    second) per step.
+
+    Without output paths nothing is written, and the overhead is a few dictionary lookups per observation. Safe to use
+    from multiple threads. Worker processes only write events, because the snapshot belongs to the main process.
+    """
+
+    def __init__(self,
+                 events_path: Optional[str] = None,
+                 prometheus_path: Optional[str] = None,
+                 snapshot_interval: float = 30.0):
+        self.events_path = events_path
+        self.prometheus_path = prometheus_path
+        self.snapshot_interval = snapshot_interval
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._lock = threading.Lock()
+        self._events_file = open(events_path, "a", encoding="utf-8") if events_path is not None else None
+        self._last_snapshot = time.monotonic()
+
+    def timer(self, name: str, items: int = 0, **labels: str) -> Timer:
+        """
+        Times a processing step. Use as a context manager:
+
+            with instrumentation.timer("embed", items=len(texts)):
+                ...
+
+        :param name: The name of the step.
+        :param items: The number of items (for example records) processed, used to compute throughput.
+        :param labels: Optional labels, for example the table name.
+        """
+        return Timer(self, name, items, labels)
+
+    def observe(self, name: str, seconds: float, items: int = 0, **labels: str):
+        """
+        Records the duration of a processing step that was timed elsewhere.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = _Histogram()
+            histograms[key].observe(seconds, items)
+            self._write_event({"event": name, "seconds": seconds, "items": items, "labels": labels})
+        self._maybe_write_snapshot()
+
+    def count(self, name: str, value: float = 1, **labels: str):
+        """
+        Increments a counter, for example the number of failed requests.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+            self._write_event({"event": name, "value": value, "labels": labels})
+
+    def _write_event(self, event: Dict):
+        if self._events_file is None:
+            return
+        event = {"time": datetime.datetime.now().isoformat(timespec="milliseconds"), "pid": os.getpid(), **event}
+        self._events_file.write(json.dumps(event) + "\n")
+        self._events_file.flush()
+
+    def _maybe_write_snapshot(self):
+        if self.prometheus_path is None or time.monotonic() - self._last_snapshot < self.snapshot_interval:
+            return
+        self.write_snapshot()
+
+    def write_snapshot(self):
+        """
+        Writes all metrics to the Prometheus file. The file is replaced atomically, so a scraper never sees a partial
+        file.
+        """
+        if self.prometheus_path is None:
+            return
+        with self._lock:
+            lines = self._format_prometheus()
+            self._last_snapshot = time.monotonic()
+        temp_file_name = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        with open(temp_file_name, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_file_name, self.prometheus_path)
+
+    def _format_prometheus(self) -> List[str]:
+        lines = []
+        for name, histograms in sorted(self._histograms.items()):
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric}_seconds histogram")
+            for key, histogram in histograms.items():
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + [float("inf")], histogram.bucket_counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{metric}_seconds_bucket{_format_labels(key, le=le)} {cumulative}")
+                lines.append(f"{metric}_seconds_sum{_format_labels(key)} {histogram.sum}")
+                lines.append(f"{metric}_seconds_count{_format_labels(key)} {histogram.count}")
+            lines.append(f"# TYPE {metric}_items_total counter")
+            for key, histogram in histograms.items():
+                lines.append(f"{metric}_items_total{_format_labels(key)} {histogram.items}")
+            lines.append(f"# TYPE {metric}_items_per_second gauge")
+            for key, histogram in histograms.items():
+                rate = histogram.items / histogram.sum if histogram.sum > 0 else 0.0
+                lines.append(f"{metric}_items_per_second{_format_labels(key)} {rate}")
+        for name, counters in sorted(self._counters.items()):
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in counters.items():
+                lines.append(f"{metric}{_format_labels(key)} {value}")
+        return lines
+
+    def close(self):
+        if multiprocessing.parent_process() is None:
+            self.write_snapshot()
+        if self._events_file is not None:
+            self._events_file.close()
+            self._events_file = None
+
+
+def _format_labels(key: LabelKey, **extra: str) -> str:
+    labels = list(key) + list(extra.items())
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+_instrumentation = Instrumentation()
+
+
+def open_instrumentation(log_path: str):
+    """
+    Starts writing metrics next to the log file: the events to '<log file>.events.jsonl' and the Prometheus snapshot to
+    '<log file>.prom'. Worker processes only write events.
+    """
+    global _instrumentation
+    _instrumentation.close()
+    base_path = os.path.splitext(log_path)[0]
+    prometheus_path = f"{base_path}.prom" if multiprocessing.parent_process() is None else None
+    _instrumentation = Instrumentation(events_path=f"{base_path}.events.jsonl", prometheus_path=prometheus_path)
+
+
+def get_instrumentation() -> Instrumentation:
+    return _instrumentation
+
+
+def timer(name: str, items: int = 0, **labels: str) -> Timer:
+    """
+    Times a processing step using the shared Instrumentation. See Instrumentation.timer.
+    """
+    return _instrumentation.timer(name, items, **labels)
+
+
+def count(name: str, value: float = 1, **labels: str):
+    """
+    Increments a counter of the shared Instrumentation. See Instrumentation.count.
+    """
+    _instrumentation.count(name, value, **labels)
+
+
+def peak_memory_mb() -> Optional[float]:
+    """
+    :return: The peak resident set size of the current process in MB, or None if it cannot be determined.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes on Linux:
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def current_memory_mb() -> Optional[float]:
+    """
+    :return: The current resident set size of the current process in MB, or None if it cannot be determined. Uses
+    psutil if it is installed, and /proc otherwise (Linux only).
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2 ** 20
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+@atexit.register
+def _close_instrumentation():
+    _instrumentation.close()
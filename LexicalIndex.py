@@ -0,0 +1,257 @@
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+import zlib
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Tuple, Optional, Dict, Sequence, Set
+
+import numpy as np
+
+FTS_TABLE = "pubmed_fts"
+VOCAB_TABLE = "pubmed_fts_vocab"
+POSTINGS_TABLE = "lexical_postings"
+
+# The columns of pubmed_articles that are indexed, in the order of the column weights:
+LEXICAL_COLUMNS = ["title", "abstract", "mesh_terms", "keywords", "chemicals"]
+
+# The search modes of the evaluators and the Shiny app:
+VECTOR = "vector"
+LEXICAL = "lexical"
+HYBRID = "hybrid"
+SEARCH_MODES = [VECTOR, LEXICAL, HYBRID]
+
+# The constant in reciprocal-rank fusion. 60 is the value from the original paper (Cormack et al., 2009):
+RRF_K = 60
+
+# Tokens as produced by the unicode61 tokenizer, after lower-casing and removing diacritics:
+_TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into the same terms as the FTS5 unicode61 tokenizer with remove_diacritics 2, so the terms can be
+    looked up in the index.
+    """
+    # Canonical rather than compatibility decomposition, because unicode61 does not fold characters such as the
+    # subscript in "CO₂" or the ligature in "ﬁbrosis":
+    text = unicodedata.normalize("NFD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return _TOKEN_PATTERN.findall(text)
+
+
+def create_full_text_index(con: sqlite3.Connection, column_weights: Optional[Dict[str, float]] = None):
+    """
+    Creates an FTS5 full-text index on the pubmed_articles table, or rebuilds it if it already exists. The index is an
+    external content table, so the texts are not stored twice.
+
+    :param column_weights: The BM25 weight of each column in LEXICAL_COLUMNS. Columns that are not listed get weight 1.
+    """
+    column_weights = {} if column_weights is None else column_weights
+    unknown_columns = set(column_weights) - set(LEXICAL_COLUMNS)
+    if len(unknown_columns) > 0:
+        raise ValueError(f"Unknown columns in column weights: {', '.join(sorted(unknown_columns))}")
+    con.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            {", ".join(LEXICAL_COLUMNS)},
+            content='pubmed_articles',
+            content_rowid='pmid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    con.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {VOCAB_TABLE} USING fts5vocab({FTS_TABLE}, 'row')")
+    logging.info("Building the full-text index")
+    con.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+    # Stored in the index, so 'ORDER BY rank' uses these weights:
+    weights = ", ".join(str(float(column_weights.get(column, 1.0))) for column in LEXICAL_COLUMNS)
+    con.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('rank', 'bm25({weights})')")
+    logging.info("Optimizing the full-text index")
+    con.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    con.commit()
+
+
+def encode_postings(pmids: np.ndarray, scores: np.ndarray) -> Tuple[bytes, bytes]:
+    """
+    Compresses a posting list. The PMIDs are sorted and delta-encoded before compression, because small gaps compress
+    well.
+
+    :return: The compressed PMIDs and the scores in the same order.
+    """
+    order = np.argsort(pmids)
+    pmids = pmids[order]
+    deltas = np.diff(pmids, prepend=0).astype(np.uint32)
+    return zlib.compress(deltas.tobytes(), 1), scores[order].astype(np.float32).tobytes()
+
+
+def decode_postings(pmid_blob: bytes, score_blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    pmids = np.cumsum(np.frombuffer(zlib.decompress(pmid_blob), dtype=np.uint32), dtype=np.int64)
+    return pmids, np.frombuffer(score_blob, dtype=np.float32)
+
+
+_worker_con: Optional[sqlite3.Connection] = None
+
+
+def _open_worker(sqlite_path: str):
+    global _worker_con
+    _worker_con = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+
+
+def _compute_postings(terms: List[Tuple[str, int]], postings_per_term: int) -> List[Tuple[str, int, bytes, bytes]]:
+    """
+    Computes the truncated posting lists of a batch of terms. Runs in a worker process.
+
+    :param terms: Tuples of a term and the number of articles it occurs in.
+    """
+    rows = []
+    for term, document_count in terms:
+        # The BM25 score of a query is the sum of the scores of its terms, so each term can be scored on its own:
+        postings = _worker_con.execute(f"""
+            SELECT rowid, -rank
+            FROM {FTS_TABLE}
+            WHERE {FTS_TABLE} MATCH ?
+            ORDER BY rank
+            LIMIT ?
+            """, (f'"{term}"', postings_per_term)).fetchall()
+        if len(postings) == 0:
+            continue
+        postings = np.array(postings, dtype=np.float64)
+        pmid_blob, score_blob = encode_postings(postings[:, 0].astype(np.int64), postings[:, 1])
+        rows.append((term, document_count, pmid_blob, score_blob))
+    return rows
+
+
+def create_postings(sqlite_path: str,
+                    index_path: str,
+                    postings_per_term: int = 10000,
+                    num_workers: Optional[int] = None,
+                    terms_per_task: int = 10000):
+    """
+    Writes a truncated, impact-ordered posting list for every term in the full-text index: the postings_per_term
+    articles with the highest BM25 score for the term (also known as champion lists). A search only reads the lists of
+    its terms, so its cost is bounded by the number of terms times postings_per_term, however common the terms are. The
+    score of an article is exact if it is in the list of every query term it contains, and a lower bound otherwise.
+
+    :param sqlite_path: The path to the database with the full-text index.
+    :param index_path: The path of the SQLite database the posting lists are written to. It is written under a
+        temporary name and then renamed, so searches never see a partial index.
+    :param num_workers: The number of worker processes. If None, one per CPU is used.
+    """
+    temp_index_path = f"{index_path}.tmp"
+    if os.path.exists(temp_index_path):
+        os.remove(temp_index_path)
+    index_con = sqlite3.connect(temp_index_path)
+    index_con.execute(f"""
+        CREATE TABLE {POSTINGS_TABLE} (
+            term TEXT PRIMARY KEY,
+            document_count INTEGER,
+            pmids BLOB,
+            scores BLOB
+        ) WITHOUT ROWID
+    """)
+    sqlite_con = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+    vocabulary = sqlite_con.execute(f"SELECT term, doc FROM {VOCAB_TABLE}")
+    num_workers = multiprocessing.cpu_count() if num_workers is None else num_workers
+    term_count = 0
+    start = time.perf_counter()
+
+    def write(future: Future):
+        nonlocal term_count
+        rows = future.result()
+        index_con.executemany(f"INSERT INTO {POSTINGS_TABLE} (term, document_count, pmids, scores) "
+                              f"VALUES (?, ?, ?, ?)", rows)
+        index_con.commit()
+        term_count += len(rows)
+        logging.info(f"- Wrote the posting lists of {term_count} terms ({time.perf_counter() - start:.0f} seconds)")
+
+    # Using spawn to be consistent with the other scripts. Only a few batches are in flight, so the vocabulary does not
+    # have to fit in memory:
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_open_worker,
+                             initargs=(sqlite_path,)) as executor:
+        pending: Set[Future] = set()
+        while True:
+            terms = vocabulary.fetchmany(terms_per_task)
+            if len(terms) == 0:
+                break
+            pending.add(executor.submit(_compute_postings, terms, postings_per_term))
+            while len(pending) >= 2 * num_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write(future)
+        for future in pending:
+            write(future)
+    sqlite_con.close()
+    index_con.close()
+    os.replace(temp_index_path, index_path)
+
+
+def get_index_id(index_path: str) -> str:
+    """
+    :return: An identifier of a build of the posting lists: the file name, size, and modification time. The index is
+    written under a temporary name and then renamed, so the identifier changes every time the index is rebuilt.
+    """
+    stat = os.stat(index_path)
+    return f"{os.path.basename(index_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class LexicalIndex:
+    """
+    BM25 search on the posting lists created by BuildLexicalIndex. The terms of a query are combined with OR, and the
+    scores of an article are summed over the posting lists it appears in. Because the posting lists are truncated,
+    searches take milliseconds on the full corpus, even for common terms.
+
+    :param index_path: The path to the SQLite database holding the posting lists. Opened read-only.
+    """
+
+    def __init__(self, index_path: str):
+        # Searches can come from a different thread than the one that opened the index, for example in the Shiny app:
+        self.con = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True, check_same_thread=False)
+
+    def search(self, query: str, limit: int = 1000) -> List[Tuple[int, float]]:
+        """
+        :return: The PMIDs and BM25 scores of the best matching articles, best first. Ties are broken by PMID.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if len(terms) == 0:
+            return []
+        placeholders = ", ".join(["?"] * len(terms))
+        rows = self.con.execute(f"SELECT pmids, scores FROM {POSTINGS_TABLE} WHERE term IN ({placeholders})",
+                                terms).fetchall()
+        if len(rows) == 0:
+            return []
+        postings = [decode_postings(pmid_blob, score_blob) for pmid_blob, score_blob in rows]
+        pmids, inverse = np.unique(np.concatenate([pmids for pmids, _ in postings]), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate([scores for _, scores in postings]))
+        if len(pmids) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            pmids = pmids[top]
+            scores = scores[top]
+        order = np.lexsort((pmids, -scores))[:limit]
+        return list(zip(pmids[order].tolist(), scores[order].tolist()))
+
+    def close(self):
+        self.con.close()
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]],
+                           limit: Optional[int] = None,
+                           k: int = RRF_K) -> List[Tuple[int, float]]:
+    """
+    Combines rankings with reciprocal-rank fusion: each document scores the sum of 1 / (k + rank) over the rankings it
+    appears in, with ranks starting at 1. Only ranks are used, so the scores of the rankings do not need to be
+    comparable.
+
+    :param rankings: Lists of PMIDs, best first.
+    :param limit: The maximum number of PMIDs returned.
+    :return: The PMIDs and their fused scores, best first. Ties are broken by PMID, so the order is deterministic.
+    """
+    pmid_to_score = {}
+    for ranking in rankings:
+        for rank, pmid in enumerate(ranking, start=1):
+            pmid_to_score[pmid] = pmid_to_score.get(pmid, 0.0) + 1.0 / (k + rank)
+    fused = sorted(pmid_to_score.items(), key=lambda item: (-item[1], item[0]))
+    return fused if limit is None else fused[:limit]
@@ -1,8 +1,10 @@
 import logging
 import os
 import sys
-from typing import List
+from typing import List, Optional
 
+import numpy as np
+import pyarrow as pa
 import pyarrow.parquet as pq
 import yaml
 
@@ -12,13 +14,94 @@ from psycopg import sql
 from pgvector.psycopg import register_vector
 from dotenv import load_dotenv
 
+from EmbeddingTransform import EmbeddingTransform, SCALE_COLUMN
 from LoadVectorsInStoreSettings import LoadVectorsInStoreSettings
+from Instrumentation import timer
 from Logging import open_log
+from Profiling import Profiler, open_profiler
+from ShardManifest import ShardManifest
 
 load_dotenv()
 
 
-def load_vectors_in_pgvector(settings: LoadVectorsInStoreSettings):
+def get_vector_type(store_type: str) -> str:
+    return "vector" if store_type == LoadVectorsInStoreSettings.PGVECTOR else "halfvec"
+
+
+def read_embeddings(row_group: pa.Table) -> np.ndarray:
+    """
+    Reads the embeddings from (a row group of) a Parquet file written by SqliteToEmbeddingVectors, converting float16
+    and int8 embeddings back to float32.
+    """
+    names = [name for name in row_group.column_names if name.startswith("embedding_")]
+    embeddings = np.column_stack([row_group.column(name).to_numpy() for name in names])
+    scales = row_group.column(SCALE_COLUMN).to_numpy() if SCALE_COLUMN in row_group.column_names else None
+    return EmbeddingTransform.decode(embeddings, scales)
+
+
+def create_vector_table(conn: psycopg.Connection, schema: str, table: str, vector_type: str, dimensions: int):
+    statement = sql.SQL("CREATE TABLE IF NOT EXISTS {schema}.{table} (pmid INT PRIMARY KEY, embedding {vector_type}({dimensions}))").format(
+        vector_type=sql.SQL(vector_type),
+        schema=sql.Identifier(schema),
+        table=sql.Identifier(table),
+        dimensions=sql.Literal(dimensions)
+    )
+    conn.execute(statement)
+
+
+def upsert_vectors_from_parquet(conn: psycopg.Connection,
+                                schema: str,
+                                table: str,
+                                vector_type: str,
+                                file_path: Optional[str],
+                                delete_pmids: List[int]) -> int:
+    """
+    Inserts the vectors in a Parquet file, replacing the vectors of PMIDs that are already in the table, and deletes the
+    vectors of deleted PMIDs. Everything happens in a single transaction, so the table is never partially updated.
+
+    :param conn: A connection with the pgvector types registered, not in autocommit mode.
+    :param schema: The database schema.
+    :param table: The vector table. Must already exist.
+    :param vector_type: "vector" or "halfvec".
+    :param file_path: The path to the Parquet file, as written by SqliteToEmbeddingVectors. Can be None if there are
+    only deletions.
+    :param delete_pmids: The PMIDs to remove from the table.
+    :return: The number of vectors that were inserted or replaced.
+    """
+    count = 0
+    with conn.transaction():
+        cur = conn.cursor()
+        if file_path is not None:
+            cur.execute(sql.SQL("CREATE TEMPORARY TABLE staging_vectors (LIKE {schema}.{table}) ON COMMIT DROP").format(
+                schema=sql.Identifier(schema),
+                table=sql.Identifier(table)
+            ))
+            with (timer("copy", table=table) as copy_timer,
+                  cur.copy("COPY staging_vectors (pmid, embedding) FROM STDIN WITH (FORMAT BINARY)") as copy):
+                copy.set_types(["int4", vector_type])
+                parquet_file = pq.ParquetFile(file_path)
+                for row_group_idx in range(parquet_file.num_row_groups):
+                    row_group = parquet_file.read_row_group(row_group_idx)
+                    pmids = row_group.column("pmid").to_numpy()
+                    embeddings = read_embeddings(row_group)
+                    for pmid, embedding in zip(pmids.tolist(), embeddings):
+                        copy.write_row([pmid, embedding])
+                    count += len(pmids)
+                copy_timer.items = count
+            cur.execute(sql.SQL("""
+                INSERT INTO {schema}.{table} (pmid, embedding)
+                SELECT pmid, embedding FROM staging_vectors
+                ON CONFLICT (pmid) DO UPDATE SET embedding = EXCLUDED.embedding
+            """).format(schema=sql.Identifier(schema), table=sql.Identifier(table)))
+        if len(delete_pmids) > 0:
+            cur.execute(sql.SQL("DELETE FROM {schema}.{table} WHERE pmid = ANY(%s)").format(
+                schema=sql.Identifier(schema),
+                table=sql.Identifier(table)
+            ), (delete_pmids,))
+    return count
+
+
+def load_vectors_in_pgvector(settings: LoadVectorsInStoreSettings, profiler: Optional[Profiler] = None):
     if os.getenv("POSTGRES_SERVER") is None:
         raise Exception("Must set environmental variables POSTGRES_SERVER, POSTGRES_USER, POSTGRES_PASSWORD, and "
                         "POSTGRES_DATABASE when writing to Postgres.")
@@ -29,16 +112,10 @@ def load_vectors_in_pgvector(settings: LoadVectorsInStoreSettings):
                            autocommit=True)
     conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
     register_vector(conn)
-    vector_type = "vector" if settings.store_type == settings.PGVECTOR else "halfvec"
-
-    # create table
-    statement = sql.SQL("CREATE TABLE IF NOT EXISTS {schema}.{table} (pmid INT PRIMARY KEY, embedding {vector_type}({dimensions}))").format(
-        vector_type=sql.SQL(vector_type),
-        schema=sql.Identifier(settings.schema),
-        table=sql.Identifier(settings.table),
-        dimensions=sql.Literal(settings.dimensions)
-    )
-    conn.execute(statement)
+    if profiler is None:
+        profiler = open_profiler("LoadVectorsInStore")
+    vector_type = get_vector_type(settings.store_type)
+    create_vector_table(conn, settings.schema, settings.table, vector_type, settings.dimensions)
 
     cur = conn.cursor()
     statement = sql.SQL("COPY {schema}.{table} (pmid, embedding) FROM STDIN WITH (FORMAT BINARY)").format(
@@ -50,23 +127,34 @@ def load_vectors_in_pgvector(settings: LoadVectorsInStoreSettings):
 
         # Iterate over Parquet files:
         total_count = 0
-        file_list = sorted([f for f in os.listdir(settings.parquet_folder) if f.endswith(".parquet")])
+        manifest = ShardManifest(settings.parquet_folder)
+        file_list = manifest.get_shard_names()
+        if not manifest.exists():
+            logging.warning(f"No manifest found in '{settings.parquet_folder}', loading all Parquet files in it")
+            file_list = sorted([f for f in os.listdir(settings.parquet_folder) if f.endswith(".parquet")])
         for i in tqdm(range(0, len(file_list))):
             file_name = file_list[i]
             logging.info(f"Processing Parquet file '{file_name}'")
+            if manifest.exists() and not manifest.is_valid(file_name):
+                raise ValueError(f"'{file_name}' is missing or does not match the manifest. Run "
+                                 f"SqliteToEmbeddingVectors again to redo it")
             file_path = os.path.join(settings.parquet_folder, file_name)
             parquet_file = pq.ParquetFile(file_path)
             for row_group_idx in range(parquet_file.num_row_groups):
-                row_group = parquet_file.read_row_group(row_group_idx)
-                pmids = row_group.column("pmid").to_pylist()
-                embedding_columns = [row_group.column(i).to_pylist() for i in range(2, row_group.num_columns)]
-                logging.info(f"- Inserting {len(pmids)} vectors")
-                # Iterate over rows
-                for i, embedding in enumerate(zip(*embedding_columns)):
-                    pmid = int(pmids[i])
-                    copy.write_row([pmid, embedding])
-                total_count = total_count + len(pmids)
-                logging.info(f"- Inserted {total_count} vectors in total")
+                with profiler.batch():
+                    row_group = parquet_file.read_row_group(row_group_idx)
+                    pmids = row_group.column("pmid").to_pylist()
+                    embeddings = read_embeddings(row_group)
+                    if embeddings.shape[1] != settings.dimensions:
+                        raise ValueError(f"'{file_name}' has {embeddings.shape[1]} dimensions, but "
+                                         f"vector_store.dimensions is {settings.dimensions}")
+                    logging.info(f"- Inserting {len(pmids)} vectors")
+                    # Iterate over rows
+                    with timer("copy", items=len(pmids), table=settings.table):
+                        for pmid, embedding in zip(pmids, embeddings):
+                            copy.write_row([int(pmid), embedding])
+                    total_count = total_count + len(pmids)
+                    logging.info(f"- Inserted {total_count} vectors in total")
         # Flush data
         while conn.pgconn.flush() == 1:
             pass
@@ -78,6 +166,7 @@ def load_vectors_in_pgvector(settings: LoadVectorsInStoreSettings):
     result = cur.execute(query)
     count = result.fetchone()[0]
     logging.info(f"Index size is now {count} records")
+    profiler.close()
 
 
 def main(args: List[str]):
@@ -86,7 +175,7 @@ def main(args: List[str]):
     settings = LoadVectorsInStoreSettings(config)
     open_log(settings.log_path)
 
-    load_vectors_in_pgvector(settings)
+    load_vectors_in_pgvector(settings, open_profiler("LoadVectorsInStore", config.get("profiling")))
 
 
 if __name__ == "__main__":
@@ -1,9 +1,13 @@
 import logging
 
+from Instrumentation import open_instrumentation
+
 
 def open_log(log_path):
     logger = logging.getLogger(__name__)
     logging.basicConfig(filename=log_path,
                         level=logging.INFO,
                         format="%(asctime)s %(levelname)-8s %(message)s",
-                        datefmt="%Y-%m-%d %H:%M:%S")
\ No newline at end of file
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    # Structured timings and counters are written next to the log:
+    open_instrumentation(log_path)
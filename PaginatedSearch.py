@@ -0,0 +1,182 @@
+import logging
+import re
+from typing import Iterator, List, Tuple, Optional, Sequence, TypeVar
+
+import psycopg
+from numpy import ndarray
+from psycopg import sql
+
+from ClusterIndex import ClusterIndex
+from LexicalIndex import LexicalIndex, LEXICAL
+
+# Iterative index scans were added in pgvector 0.8.0. Before that, an HNSW index scan stops after ef_search results:
+ITERATIVE_SCAN_VERSION = (0, 8, 0)
+
+# The default of hnsw.max_scan_tuples in pgvector:
+DEFAULT_MAX_SCAN_TUPLES = 20000
+
+# The search engines that can be paginated:
+POSTGRES = "postgres"
+CLUSTER = "cluster"
+ENGINES = [POSTGRES, CLUSTER, LEXICAL]
+
+T = TypeVar("T")
+
+
+def get_pgvector_version(conn: psycopg.Connection) -> Optional[Tuple[int, ...]]:
+    """
+    :return: The version of the vector extension in the database, for example (0, 8, 0), or None if it is not installed.
+    """
+    row = conn.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'").fetchone()
+    if row is None:
+        return None
+    return tuple(int(part) for part in re.findall(r"\d+", row[0]))
+
+
+def paginate(results: Sequence[T], page_size: int) -> Iterator[Sequence[T]]:
+    for start in range(0, len(results), page_size):
+        yield results[start:start + page_size]
+
+
+class VectorStorePager:
+    """
+    Streams the results of a vector search in pages through a server-side cursor, so a search can return far more
+    than the 1,000 results of evaluate_vector_store while only one page is held in memory on the client.
+
+    With pgvector 0.8.0 or later, the HNSW index is searched with strict-order iterative scans: when the ef_search
+    candidates are used up, the scan continues in the graph until enough results are found, and the results are
+    returned in order of distance. With older versions an index scan stops after ef_search results, so the pager falls
+    back to an exact scan, which computes the distance to every vector. This gives the same pages, but slowly.
+
+    All pages of a search come from a single cursor in a single transaction, so pages never overlap or skip results,
+    even if the table is modified during the search.
+
+    :param conn: A connection in autocommit mode, so each search runs in its own transaction. Do not use the connection
+        for anything else until the pages of a search are consumed or the generator is closed.
+    :param ef_search: The size of the candidate list of the HNSW search.
+    :param max_scan_tuples: The maximum number of vectors visited by an iterative scan. If None, twice the number of
+        results requested (and at least the pgvector default of 20,000).
+    :param scan_mem_multiplier: The memory an iterative scan may use, as a multiple of work_mem.
+    """
+
+    def __init__(self,
+                 conn: psycopg.Connection,
+                 schema: str,
+                 table: str,
+                 ef_search: int = 1000,
+                 max_scan_tuples: Optional[int] = None,
+                 scan_mem_multiplier: float = 1):
+        self.conn = conn
+        self.schema = schema
+        self.table = table
+        self.ef_search = ef_search
+        self.max_scan_tuples = max_scan_tuples
+        self.scan_mem_multiplier = scan_mem_multiplier
+        version = get_pgvector_version(conn)
+        self.iterative_scan = version is not None and version >= ITERATIVE_SCAN_VERSION
+        if not self.iterative_scan:
+            version_str = "not installed" if version is None else ".".join(map(str, version))
+            logging.warning(f"pgvector {version_str} does not support iterative index scans, which need version "
+                            f"{'.'.join(map(str, ITERATIVE_SCAN_VERSION))}. Falling back to exact scans, which read "
+                            f"every vector. Consider the cluster index for deep searches instead.")
+
+    def _configure(self, max_results: int):
+        if self.iterative_scan:
+            max_scan_tuples = self.max_scan_tuples
+            if max_scan_tuples is None:
+                max_scan_tuples = max(DEFAULT_MAX_SCAN_TUPLES, 2 * max_results)
+            self.conn.execute("SET LOCAL hnsw.iterative_scan = strict_order")
+            self.conn.execute(sql.SQL("SET LOCAL hnsw.max_scan_tuples = {value}").format(
+                value=sql.Literal(int(max_scan_tuples))))
+            self.conn.execute(sql.SQL("SET LOCAL hnsw.scan_mem_multiplier = {value}").format(
+                value=sql.Literal(self.scan_mem_multiplier)))
+            self.conn.execute(sql.SQL("SET LOCAL hnsw.ef_search = {value}").format(
+                value=sql.Literal(int(self.ef_search))))
+        else:
+            self.conn.execute("SET LOCAL enable_indexscan = off")
+            self.conn.execute("SET LOCAL enable_bitmapscan = off")
+
+    def search_pages(self,
+                     query_embedding: ndarray,
+                     page_size: int = 1000,
+                     max_results: int = 10000) -> Iterator[List[Tuple[int, float]]]:
+        """
+        :param query_embedding: The query vector, transformed the same way as the documents.
+        :param max_results: The total number of results over all pages.
+        :return: A generator of pages, each a list of PMIDs and cosine distances, nearest first.
+        """
+        # An index scan can only order by distance, so ties are only broken by PMID in an exact scan:
+        order_by = "distance" if self.iterative_scan else "distance, pmid"
+        statement = sql.SQL("""
+            SELECT pmid, embedding <=> %s AS distance
+            FROM {schema}.{table}
+            ORDER BY {order_by}
+            LIMIT {limit}
+            """).format(schema=sql.Identifier(self.schema),
+                        table=sql.Identifier(self.table),
+                        order_by=sql.SQL(order_by),
+                        limit=sql.Literal(int(max_results)))
+        embedding_str = f"[{','.join(map(str, query_embedding))}]"
+        result_count = 0
+        with self.conn.transaction():
+            self._configure(max_results)
+            with self.conn.cursor(name="paginated_search") as cursor:
+                cursor.execute(statement, (embedding_str,))
+                while True:
+                    rows = cursor.fetchmany(page_size)
+                    if len(rows) == 0:
+                        break
+                    result_count += len(rows)
+                    yield rows
+        if self.iterative_scan and result_count < max_results:
+            logging.warning(f"The iterative scan returned {result_count} of {max_results} results. If the table has "
+                            f"more rows, increase max_scan_tuples or scan_mem_multiplier")
+
+
+class ClusterIndexPager:
+    """
+    Returns the results of a cluster index search in pages. The search keeps only the best max_results candidates
+    while it scans the clusters, so memory is bounded by max_results rather than by the number of vectors scanned. Ties
+    are broken by PMID, so the order is the same every time.
+
+    :param nprobe: The number of clusters scanned. Should hold well over max_results vectors, for good recall.
+    """
+
+    def __init__(self, index: ClusterIndex, nprobe: int):
+        self.index = index
+        self.nprobe = nprobe
+
+    def search_pages(self,
+                     query_embedding: ndarray,
+                     page_size: int = 1000,
+                     max_results: int = 10000) -> Iterator[List[Tuple[int, float]]]:
+        """
+        :param query_embedding: The query vector, transformed the same way as the documents.
+        :param max_results: The total number of results over all pages.
+        :return: A generator of pages, each a list of PMIDs and cosine similarities, most similar first.
+        """
+        results = self.index.search(query_embedding, k=max_results, nprobe=self.nprobe)
+        if len(results) < max_results:
+            logging.warning(f"The {self.nprobe} clusters scanned held only {len(results)} vectors. Increase nprobe to "
+                            f"return {max_results} results")
+        return paginate(results, page_size)
+
+
+class LexicalIndexPager:
+    """
+    Returns BM25 results from the lexical index in pages. The posting lists are truncated, so a query can not return
+    more articles than its terms have postings in total. Build the index with a larger postings_per_term for deep
+    searches.
+    """
+
+    def __init__(self, index: LexicalIndex):
+        self.index = index
+
+    def search_pages(self,
+                     query: str,
+                     page_size: int = 1000,
+                     max_results: int = 10000) -> Iterator[List[Tuple[int, float]]]:
+        """
+        :return: A generator of pages, each a list of PMIDs and BM25 scores, best first. Ties are broken by PMID.
+        """
+        return paginate(self.index.search(query, limit=max_results), page_size)
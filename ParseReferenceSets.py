@@ -1,88 +1,165 @@
 import csv
+import hashlib
 import json
 import os
 import random
 import re
-import pickle
-from typing import List
+from typing import List, Dict, Iterator, Tuple, Optional
 
+import numpy as np
 import psycopg
 from dotenv import load_dotenv
 
+from ReferenceSet import ReferenceSet
+from RetrievalEvaluation import TREC_COVID_FOLDER, BIOASQ_FOLDER
+
 load_dotenv()
 
 TREC_COVID_SOURCE_FOLDER = "/Users/schuemie/Downloads/trec-covid"
 BIOASQ_SOURCE_FILE = "/Users/schuemie/Downloads/BioASQ-training12b/training12b_new.json"
 
+# Some lines in the corpus file are not valid JSON. For those we fall back to regular expressions:
+_ID_PATTERN = re.compile(r"\"_id\":\s\"([a-z0-9]+)\"")
+_TEXT_PATTERN = re.compile(r"\"text\":\s\"(.*?)\",")
+_TITLE_PATTERN = re.compile(r"\"title\":\s\"(.*?)\",")
+_PUBMED_ID_PATTERN = re.compile(r"\"pubmed_id\":\s\"([0-9]+)\"")
+_NON_ALPHANUMERIC_PATTERN = re.compile(r"[^a-z0-9]+")
 
-def parse_trec_covid():
-    # Load queries ----------------------------------------------
-    with open(os.path.join(TREC_COVID_SOURCE_FOLDER, "queries.jsonl"), "r", encoding="utf-8") as f:
-        queries = f.read().split("\n")
-    id_pattern = r"\"_id\":\s\"([a-z0-9]+)\""
-    query_pattern = r"\"text\":\s\"(.*?)\","
-    query_id_to_query = {re.search(id_pattern, query).group(1): re.search(query_pattern, query).group(1) for query
-                         in queries if re.search(id_pattern, query) is not None}
+# Must produce the same hash as title_hash:
+_POSTGRES_TITLE_HASH = "md5(regexp_replace(lower(pubmed_articles.title), '[^a-z0-9]+', '', 'g'))"
 
-    # Load QRELS -----------------------------------------------
-    with open(os.path.join(TREC_COVID_SOURCE_FOLDER, "qrels", "test.tsv")) as f:
-        qrels = csv.reader(f, delimiter="\t")
-        qrels = [qrel for qrel in qrels][1:]
-    doc_ids_in_qrels = set([qrel[1] for qrel in qrels])
 
-    # Load corpus -------------------------------------------------
-    # Corpus file appears incorrect JSON, so hacking the parsing:
-    with open(os.path.join(TREC_COVID_SOURCE_FOLDER, "corpus.jsonl"), "r", encoding="utf-8") as f:
-        corpus = f.read().split("\n")
-    pattern = r"\"_id\":\s\"([a-z0-9]+)\""
-    doc_id_to_doc = {re.search(pattern, doc).group(1): doc for doc in corpus if re.search(pattern, doc) is not None}
+def title_hash(title: str) -> Optional[str]:
+    """
+    Hashes a title for matching, ignoring case, punctuation, and whitespace.
 
-    # Find PMIDs:
-    doc_id_to_pmid = {item[0]: re.search(r"\"pubmed_id\":\s\"([0-9]+)\"", item[1]).group(1) for item in
-                      doc_id_to_doc.items() if re.search(r"\"pubmed_id\":\s\"([0-9]+)\"", item[1]) is not None}
+    :return: The MD5 hash of the normalized title, or None if nothing is left after normalization.
+    """
+    normalized_title = _NON_ALPHANUMERIC_PATTERN.sub("", title.lower())
+    if normalized_title == "":
+        return None
+    return hashlib.md5(normalized_title.encode("utf-8")).hexdigest()
 
-    # Try to find PMIDs for remainder based on titles:
-    doc_id_to_title = {item[0]: re.search(r"\"title\":\s\"(.*?)\",", item[1]).group(1) for item in doc_id_to_doc.items()
-                       if re.search(r"\"pubmed_id\":\s\"([0-9]+)\"", item[1]) is None}
+
+def _iterate_json_lines(file_name: str) -> Iterator[Tuple[Optional[dict], str]]:
+    """
+    Reads a JSON lines file one line at a time.
+
+    :return: An iterator over tuples of the parsed object (or None if the line is not valid JSON) and the raw line.
+    """
+    with open(file_name, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+            try:
+                yield json.loads(line), line
+            except json.JSONDecodeError:
+                yield None, line
+
+
+def _search_group(pattern: re.Pattern, text: str) -> Optional[str]:
+    match = pattern.search(text)
+    return None if match is None else match.group(1)
+
+
+def _parse_query(query: Optional[dict], line: str) -> Tuple[Optional[str], Optional[str]]:
+    if query is not None:
+        return query.get("_id"), query.get("text")
+    return _search_group(_ID_PATTERN, line), _search_group(_TEXT_PATTERN, line)
+
+
+def _parse_corpus_document(document: Optional[dict], line: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    :return: A tuple of the document ID, PMID (or None), and title (or None).
+    """
+    if document is not None:
+        metadata = document.get("metadata") or {}
+        pmid = metadata.get("pubmed_id") or None
+        return document.get("_id"), pmid, document.get("title")
+    return (_search_group(_ID_PATTERN, line),
+            _search_group(_PUBMED_ID_PATTERN, line),
+            _search_group(_TITLE_PATTERN, line))
+
+
+def _match_titles_to_pmids(doc_id_to_title: Dict[str, str]) -> Dict[str, int]:
+    """
+    Finds PMIDs for documents based on their normalized titles. The title hashes are loaded into a temporary table with
+    a single COPY, so matching takes one hash join against the articles table.
+    """
     postgres_conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
                                     user=os.getenv("POSTGRES_USER"),
                                     password=os.getenv("POSTGRES_PASSWORD"),
                                     dbname=os.getenv("POSTGRES_DATABASE"))
     cursor = postgres_conn.cursor()
     cursor.execute(f"SET SEARCH_PATH={os.getenv('POSTGRES_SCHEMA')};")
-
-    cursor.execute("BEGIN TRANSACTION;")
-    cursor.execute("CREATE TEMPORARY TABLE doc_id_to_title (doc_id TEXT, title TEXT);")
-    cursor.executemany("INSERT INTO doc_id_to_title (doc_id, title) VALUES (%s, %s)", doc_id_to_title.items())
-    sql = """
-    SELECT doc_id, 
-        pmid 
-    FROM doc_id_to_title 
+    cursor.execute("CREATE TEMPORARY TABLE doc_id_to_title (doc_id TEXT, title_hash TEXT);")
+    with cursor.copy("COPY doc_id_to_title (doc_id, title_hash) FROM STDIN") as copy:
+        for doc_id, title in doc_id_to_title.items():
+            hashed_title = title_hash(title)
+            # Empty titles would match many unrelated articles:
+            if hashed_title is not None:
+                copy.write_row((doc_id, hashed_title))
+    cursor.execute("CREATE INDEX idx_title_hash ON doc_id_to_title USING hash (title_hash);")
+    cursor.execute("ANALYZE doc_id_to_title;")
+    sql = f"""
+    SELECT doc_id,
+        pmid
+    FROM doc_id_to_title
     INNER JOIN pubmed_articles
-        ON  doc_id_to_title.title = pubmed_articles.title
+        ON  doc_id_to_title.title_hash = {_POSTGRES_TITLE_HASH}
     """
     cursor.execute(sql)
-    doc_id_to_pmid_2 = cursor.fetchall()
-    doc_id_to_pmid.update({doc_id: pmid for doc_id, pmid in doc_id_to_pmid_2})
-
-    # Convert query IDs to ints:
-    query_id_to_int = {}
-    for i, query_id in enumerate(query_id_to_query):
-        query_id_to_int[query_id] = i
-
-    # Combine objects and save:
-    pmids = [int(pmid) for pmid in doc_id_to_pmid.values()]
-    query_id_to_qrels = {}
-    for query_id in query_id_to_query:
-        pmid_to_score = {int(doc_id_to_pmid[doc_id]): int(score) for id, doc_id, score
-                         in qrels if id == query_id and doc_id in doc_id_to_pmid}
-        query_id_to_qrels[query_id_to_int[query_id]] = pmid_to_score
-    query_id_to_query = {query_id_to_int[query_id]: query for query_id, query in query_id_to_query.items()}
-    dataset = {"pmids": pmids,
-               "query_id_to_qrels": query_id_to_qrels,
-               "query_id_to_query": query_id_to_query}
-    with open("TREC_COVID.pickle", "wb") as f:
-        pickle.dump(dataset, f)
+    doc_id_to_pmid = {doc_id: int(pmid) for doc_id, pmid in cursor.fetchall()}
+    postgres_conn.rollback()
+    postgres_conn.close()
+    return doc_id_to_pmid
+
+
+def parse_trec_covid():
+    # Load queries ----------------------------------------------
+    query_id_to_query = {}
+    for query, line in _iterate_json_lines(os.path.join(TREC_COVID_SOURCE_FOLDER, "queries.jsonl")):
+        query_id, text = _parse_query(query, line)
+        if query_id is not None:
+            query_id_to_query[query_id] = text
+
+    # Load QRELS -----------------------------------------------
+    with open(os.path.join(TREC_COVID_SOURCE_FOLDER, "qrels", "test.tsv")) as f:
+        qrels = csv.reader(f, delimiter="\t")
+        next(qrels)
+        qrels = [(query_id, doc_id, int(score)) for query_id, doc_id, score in qrels]
+
+    # Load corpus -------------------------------------------------
+    # Streamed one document at a time, keeping only the PMIDs, and the titles of documents without a PMID:
+    doc_id_to_pmid = {}
+    doc_id_to_title = {}
+    for document, line in _iterate_json_lines(os.path.join(TREC_COVID_SOURCE_FOLDER, "corpus.jsonl")):
+        doc_id, pmid, title = _parse_corpus_document(document, line)
+        if doc_id is None:
+            continue
+        if pmid is not None:
+            doc_id_to_pmid[doc_id] = int(pmid)
+        elif title is not None:
+            doc_id_to_title[doc_id] = title
+
+    # Try to find PMIDs for remainder based on titles:
+    doc_id_to_pmid.update(_match_titles_to_pmids(doc_id_to_title))
+
+    # Convert query IDs to ints, and combine objects:
+    query_id_to_int = {query_id: i for i, query_id in enumerate(query_id_to_query)}
+    qrels = [(query_id_to_int[query_id], doc_id_to_pmid[doc_id], score) for query_id, doc_id, score in qrels
+             if query_id in query_id_to_int and doc_id in doc_id_to_pmid]
+    # Keep the last judgement when a PMID is judged more than once for a query:
+    qrels = list({(query_id, pmid): (query_id, pmid, score) for query_id, pmid, score in qrels}.values())
+    qrels = np.asarray(qrels, dtype=np.int64).reshape(-1, 3)
+    reference_set = ReferenceSet(query_ids=np.asarray(list(query_id_to_int.values()), dtype=np.int64),
+                                 queries=np.asarray(list(query_id_to_query.values()), dtype=object),
+                                 qrels_query_ids=qrels[:, 0],
+                                 qrels_pmids=qrels[:, 1],
+                                 qrels_relevance=qrels[:, 2],
+                                 pmids=np.asarray(list(doc_id_to_pmid.values()), dtype=np.int64))
+    reference_set.save(TREC_COVID_FOLDER)
 
 
 def _extract_pmids(documents: List[str]) -> List[int]:
@@ -93,8 +170,6 @@ def parse_bioasq():
     with open(BIOASQ_SOURCE_FILE, "r", encoding="utf-8") as f:
         bioasq = json.load(f)
     questions = bioasq["questions"]
-    query_id_to_query = {question["id"]: question["body"] for question in questions}
-    query_id_to_pmids = {question["id"]: _extract_pmids(question["documents"]) for question in questions}
 
     # BioASQ is limited to 2024 baseline of PubMed, which is has highest file ID 1219. Find corresponding highest PMID:
     postgres_conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
@@ -105,24 +180,25 @@ def parse_bioasq():
     cursor.execute(f"SET SEARCH_PATH={os.getenv('POSTGRES_SCHEMA')};")
     cursor.execute("SELECT MAX(pmid) FROM pubmed_articles WHERE file_number <= 1219")
     max_pmid = cursor.fetchone()[0]
+    postgres_conn.close()
 
-    # Convert query IDs to ints:
-    query_id_to_int = {}
-    for i, query_id in enumerate(query_id_to_query):
-        query_id_to_int[query_id] = i
-    query_id_to_query = {query_id_to_int[query_id]: query for query_id, query in query_id_to_query.items()}
-    query_id_to_pmids = {query_id_to_int[query_id]: pmids for query_id, pmids in query_id_to_pmids.items()}
+    # Convert query IDs to ints, and combine objects. Query IDs are the position of the question in the file:
+    query_ids = np.arange(len(questions), dtype=np.int64)
+    qrels = [(query_id, pmid) for query_id, question in enumerate(questions)
+             for pmid in dict.fromkeys(_extract_pmids(question["documents"]))]
+    qrels = np.asarray(qrels, dtype=np.int64).reshape(-1, 2)
 
     # Take a sample of query IDs:
-    sampled_query_ids = random.sample(sorted(query_id_to_int.values()), 100)
-
-    # Combine objects and save:
-    dataset = {"query_id_to_query": query_id_to_query,
-               "query_id_to_pmids": query_id_to_pmids,
-               "max_pmid": max_pmid,
-               "sampled_query_ids": sampled_query_ids}
-    with open("BioASQTrain2024.pickle", "wb") as f:
-        pickle.dump(dataset, f)
+    sampled_query_ids = random.sample(query_ids.tolist(), 100)
+
+    reference_set = ReferenceSet(query_ids=query_ids,
+                                 queries=np.asarray([question["body"] for question in questions], dtype=object),
+                                 qrels_query_ids=qrels[:, 0],
+                                 qrels_pmids=qrels[:, 1],
+                                 qrels_relevance=np.ones(len(qrels), dtype=np.int64),
+                                 metadata={"max_pmid": max_pmid,
+                                           "sampled_query_ids": sampled_query_ids})
+    reference_set.save(BIOASQ_FOLDER)
 
 
 if __name__ == "__main__":
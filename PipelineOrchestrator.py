@@ -0,0 +1,403 @@
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List, Dict, Any, Iterator, Optional
+
+import numpy as np
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from psycopg import sql
+
+from LoadVectorsInStore import get_vector_type, create_vector_table, upsert_vectors_from_parquet
+from Instrumentation import timer
+from Logging import open_log
+from PipelineOrchestratorSettings import PipelineOrchestratorSettings
+from PubMedSqliteIterator import fetch_pubmed_abstracts_for_embedding
+from PubMedXmlToSqlite import create_tables, insert_records, parse_pubmed_xml, extract_sequence_number
+from SqliteToEmbeddingVectors import store_in_parquet
+from TransformerEmbedder import TransformerEmbedder
+
+load_dotenv()
+
+CHECKPOINT_TABLE = "pipeline_checkpoints"
+
+# Placed on a queue after the last item:
+_END = None
+# How often (in seconds) a stage that is waiting on a queue checks whether another stage has failed:
+_POLL_SECONDS = 1.0
+
+
+def _connect_to_sqlite(sqlite_path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(sqlite_path, timeout=60)
+    # Write-ahead logging lets the embedding stage read while the ingestion stage is writing:
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+            stage TEXT,
+            file_number INTEGER,
+            completed_at TEXT,
+            PRIMARY KEY (stage, file_number)
+        )
+    """)
+    return con
+
+
+def _connect_to_postgres() -> psycopg.Connection:
+    if os.getenv("POSTGRES_SERVER") is None:
+        raise Exception("Must set environmental variables POSTGRES_SERVER, POSTGRES_USER, POSTGRES_PASSWORD, and "
+                        "POSTGRES_DATABASE when writing to Postgres.")
+    conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                           user=os.getenv("POSTGRES_USER"),
+                           password=os.getenv("POSTGRES_PASSWORD"),
+                           dbname=os.getenv("POSTGRES_DATABASE"),
+                           autocommit=True)
+    conn.execute('CREATE EXTENSION IF NOT EXISTS vector')
+    register_vector(conn)
+    return conn
+
+
+class PipelineStage(ABC):
+    """
+    A stage of the pipeline. Items flowing through the pipeline are XML file numbers: once a stage has processed a file
+    number, the next stage can start on it. Every stage records which file numbers it has completed in a checkpoint
+    table in the SQLite database, so an interrupted run resumes where it left off.
+
+    Resources such as database connections and models are created in open(), which is called in the thread that runs
+    the stage.
+    """
+
+    def __init__(self, name: str, settings: PipelineOrchestratorSettings, stage_config: Dict[str, Any]):
+        self.name = name
+        self.settings = settings
+        self.stage_config = stage_config
+        self.busy_seconds = 0.0
+        self.processed_count = 0
+        self.skipped_count = 0
+        self.sqlite_con: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        self.sqlite_con = _connect_to_sqlite(self.settings.sqlite_path)
+
+    def close(self):
+        if self.sqlite_con is not None:
+            self.sqlite_con.close()
+
+    def is_done(self, file_number: int) -> bool:
+        row = self.sqlite_con.execute(f"SELECT 1 FROM {CHECKPOINT_TABLE} WHERE stage = ? AND file_number = ?",
+                                      (self.name, file_number)).fetchone()
+        return row is not None
+
+    def mark_done(self, file_number: int):
+        """
+        Adds the checkpoint to the current transaction of the SQLite connection, and commits it.
+        """
+        self.sqlite_con.execute(f"INSERT OR REPLACE INTO {CHECKPOINT_TABLE} (stage, file_number, completed_at) "
+                                f"VALUES (?, ?, datetime('now'))",
+                                (self.name, file_number))
+        self.sqlite_con.commit()
+
+    def process(self, file_number: int):
+        """
+        Processes a file number, unless this stage already completed it in an earlier run.
+        """
+        if self.is_done(file_number):
+            self.skipped_count += 1
+            return
+        start = time.perf_counter()
+        self._process(file_number)
+        self.busy_seconds += time.perf_counter() - start
+        self.processed_count += 1
+
+    @abstractmethod
+    def _process(self, file_number: int):
+        pass
+
+    def finish(self):
+        """
+        Called after the last item has been processed.
+        """
+        pass
+
+
+class XmlToSqliteStage(PipelineStage):
+    """
+    Parses the PubMed XML files in order and inserts them in the SQLite database. This is the source of the pipeline.
+    """
+
+    def open(self):
+        super().open()
+        create_tables(self.sqlite_con)
+        file_list = sorted([f for f in os.listdir(self.settings.xml_folder) if f.endswith(".xml.gz")])
+        self.file_number_to_file_name = {extract_sequence_number(file_name): file_name for file_name in file_list}
+
+    def file_numbers(self) -> Iterator[int]:
+        for file_number in self.file_number_to_file_name:
+            self.process(file_number)
+            yield file_number
+
+    def _process(self, file_number: int):
+        file_name = self.file_number_to_file_name[file_number]
+        logging.info(f"[{self.name}] Processing {file_name}")
+        with timer("parse") as parse_timer:
+            records = parse_pubmed_xml(os.path.join(self.settings.xml_folder, file_name))
+            parse_timer.items = len(records.pmids)
+        # The checkpoint is committed in the same transaction as the records:
+        with timer("insert", items=len(records.pmids)):
+            insert_records(self.sqlite_con, records, file_number)
+            self.mark_done(file_number)
+
+
+class EmbedStage(PipelineStage):
+    """
+    Embeds the articles that were last updated by an XML file, and writes the vectors to one Parquet file per XML file.
+    """
+
+    def open(self):
+        super().open()
+        self.embedder = TransformerEmbedder(model_name=self.settings.embedding_model,
+                                            embed_document_prompt=self.settings.embed_document_prompt,
+                                            embed_query_prompt=self.settings.embed_query_prompt,
+                                            embedding_batch_size=self.settings.embedding_batch_size,
+                                            warm_up=True)
+        os.makedirs(self.settings.parquet_folder, exist_ok=True)
+
+    def _process(self, file_number: int):
+        file_name = parquet_file_name(self.settings.parquet_folder, file_number)
+        pmids = []
+        publication_dates = []
+        embeddings = []
+        for records in fetch_pubmed_abstracts_for_embedding(self.settings.sqlite_path,
+                                                            self.settings.batch_size,
+                                                            file_number=file_number):
+            embeddings.append(self.embedder.embed_documents([record[1] for record in records]))
+            pmids.extend(int(record[0]) for record in records)
+            publication_dates.extend(record[2] for record in records)
+        logging.info(f"[{self.name}] Embedded {len(pmids)} records of file {file_number}")
+        if len(pmids) > 0:
+            # Written under a temporary name first, so an interrupted write never leaves a file that looks complete:
+            temp_file_name = file_name + ".tmp"
+            store_in_parquet(pmids=pmids,
+                             embeddings=np.concatenate(embeddings),
+                             publication_dates=publication_dates,
+                             file_name=temp_file_name)
+            os.replace(temp_file_name, file_name)
+        self.mark_done(file_number)
+
+
+class LoadStage(PipelineStage):
+    """
+    Upserts the vectors of an XML file in the vector store, and removes the vectors of articles deleted by that file.
+    """
+
+    def open(self):
+        super().open()
+        self.conn: Optional[psycopg.Connection] = None
+        self.conn = _connect_to_postgres()
+        self.conn.autocommit = False
+        self.vector_type = get_vector_type(self.settings.store_type)
+        with self.conn.transaction():
+            create_vector_table(self.conn,
+                                self.settings.schema,
+                                self.settings.table,
+                                self.vector_type,
+                                self.settings.dimensions)
+
+    def close(self):
+        super().close()
+        if self.conn is not None:
+            self.conn.close()
+
+    def _process(self, file_number: int):
+        file_name = parquet_file_name(self.settings.parquet_folder, file_number)
+        if not os.path.isfile(file_name):
+            file_name = None
+        delete_pmids = [row[0] for row in
+                        self.sqlite_con.execute("SELECT pmid FROM deleted_pmids WHERE file_number = ?", (file_number,))]
+        count = upsert_vectors_from_parquet(conn=self.conn,
+                                            schema=self.settings.schema,
+                                            table=self.settings.table,
+                                            vector_type=self.vector_type,
+                                            file_path=file_name,
+                                            delete_pmids=delete_pmids)
+        logging.info(f"[{self.name}] Loaded {count} vectors and deleted {len(delete_pmids)} vectors of file "
+                     f"{file_number}")
+        self.mark_done(file_number)
+
+
+class IndexStage(PipelineStage):
+    """
+    Creates the HNSW index once all vectors have been loaded. Building the index after loading is much faster than
+    loading into an indexed table. If the index already exists (for example when processing update files), nothing
+    happens, because Postgres keeps the index up to date.
+    """
+
+    def process(self, file_number: int):
+        pass
+
+    def _process(self, file_number: int):
+        pass
+
+    def finish(self):
+        start = time.perf_counter()
+        conn = _connect_to_postgres()
+        operator_class = f"{get_vector_type(self.settings.store_type)}_cosine_ops"
+        if "maintenance_work_mem" in self.stage_config:
+            conn.execute(sql.SQL("SET maintenance_work_mem = {value}").format(
+                value=sql.Literal(self.stage_config["maintenance_work_mem"])))
+        logging.info(f"[{self.name}] Creating HNSW index (if it does not exist)")
+        conn.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {index} ON {schema}.{table} "
+                             "USING hnsw (embedding {operator_class})").format(
+            index=sql.Identifier(f"idx_{self.settings.table}_embedding"),
+            schema=sql.Identifier(self.settings.schema),
+            table=sql.Identifier(self.settings.table),
+            operator_class=sql.SQL(operator_class)))
+        conn.execute(sql.SQL("ANALYZE {schema}.{table}").format(schema=sql.Identifier(self.settings.schema),
+                                                                table=sql.Identifier(self.settings.table)))
+        conn.close()
+        self.busy_seconds += time.perf_counter() - start
+
+
+_STAGE_CLASSES = {
+    PipelineOrchestratorSettings.XML_TO_SQLITE: XmlToSqliteStage,
+    PipelineOrchestratorSettings.EMBED: EmbedStage,
+    PipelineOrchestratorSettings.LOAD: LoadStage,
+    PipelineOrchestratorSettings.INDEX: IndexStage,
+}
+
+
+def parquet_file_name(parquet_folder: str, file_number: int) -> str:
+    return os.path.join(parquet_folder, f"EmbeddingVectorsFile{file_number:05d}.parquet")
+
+
+def _order_stages(stage_configs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Sorts the stages so every stage comes after its input, and checks that the stages form a DAG.
+    """
+    ordered = []
+    done = set()
+    remaining = list(stage_configs)
+    while len(remaining) > 0:
+        ready = [stage for stage in remaining if stage.get("input") is None or stage["input"] in done]
+        if len(ready) == 0:
+            raise ValueError(f"Stages {[stage['name'] for stage in remaining]} form a cycle")
+        for stage in ready:
+            ordered.append(stage)
+            done.add(stage["name"])
+            remaining.remove(stage)
+    return ordered
+
+
+def _put(output_queue: queue.Queue, item: Optional[int], failed: threading.Event):
+    while not failed.is_set():
+        try:
+            output_queue.put(item, timeout=_POLL_SECONDS)
+            return
+        except queue.Full:
+            pass
+    raise InterruptedError("Another stage failed")
+
+
+def _iterate_queue(input_queue: queue.Queue, failed: threading.Event) -> Iterator[int]:
+    while True:
+        if failed.is_set():
+            raise InterruptedError("Another stage failed")
+        try:
+            item = input_queue.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item is _END:
+            return
+        yield item
+
+
+def _run_stage(stage: PipelineStage,
+               input_queue: Optional[queue.Queue],
+               output_queues: List[queue.Queue],
+               failed: threading.Event,
+               errors: List[BaseException]):
+    try:
+        stage.open()
+        if input_queue is None:
+            items = stage.file_numbers()
+        else:
+            items = _iterate_queue(input_queue, failed)
+        for file_number in items:
+            if input_queue is not None:
+                stage.process(file_number)
+            for output_queue in output_queues:
+                _put(output_queue, file_number, failed)
+        stage.finish()
+        for output_queue in output_queues:
+            _put(output_queue, _END, failed)
+        logging.info(f"[{stage.name}] Finished. Processed {stage.processed_count} files, skipped "
+                     f"{stage.skipped_count} files completed in an earlier run, busy for {stage.busy_seconds:.1f} "
+                     f"seconds")
+    except InterruptedError:
+        logging.info(f"[{stage.name}] Stopped because another stage failed")
+    except BaseException as e:
+        logging.exception(f"[{stage.name}] Failed")
+        errors.append(e)
+        failed.set()
+    finally:
+        stage.close()
+
+
+def run_pipeline(settings: PipelineOrchestratorSettings) -> Dict[str, float]:
+    """
+    Runs all stages concurrently, each in its own thread. Stages are connected by bounded queues, so a fast stage can
+    run ahead of a slow one by at most queue_size files. Threads are sufficient because the heavy lifting (XML parsing
+    aside) happens in PyTorch and the databases, which release the GIL.
+
+    :return: A dictionary from stage name to the number of seconds the stage was busy, plus the total wall time.
+    """
+    stage_configs = _order_stages(settings.stages)
+    stages = {config["name"]: _STAGE_CLASSES[config["type"]](config["name"], settings, config)
+              for config in stage_configs}
+    input_queues = {config["name"]: queue.Queue(maxsize=config.get("queue_size", 2))
+                    for config in stage_configs if config.get("input") is not None}
+    output_queues = {config["name"]: [] for config in stage_configs}
+    for config in stage_configs:
+        if config.get("input") is not None:
+            output_queues[config["input"]].append(input_queues[config["name"]])
+
+    failed = threading.Event()
+    errors = []
+    threads = [threading.Thread(target=_run_stage,
+                                name=name,
+                                args=(stage, input_queues.get(name), output_queues[name], failed, errors))
+               for name, stage in stages.items()]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    timing = {name: stage.busy_seconds for name, stage in stages.items()}
+    timing["wall_time"] = time.perf_counter() - start
+    logging.info(f"Pipeline finished in {timing['wall_time']:.1f} seconds. Busy seconds per stage: "
+                 + ", ".join(f"{name}: {stage.busy_seconds:.1f}" for name, stage in stages.items()))
+    return timing
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = PipelineOrchestratorSettings(config)
+    open_log(settings.log_path)
+
+    run_pipeline(settings)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,56 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+
+
+@dataclass
+class PipelineOrchestratorSettings:
+    xml_folder: str
+    sqlite_path: str
+    parquet_folder: str
+    log_path: str
+    batch_size: int
+    embedding_model: str
+    embed_document_prompt: Optional[str]
+    embed_query_prompt: Optional[str]
+    embedding_batch_size: int
+    dimensions: int
+    store_type: str
+    schema: str
+    table: str
+    stages: List[Dict[str, Any]]
+
+    XML_TO_SQLITE = "xml_to_sqlite"
+    EMBED = "embed"
+    LOAD = "load"
+    INDEX = "index"
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        processing = config["processing"]
+        for key, value in processing.items():
+            setattr(self, key, value)
+        model = config["model"]
+        for key, value in model.items():
+            setattr(self, key, value)
+        vector_store = config["vector_store"]
+        for key, value in vector_store.items():
+            setattr(self, key, value)
+        self.stages = config["stages"]
+        self.__post_init__()
+
+    def __post_init__(self):
+        stage_types = [self.XML_TO_SQLITE, self.EMBED, self.LOAD, self.INDEX]
+        names = [stage["name"] for stage in self.stages]
+        if len(set(names)) != len(names):
+            raise ValueError("stages must have unique names")
+        for stage in self.stages:
+            if stage["type"] not in stage_types:
+                raise ValueError(f"stage type must be one of {stage_types}, not '{stage['type']}'")
+            if stage.get("input") is not None and stage["input"] not in names:
+                raise ValueError(f"stage '{stage['name']}' has unknown input '{stage['input']}'")
+            if (stage.get("input") is None) != (stage["type"] == self.XML_TO_SQLITE):
+                raise ValueError(f"stage '{stage['name']}': only stages of type '{self.XML_TO_SQLITE}' have no input")
@@ -0,0 +1,82 @@
+import logging
+import time
+from typing import List, Tuple
+
+import psycopg
+from psycopg import sql
+
+# Vector indexes are prewarmed first, because searches read them the most:
+VECTOR_INDEX_TYPES = ["hnsw", "ivfflat"]
+
+
+def get_relations(conn: psycopg.Connection, schema: str, table: str) -> List[Tuple[str, str]]:
+    """
+    Finds the indexes and tables holding the data of a table. For a partitioned table, these are the indexes and tables
+    of all its partitions.
+
+    :return: Tuples of the relation name and its type ('hnsw', 'btree', ..., or 'heap' for tables), with vector indexes
+    first, then other indexes, and then tables.
+    """
+    rows = conn.execute("""
+        WITH target AS (
+            SELECT to_regclass(format('%%I.%%I', %s::text, %s::text)) AS relid
+        ),
+        leaves AS (
+            SELECT tree.relid
+            FROM target, pg_partition_tree(target.relid) tree
+            WHERE isleaf
+            UNION
+            SELECT relid
+            FROM target
+            INNER JOIN pg_class
+                ON pg_class.oid = target.relid
+            WHERE relkind = 'r'
+        )
+        SELECT indexrelid::regclass::text, amname
+        FROM pg_index
+        INNER JOIN pg_class
+            ON pg_class.oid = pg_index.indexrelid
+        INNER JOIN pg_am
+            ON pg_am.oid = pg_class.relam
+        WHERE indrelid IN (SELECT relid FROM leaves)
+        UNION ALL
+        SELECT relid::regclass::text, 'heap'
+        FROM leaves
+        """, (schema, table)).fetchall()
+    if len(rows) == 0:
+        raise ValueError(f"Table {schema}.{table} not found")
+
+    def order(relation: Tuple[str, str]) -> int:
+        return 0 if relation[1] in VECTOR_INDEX_TYPES else 2 if relation[1] == "heap" else 1
+
+    return sorted(rows, key=order)
+
+
+def create_extension(conn: psycopg.Connection, extension: str) -> bool:
+    """
+    :return: False if the extension is not installed on the server, or the user may not create it.
+    """
+    try:
+        conn.execute(sql.SQL("CREATE EXTENSION IF NOT EXISTS {extension}").format(extension=sql.Identifier(extension)))
+        return True
+    except psycopg.Error as e:
+        logging.warning(f"Extension {extension} is not available: {str(e).splitlines()[0]}")
+        return False
+
+
+def prewarm_relations(conn: psycopg.Connection, relations: List[Tuple[str, str]], mode: str) -> int:
+    """
+    Reads all pages of the relations with pg_prewarm.
+
+    :param mode: 'buffer' to load the pages into shared buffers, or 'read' or 'prefetch' to load them into the
+    operating system cache only.
+    :return: The number of pages read.
+    """
+    total_pages = 0
+    for relation, relation_type in relations:
+        start = time.perf_counter()
+        pages = conn.execute("SELECT pg_prewarm(%s::regclass, %s)", (relation, mode)).fetchone()[0]
+        logging.info(f"- Prewarmed {relation} ({relation_type}): {pages} pages in {time.perf_counter() - start:.1f} "
+                     f"seconds")
+        total_pages += pages
+    return total_pages
@@ -0,0 +1,163 @@
+import itertools
+import logging
+import os
+import sys
+import time
+from typing import List, Dict, Tuple, Any
+
+import psycopg
+import yaml
+from dotenv import load_dotenv
+from pgvector.psycopg import register_vector
+from psycopg import sql
+
+from EmbeddingTransform import load_transform
+from EvaluateVectorStore import summarize_latencies
+from Logging import open_log
+from PrewarmRelations import get_relations, create_extension, prewarm_relations
+from PrewarmVectorStoreSettings import PrewarmVectorStoreSettings
+from RetrievalEvaluation import create_evaluator
+from TransformerEmbedder import TransformerEmbedder
+
+load_dotenv()
+
+
+def get_buffer_coverage(conn: psycopg.Connection, relations: List[Tuple[str, str]]) -> Dict[str, float]:
+    """
+    Requires the pg_buffercache extension.
+
+    :return: For each relation the fraction of its pages that are in shared buffers.
+    """
+    coverage = {}
+    for relation, _ in relations:
+        buffered_pages, pages = conn.execute("""
+            SELECT (SELECT COUNT(*)
+                    FROM pg_buffercache
+                    WHERE reldatabase = (SELECT oid FROM pg_database WHERE datname = current_database())
+                        AND relfilenode = pg_relation_filenode(%s::regclass)),
+                pg_relation_size(%s::regclass) / current_setting('block_size')::int
+            """, (relation, relation)).fetchone()
+        coverage[relation] = buffered_pages / pages if pages > 0 else 1.0
+    return coverage
+
+
+def get_relation_sizes(conn: psycopg.Connection, relations: List[Tuple[str, str]]) -> Dict[str, float]:
+    """
+    :return: For each relation its size in MB.
+    """
+    return {relation: conn.execute("SELECT pg_relation_size(%s::regclass)", (relation,)).fetchone()[0] / 2 ** 20
+            for relation, _ in relations}
+
+
+def run_queries(conn: psycopg.Connection,
+                settings: PrewarmVectorStoreSettings,
+                query_embeddings: List[List[float]]) -> List[float]:
+    """
+    Searches the vector table for each query embedding.
+
+    :return: The latency of each search, in seconds.
+    """
+    statement = sql.SQL("SELECT pmid FROM {schema}.{table} ORDER BY embedding <=> %s LIMIT {k}").format(
+        schema=sql.Identifier(settings.schema),
+        table=sql.Identifier(settings.table),
+        k=sql.Literal(settings.k)
+    )
+    latencies = []
+    for query_embedding in query_embeddings:
+        embedding_str = f"[{','.join(map(str, query_embedding))}]"
+        start = time.perf_counter()
+        conn.execute(statement, (embedding_str,)).fetchall()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _summarize_probe(latencies: List[float]) -> Dict[str, float]:
+    return {"first_query_ms": latencies[0] * 1000, **summarize_latencies(latencies)}
+
+
+def prewarm_vector_store(conn: psycopg.Connection,
+                         settings: PrewarmVectorStoreSettings,
+                         query_embeddings: List[List[float]]) -> Dict[str, Any]:
+    """
+    Prewarms the indexes and tables of the vector table and its partitions. Probe searches are timed before and after
+    prewarming, using different queries, so the searches after prewarming do not benefit from the pages read by the
+    searches before. The latencies before prewarming only show the cold start if the caches are cold, for example
+    right after a restart of the server.
+
+    :param query_embeddings: The embeddings of the queries used for probing, and for prewarming with queries.
+    :return: A dictionary with the method used, the probe latencies before and after, and the buffer coverage per
+    relation before and after (if pg_buffercache is available).
+    """
+    conn.execute(sql.SQL("SET hnsw.ef_search = {ef_search}").format(ef_search=sql.Literal(settings.ef_search)))
+    relations = get_relations(conn, settings.schema, settings.table)
+    if not settings.include_heap:
+        relations = [relation for relation in relations if relation[1] != "heap"]
+    has_buffer_cache = create_extension(conn, "pg_buffercache")
+    method = settings.method
+    if method == settings.PG_PREWARM and not create_extension(conn, "pg_prewarm"):
+        logging.warning("Falling back to prewarming with queries")
+        method = settings.QUERIES
+
+    report = {"method": method, "sizes_mb": get_relation_sizes(conn, relations)}
+    if has_buffer_cache:
+        report["coverage_before"] = get_buffer_coverage(conn, relations)
+    probe_count = min(settings.probe_queries, len(query_embeddings) // 2)
+    report["before"] = _summarize_probe(run_queries(conn, settings, query_embeddings[:probe_count]))
+
+    start = time.perf_counter()
+    if method == settings.PG_PREWARM:
+        report["pages"] = prewarm_relations(conn, relations, settings.prewarm_mode)
+    else:
+        warm_up_embeddings = itertools.islice(itertools.cycle(query_embeddings[2 * probe_count:] or query_embeddings),
+                                              settings.warm_up_queries)
+        run_queries(conn, settings, list(warm_up_embeddings))
+    report["prewarm_seconds"] = time.perf_counter() - start
+
+    report["after"] = _summarize_probe(run_queries(conn, settings, query_embeddings[probe_count:2 * probe_count]))
+    if has_buffer_cache:
+        report["coverage_after"] = get_buffer_coverage(conn, relations)
+    return report
+
+
+def log_report(report: Dict[str, Any]):
+    logging.info(f"Prewarmed with {report['method']} in {report['prewarm_seconds']:.1f} seconds")
+    for relation, size_mb in report["sizes_mb"].items():
+        coverage = ""
+        if "coverage_before" in report:
+            coverage = (f", {report['coverage_before'][relation]:.0%} in shared buffers before and "
+                        f"{report['coverage_after'][relation]:.0%} after")
+        logging.info(f"- {relation}: {size_mb:.1f} MB{coverage}")
+    for moment in ["before", "after"]:
+        probe = report[moment]
+        logging.info(f"Probe searches {moment} prewarming: first {probe['first_query_ms']:.1f} ms, "
+                     f"p50 {probe['latency_p50_ms']:.1f} ms, p95 {probe['latency_p95_ms']:.1f} ms")
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = PrewarmVectorStoreSettings(config)
+    open_log(settings.log_path)
+
+    transform = None if settings.parquet_folder is None else load_transform(settings.parquet_folder)
+    embedder = TransformerEmbedder(model_name=settings.embedding_model, transform=transform)
+    queries = list(create_evaluator(settings.evaluator).get_query_id_to_query().values())
+    # Embedded before any search, so the probe latencies do not include loading the model:
+    query_embeddings = embedder.embed_queries(queries).tolist()
+
+    conn = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                           user=os.getenv("POSTGRES_USER"),
+                           password=os.getenv("POSTGRES_PASSWORD"),
+                           dbname=os.getenv("POSTGRES_DATABASE"),
+                           autocommit=True)
+    register_vector(conn)
+    report = prewarm_vector_store(conn, settings, query_embeddings)
+    conn.close()
+    log_report(report)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+
+@dataclass
+class PrewarmVectorStoreSettings:
+    log_path: str
+    schema: str
+    table: str
+    embedding_model: str
+    method: str
+    prewarm_mode: str
+    include_heap: bool
+    evaluator: str
+    warm_up_queries: int
+    probe_queries: int
+    ef_search: int
+    k: int
+    parquet_folder: Optional[str] = None
+
+    PG_PREWARM = "pg_prewarm"
+    QUERIES = "queries"
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        vector_store = config["vector_store"]
+        for key, value in vector_store.items():
+            setattr(self, key, value)
+        prewarm = config["prewarm"]
+        for key, value in prewarm.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.method not in [self.PG_PREWARM, self.QUERIES]:
+            raise ValueError(f"prewarm.method must be '{self.PG_PREWARM}' or '{self.QUERIES}'")
+        if self.prewarm_mode not in ["buffer", "read", "prefetch"]:
+            raise ValueError("prewarm.prewarm_mode must be 'buffer', 'read', or 'prefetch'")
@@ -0,0 +1,214 @@
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, ContextManager
+
+PROFILE_ENV_VAR = "RAGPLAYGROUND_PROFILE"
+PROFILE_BATCHES_ENV_VAR = "RAGPLAYGROUND_PROFILE_BATCHES"
+PROFILE_FOLDER_ENV_VAR = "RAGPLAYGROUND_PROFILE_FOLDER"
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+@dataclass
+class ProfilingSettings:
+    """
+    Settings for profiling, from the optional 'profiling' section of a YAML file, or from environmental variables:
+    RAGPLAYGROUND_PROFILE sets the mode ('cprofile' or 'sampling'), RAGPLAYGROUND_PROFILE_BATCHES the batch window (for
+    example '5-10'), and RAGPLAYGROUND_PROFILE_FOLDER the output folder. Environmental variables take precedence.
+    """
+    mode: Optional[str] = None
+    first_batch: int = 1
+    last_batch: Optional[int] = None
+    output_folder: str = "profiles"
+    top_n: int = 25
+    tracemalloc: bool = True
+    sampling_interval: float = 0.005
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is not None:
+            for key, value in config.items():
+                setattr(self, key, value)
+        mode = os.getenv(PROFILE_ENV_VAR)
+        if mode is not None and mode != "":
+            self.mode = CPROFILE if mode.lower() in ["1", "true", "yes"] else mode.lower()
+        batches = os.getenv(PROFILE_BATCHES_ENV_VAR)
+        if batches is not None and batches != "":
+            first, _, last = batches.partition("-")
+            self.first_batch = int(first)
+            self.last_batch = int(last) if last != "" else self.first_batch
+        if os.getenv(PROFILE_FOLDER_ENV_VAR):
+            self.output_folder = os.getenv(PROFILE_FOLDER_ENV_VAR)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.mode not in [None, CPROFILE, SAMPLING]:
+            raise ValueError(f"profiling.mode must be '{CPROFILE}' or '{SAMPLING}', not '{self.mode}'")
+
+
+class _StackSampler:
+    """
+    Periodically records the call stack of one thread. Much cheaper than cProfile for code with many small function
+    calls, at the cost of statistical rather than exact counts.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="StackSampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+class Profiler:
+    """
+    Profiles the batches of a processing stage. Wrap each batch in a with block:
+
+        profiler = open_profiler("embed", config.get("profiling"))
+        for batch in batches:
+            with profiler.batch():
+                ...
+        profiler.close()
+
+    Only batches in the configured window are profiled. When profiling is off, batch() returns a shared no-op context,
+    so the overhead is negligible.
+
+    Output is written to the output folder, named after the stage and process ID: a cProfile file ('.prof', which can
+    be opened with pstats or snakeviz) or collapsed sampled stacks ('.stacks.txt', which can be turned into a flame
+    graph), and a tracemalloc snapshot per batch. A top-N summary is written to the log.
+    """
+
+    def __init__(self, stage: str, settings: ProfilingSettings):
+        self.stage = stage
+        self.settings = settings
+        self.enabled = settings.mode is not None
+        self.batch_index = 0
+        self._profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[_StackSampler] = None
+        self._previous_snapshot: Optional[tracemalloc.Snapshot] = None
+        self._profiled_seconds = 0.0
+        if self.enabled:
+            os.makedirs(settings.output_folder, exist_ok=True)
+            self._file_prefix = os.path.join(settings.output_folder, f"{stage}_{os.getpid()}")
+            logging.info(f"Profiling stage '{stage}' using {settings.mode}, writing to '{self._file_prefix}*'")
+
+    def batch(self) -> ContextManager:
+        if not self.enabled:
+            return _NULL_CONTEXT
+        self.batch_index += 1
+        if self.batch_index < self.settings.first_batch or (self.settings.last_batch is not None and
+                                                             self.batch_index > self.settings.last_batch):
+            return _NULL_CONTEXT
+        return self._profile_batch()
+
+    @contextlib.contextmanager
+    def _profile_batch(self):
+        if self.settings.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.settings.mode == CPROFILE:
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            if self._sampler is None:
+                self._sampler = _StackSampler(threading.get_ident(), self.settings.sampling_interval)
+            self._sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._profiled_seconds += time.perf_counter() - start
+            if self.settings.mode == CPROFILE:
+                self._profile.disable()
+            else:
+                self._sampler.stop()
+            if self.settings.tracemalloc:
+                self._take_snapshot()
+
+    def _take_snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(f"{self._file_prefix}_batch{self.batch_index}.tracemalloc")
+        current, peak = tracemalloc.get_traced_memory()
+        logging.info(f"[profile {self.stage}] Batch {self.batch_index}: traced memory {current / 2 ** 20:.1f} MB, peak "
+                     f"{peak / 2 ** 20:.1f} MB")
+        if self._previous_snapshot is not None:
+            differences = snapshot.compare_to(self._previous_snapshot, "lineno")[:10]
+            logging.info(f"[profile {self.stage}] Largest allocation changes since previous batch:\n" +
+                         "\n".join(str(difference) for difference in differences))
+        self._previous_snapshot = snapshot
+        tracemalloc.reset_peak()
+
+    def close(self):
+        """
+        Writes the profile and logs the summary.
+        """
+        if not self.enabled:
+            return
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if self._profile is not None:
+            file_name = f"{self._file_prefix}.prof"
+            self._profile.dump_stats(file_name)
+            summary = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=summary)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.settings.top_n)
+            logging.info(f"[profile {self.stage}] Profiled {self._profiled_seconds:.1f} seconds, written to "
+                         f"'{file_name}'. Top {self.settings.top_n} functions by cumulative time:\n{summary.getvalue()}")
+        if self._sampler is not None:
+            file_name = f"{self._file_prefix}.stacks.txt"
+            with open(file_name, "w", encoding="utf-8") as f:
+                for stack, stack_count in self._sampler.stacks.most_common():
+                    f.write(f"{stack} {stack_count}\n")
+            total = sum(self._sampler.stacks.values())
+            leaf_counts = Counter()
+            for stack, stack_count in self._sampler.stacks.items():
+                leaf_counts[stack.rsplit(";", 1)[-1]] += stack_count
+            lines = [f"{100 * leaf_count / total:5.1f}% {leaf}"
+                     for leaf, leaf_count in leaf_counts.most_common(self.settings.top_n)]
+            logging.info(f"[profile {self.stage}] Profiled {self._profiled_seconds:.1f} seconds ({total} samples), "
+                         f"written to '{file_name}'. Top {self.settings.top_n} functions by own time:\n" +
+                         "\n".join(lines))
+        self.enabled = False
+
+
+def open_profiler(stage: str, config: Optional[Dict[str, Any]] = None) -> Profiler:
+    """
+    Creates a profiler for a processing stage. Profiling is off unless a mode is set in the configuration or in the
+    RAGPLAYGROUND_PROFILE environmental variable.
+
+    :param stage: The name of the stage, used in the output file names.
+    :param config: The 'profiling' section of the YAML file, if any.
+    """
+    return Profiler(stage, ProfilingSettings(config))
@@ -1,35 +1,100 @@
-import os
 import sqlite3
+from typing import Optional, Iterator, Tuple, List
 
+from Instrumentation import timer
 
-def fetch_pubmed_abstracts_for_embedding(sqlite_path: str, batch_size: int = 100000):
+_ABSTRACTS_SQL = """
+    SELECT pmid,
+        CASE WHEN title IS NULL THEN '' ELSE title || '\n\n' END ||
+            CASE WHEN abstract IS NULL THEN '' ELSE abstract || '\n\n' END ||
+            CASE WHEN mesh_terms IS NULL THEN '' ELSE 'MeSH terms:\n' || mesh_terms || '\n\n' END ||
+            CASE WHEN keywords IS NULL THEN '' ELSE 'Keywords:\n' || keywords || '\n\n' END ||
+            CASE WHEN chemicals IS NULL THEN '' ELSE 'Chemicals:\n' || chemicals || '\n\n' END AS text,
+        publication_date
+    FROM pubmed_articles
+    """
+
+
+def fetch_pubmed_abstracts_for_embedding(sqlite_path: str, batch_size: int = 100000, file_number: Optional[int] = None):
     """
     An iterator that fetches PubMed abstracts in batches. The contents are aimed at creating embedding vectors for
     retrieval.
 
     :param sqlite_path: The path to the SQLite database file
     :param batch_size: The size of the batches the iterator returns
+    :param file_number: If provided, only the abstracts that were last updated by the XML file with this number are
+    returned.
     :return: A tuple of 3: pmids, texts, and publication dates (toordinal integers), each of length batch_size.
     """
     connection = sqlite3.connect(sqlite_path)
     cursor = connection.cursor()
 
-    sql = """
-    SELECT pmid,
-        CASE WHEN title IS NULL THEN '' ELSE title || '\n\n' END ||
-            CASE WHEN abstract IS NULL THEN '' ELSE abstract || '\n\n' END ||
-            CASE WHEN mesh_terms IS NULL THEN '' ELSE 'MeSH terms:\n' || mesh_terms || '\n\n' END ||
-            CASE WHEN keywords IS NULL THEN '' ELSE 'Keywords:\n' || keywords || '\n\n' END ||
-            CASE WHEN chemicals IS NULL THEN '' ELSE 'Chemicals:\n' || chemicals || '\n\n' END AS text,
-        publication_date
-    FROM pubmed_articles;  	
-    """
-    cursor.execute(sql)
+    if file_number is None:
+        cursor.execute(_ABSTRACTS_SQL)
+    else:
+        cursor.execute(_ABSTRACTS_SQL + "WHERE file_number = ?", (file_number,))
     while True:
-        records = cursor.fetchmany(batch_size)
+        with timer("fetch") as fetch_timer:
+            records = cursor.fetchmany(batch_size)
+            fetch_timer.items = len(records)
         if not records:
             break
         yield records
 
     cursor.close()
     connection.close()
+
+
+def fetch_pubmed_abstracts_by_pmid_range(sqlite_path: str,
+                                         pmids_per_shard: int,
+                                         fetch_size: int = 10000) -> Iterator[Tuple[int, int, List[tuple]]]:
+    """
+    An iterator that fetches PubMed abstracts in shards of fixed PMID ranges. A shard covers PMIDs
+    [k * pmids_per_shard + 1, (k + 1) * pmids_per_shard], so shard boundaries do not change when articles are added or
+    deleted. Empty shards are skipped.
+
+    :param sqlite_path: The path to the SQLite database file
+    :param pmids_per_shard: The width of the PMID range of each shard.
+    :param fetch_size: The number of rows fetched from SQLite at a time.
+    :return: A tuple of 3: the first and last PMID of the range, and the records (pmid, text, publication date) in the
+    range, ordered by PMID.
+    """
+    connection = sqlite3.connect(sqlite_path)
+    cursor = connection.cursor()
+    cursor.execute(_ABSTRACTS_SQL + "ORDER BY pmid")
+    shard = None
+    records = []
+    while True:
+        with timer("fetch") as fetch_timer:
+            rows = cursor.fetchmany(fetch_size)
+            fetch_timer.items = len(rows)
+        if not rows:
+            break
+        for row in rows:
+            row_shard = (int(row[0]) - 1) // pmids_per_shard
+            if row_shard != shard and len(records) > 0:
+                yield shard * pmids_per_shard + 1, (shard + 1) * pmids_per_shard, records
+                records = []
+            shard = row_shard
+            records.append(row)
+    if len(records) > 0:
+        yield shard * pmids_per_shard + 1, (shard + 1) * pmids_per_shard, records
+
+    cursor.close()
+    connection.close()
+
+
+def fetch_pubmed_abstracts_in_pmid_range(sqlite_path: str, pmid_start: int, pmid_end: int) -> List[tuple]:
+    """
+    Fetches the PubMed abstracts with a PMID in a range, for example a shard handed out by a work queue.
+
+    :return: The records (pmid, text, publication date), ordered by PMID.
+    """
+    connection = sqlite3.connect(sqlite_path)
+    with timer("fetch") as fetch_timer:
+        records = connection.execute(_ABSTRACTS_SQL + "WHERE pmid BETWEEN ? AND ? ORDER BY pmid",
+                                     (pmid_start, pmid_end)).fetchall()
+        fetch_timer.items = len(records)
+    connection.close()
+    return records
+
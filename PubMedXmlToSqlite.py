@@ -12,7 +12,9 @@ from xml.etree import ElementTree
 from xml.etree.ElementTree import Element
 
 from PubMedXmlToSqliteSettings import PubMedXmlToSqliteSettings
+from Instrumentation import timer
 from Logging import open_log
+from Profiling import open_profiler
 
 
 @dataclass
@@ -151,10 +153,10 @@ def parse_pubmed_xml(file_path: str) -> Records:
             publication_types_combined = "\n".join(publication_type_list) if publication_type_list else None
             records.publication_types.append(publication_types_combined)
 
+        # A DeleteCitation element usually lists many PMIDs:
         for delete_citation in root.findall(".//DeleteCitation"):
-            pmid_elem = delete_citation.find(".//PMID")
-            pmid = int(pmid_elem.text) if pmid_elem is not None else None
-            records.delete_pmids.append(pmid)
+            for pmid_elem in delete_citation.findall(".//PMID"):
+                records.delete_pmids.append(int(pmid_elem.text))
 
     return records
 
@@ -273,13 +275,10 @@ def extract_sequence_number(file_name):
     return None
 
 
-def main(args: List[str]):
-    with open(args[0]) as file:
-        config = yaml.safe_load(file)
-    settings = PubMedXmlToSqliteSettings(config)
-    open_log(settings.log_path)
-
-    con = sqlite3.connect(settings.sqlite_path)
+def create_tables(con: sqlite3.Connection):
+    """
+    Creates the tables and indexes if they do not exist yet.
+    """
     con.execute("""
         CREATE TABLE IF NOT EXISTS pubmed_articles (
             pmid INTEGER PRIMARY KEY,
@@ -299,64 +298,110 @@ def main(args: List[str]):
             file_number INTEGER
         )
     """)
+    # Used for incremental syncing to Postgres (see CopySqliteToPostgres):
+    con.execute("CREATE INDEX IF NOT EXISTS idx_file_number ON pubmed_articles (file_number)")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS deleted_pmids (
+            pmid INTEGER PRIMARY KEY,
+            file_number INTEGER
+        )
+    """)
+    con.execute("CREATE INDEX IF NOT EXISTS idx_file_number_deleted ON deleted_pmids (file_number)")
+
+
+def insert_records(con: sqlite3.Connection, records: Records, file_number: int):
+    """
+    Inserts (or replaces) the records parsed from one XML file, and applies the deletions in that file. Starts a
+    transaction, but does not commit it, so the caller can add other statements to the same transaction.
+
+    :param con: The connection to the SQLite database.
+    :param records: The records parsed from the XML file.
+    :param file_number: The sequence number of the XML file.
+    """
+    logging.info(f"- Inserting {len(records.pmids)} records into database")
+    file_numbers = [file_number] * len(records.pmids)
+    con.execute("BEGIN TRANSACTION;")
+    con.executemany(f"""
+        INSERT OR REPLACE INTO pubmed_articles (
+            pmid, 
+            title, 
+            abstract, 
+            publication_date, 
+            mesh_terms, 
+            keywords,
+            chemicals,
+            authors,
+            journal_name,
+            year,
+            volume,
+            issue,
+            pagination,
+            publication_types,
+            file_number)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """,
+                    list(zip(records.pmids,
+                             records.titles,
+                             records.abstracts,
+                             records.publication_dates,
+                             records.mesh_terms,
+                             records.keywords,
+                             records.chemicals,
+                             records.authors,
+                             records.journal_names,
+                             records.years,
+                             records.volumes,
+                             records.issues,
+                             records.paginations,
+                             records.publication_types,
+                             file_numbers)))
+    # Articles that were deleted earlier but are now back are no longer deleted:
+    con.execute("""
+        DELETE FROM deleted_pmids
+        WHERE pmid IN (SELECT pmid FROM pubmed_articles WHERE file_number = ?)
+    """, (file_number,))
+
+    if len(records.delete_pmids) > 0:
+        logging.info(f"- Deleting {len(records.delete_pmids)} records")
+        placeholders = ", ".join(["?"] * len(records.delete_pmids))
+        query = f"""
+            DELETE FROM pubmed_articles
+            WHERE pmid IN ({placeholders})
+        """
+        con.execute(query, records.delete_pmids)
+        # Keep track of deletions, so they can be propagated to copies of the database:
+        con.executemany("INSERT OR REPLACE INTO deleted_pmids (pmid, file_number) VALUES (?, ?)",
+                        [(pmid, file_number) for pmid in records.delete_pmids])
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = PubMedXmlToSqliteSettings(config)
+    open_log(settings.log_path)
+
+    profiler = open_profiler("PubMedXmlToSqlite", config.get("profiling"))
+
+    con = sqlite3.connect(settings.sqlite_path)
+    create_tables(con)
 
     file_list = sorted([f for f in os.listdir(settings.xml_folder) if f.endswith(".xml.gz")])
 
     for file_name in file_list:
-        logging.info(f"Processing {file_name}")
-        file_path = os.path.join(settings.xml_folder, file_name)
-        file_number = extract_sequence_number(file_name)
-
-        logging.info("- Parsing XML")
-        records = parse_pubmed_xml(file_path)
-
-        logging.info(f"- Inserting {len(records.pmids)} records into database")
-        file_numbers = [file_number] * len(records.pmids)
-        con.execute("BEGIN TRANSACTION;")
-        con.executemany(f"""
-            INSERT OR REPLACE INTO pubmed_articles (
-                pmid, 
-                title, 
-                abstract, 
-                publication_date, 
-                mesh_terms, 
-                keywords,
-                chemicals,
-                authors,
-                journal_name,
-                year,
-                volume,
-                issue,
-                pagination,
-                publication_types,
-                file_number)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-                        list(zip(records.pmids,
-                                 records.titles,
-                                 records.abstracts,
-                                 records.publication_dates,
-                                 records.mesh_terms,
-                                 records.keywords,
-                                 records.chemicals,
-                                 records.authors,
-                                 records.journal_names,
-                                 records.years,
-                                 records.volumes,
-                                 records.issues,
-                                 records.paginations,
-                                 records.publication_types,
-                                 file_numbers)))
-
-        if len(records.delete_pmids) > 0:
-            logging.info(f"- Deleting {len(records.delete_pmids)} records")
-            placeholders = ", ".join(["?"] * len(records.delete_pmids))
-            query = f"""
-                DELETE FROM pubmed_articles
-                WHERE pmid IN ({placeholders})
-            """
-            con.execute(query, records.delete_pmids)
-        con.commit()
+        with profiler.batch():
+            logging.info(f"Processing {file_name}")
+            file_path = os.path.join(settings.xml_folder, file_name)
+            file_number = extract_sequence_number(file_name)
+
+            logging.info("- Parsing XML")
+            with timer("parse") as parse_timer:
+                records = parse_pubmed_xml(file_path)
+                parse_timer.items = len(records.pmids)
+
+            with timer("insert", items=len(records.pmids)):
+                insert_records(con, records, file_number)
+                con.commit()
+    profiler.close()
 
     results = con.execute("SELECT COUNT(*) FROM pubmed_articles").fetchall()
     logging.info(f"Total articles inserted: {results[0][0]}")
@@ -0,0 +1,108 @@
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Any
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+QUERIES_FILE = "queries.parquet"
+QRELS_FILE = "qrels.parquet"
+PMIDS_FILE = "pmids.parquet"
+
+
+@dataclass
+class ReferenceSet:
+    """
+    A reference set (queries and relevance judgements) stored as a bundle of Parquet files in a folder, so it can be
+    memory-mapped and used as arrays without unpickling large dictionaries.
+
+    Attributes:
+    -----------
+    query_ids : ndarray
+        The query IDs, in the order of the queries.
+    queries : ndarray
+        The query texts (object array of strings), aligned with query_ids.
+    qrels_query_ids : ndarray
+        The query ID of every relevance judgement.
+    qrels_pmids : ndarray
+        The PMID of every relevance judgement.
+    qrels_relevance : ndarray
+        The relevance score of every relevance judgement. A score of 0 means judged non-relevant.
+    pmids : ndarray, optional
+        The sorted PMIDs of the documents in the collection, if the collection is a subset of PubMed.
+    metadata : dict
+        Additional JSON-serializable information about the reference set, for example the highest PMID.
+    """
+    query_ids: np.ndarray
+    queries: np.ndarray
+    qrels_query_ids: np.ndarray
+    qrels_pmids: np.ndarray
+    qrels_relevance: np.ndarray
+    pmids: Optional[np.ndarray] = None
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+    def get_query_id_to_query(self) -> Dict[int, str]:
+        return dict(zip(self.query_ids.tolist(), self.queries.tolist()))
+
+    def subset(self, query_ids: np.ndarray) -> "ReferenceSet":
+        """
+        :param query_ids: The query IDs to keep.
+        :return: A new ReferenceSet with only the queries (and judgements) of the given query IDs.
+        """
+        keep_queries = np.isin(self.query_ids, query_ids)
+        keep_qrels = np.isin(self.qrels_query_ids, query_ids)
+        return ReferenceSet(query_ids=self.query_ids[keep_queries],
+                            queries=self.queries[keep_queries],
+                            qrels_query_ids=self.qrels_query_ids[keep_qrels],
+                            qrels_pmids=self.qrels_pmids[keep_qrels],
+                            qrels_relevance=self.qrels_relevance[keep_qrels],
+                            pmids=self.pmids,
+                            metadata=self.metadata)
+
+    def save(self, folder: str):
+        """
+        Saves the reference set. Each file is first written under a temporary name, so an interrupted write never
+        leaves a file that looks complete.
+
+        :param folder: The folder to write the Parquet files to. Will be created if it does not exist.
+        """
+        os.makedirs(folder, exist_ok=True)
+        queries = pa.Table.from_arrays(arrays=[pa.array(self.query_ids.astype(np.int32)),
+                                               pa.array(self.queries.tolist(), type=pa.string())],
+                                       names=["query_id", "query"])
+        queries = queries.replace_schema_metadata({"metadata": json.dumps(self.metadata)})
+        qrels = pa.Table.from_arrays(arrays=[pa.array(self.qrels_query_ids.astype(np.int32)),
+                                             pa.array(self.qrels_pmids.astype(np.int32)),
+                                             pa.array(self.qrels_relevance.astype(np.int8))],
+                                     names=["query_id", "pmid", "relevance"])
+        tables = {QUERIES_FILE: queries, QRELS_FILE: qrels}
+        if self.pmids is not None:
+            tables[PMIDS_FILE] = pa.Table.from_arrays(arrays=[pa.array(np.unique(self.pmids).astype(np.int32))],
+                                                      names=["pmid"])
+        for file_name, table in tables.items():
+            file_name = os.path.join(folder, file_name)
+            temp_file_name = file_name + ".tmp"
+            pq.write_table(table, temp_file_name)
+            os.replace(temp_file_name, file_name)
+
+    @staticmethod
+    def load(folder: str) -> "ReferenceSet":
+        """
+        Loads a reference set. The files are memory-mapped, and all columns except the query texts are returned as
+        int64 arrays.
+        """
+        queries = pq.read_table(os.path.join(folder, QUERIES_FILE), memory_map=True)
+        qrels = pq.read_table(os.path.join(folder, QRELS_FILE), memory_map=True)
+        pmids_file_name = os.path.join(folder, PMIDS_FILE)
+        pmids = None
+        if os.path.isfile(pmids_file_name):
+            pmids = pq.read_table(pmids_file_name, memory_map=True).column("pmid").to_numpy().astype(np.int64)
+        return ReferenceSet(query_ids=queries.column("query_id").to_numpy().astype(np.int64),
+                            queries=np.asarray(queries.column("query").to_pylist(), dtype=object),
+                            qrels_query_ids=qrels.column("query_id").to_numpy().astype(np.int64),
+                            qrels_pmids=qrels.column("pmid").to_numpy().astype(np.int64),
+                            qrels_relevance=qrels.column("relevance").to_numpy().astype(np.int64),
+                            pmids=pmids,
+                            metadata=json.loads(queries.schema.metadata[b"metadata"]))
@@ -1,47 +1,13 @@
-import pickle
 from abc import ABC, abstractmethod
 from typing import Dict, List
 
-import pandas as pd
-from trectools import TrecEval, TrecQrel, TrecRun
-
-
-def _predictions_dict_to_df(query_id_to_pmids: Dict[int, List[int]]) -> pd.DataFrame:
-    predictions = {
-        "query": [],
-        "q0": [],
-        "docid": [],
-        "rank": [],
-        "score": [],
-        "system": [],
-    }
-    for query_id, pmids in query_id_to_pmids.items():
-        n = len(pmids)
-        predictions["query"].extend([query_id] * n)
-        predictions["q0"].extend(["0"] * n)
-        predictions["docid"].extend(pmids)
-        predictions["rank"].extend(list(range(n)))
-        predictions["score"].extend([0] * n)
-        predictions["system"].extend(["system"] * n)
-    return pd.DataFrame.from_dict(predictions)
-
-
-def _trectools_object_to_dict(trec_eval: TrecEval) -> Dict[str, float]:
-    result = {}
-    result["num_ret"] = trec_eval.get_retrieved_documents(per_query=False)
-    result["num_rel"] = trec_eval.get_relevant_documents(per_query=False)
-    result["num_rel_ret"] = trec_eval.get_relevant_retrieved_documents(per_query=False)
-    result["num_q"] = len(trec_eval.run.topics())
-    result["map"] = trec_eval.get_map(depth=10000, per_query=False, trec_eval=True)
-    result["gm_map"] = trec_eval.get_geometric_map(depth=10000, trec_eval=True)
-    result["bpref"] = trec_eval.get_bpref(depth=1000, per_query=False, trec_eval=True)
-    result["Rprec"] = trec_eval.get_rprec(depth=1000, per_query=False, trec_eval=True)
-    result["recip_rank"] = trec_eval.get_reciprocal_rank(depth=1000, per_query=False, trec_eval=True)
-    for v in [5, 10, 15, 20, 30, 100, 200, 500, 1000]:
-        result[f"P@{v}"] = trec_eval.get_precision(depth=v, per_query=False, trec_eval=True)
-    for v in [5, 10, 15, 20, 30, 100, 200, 500, 1000]:
-        result[f"NDCG@{v}"] = trec_eval.get_ndcg(depth=v, per_query=False, trec_eval=True)
-    return result
+import numpy as np
+
+from ReferenceSet import ReferenceSet
+from RetrievalMetrics import EncodedQrels, EncodedRun
+
+TREC_COVID_FOLDER = "TREC_COVID"
+BIOASQ_FOLDER = "BioASQTrain2024"
 
 
 class RetrievalEvaluator(ABC):
@@ -67,6 +33,17 @@ class RetrievalEvaluator(ABC):
         """
         pass
 
+    @abstractmethod
+    def evaluate_encoded(self, run: EncodedRun) -> Dict[str, float]:
+        """
+        Same as evaluate, but for a run that has already been encoded as arrays. This avoids converting between
+        dictionaries and arrays when scoring many runs.
+
+        :param run: An EncodedRun, with the retrieved PMIDs of each query in ranked order.
+        :return: A dictionary from metric name to metric value.
+        """
+        pass
+
 
 class TrecCovidEvaluator(RetrievalEvaluator):
     """
@@ -84,47 +61,23 @@ class TrecCovidEvaluator(RetrievalEvaluator):
     """
 
     def __init__(self):
-        with open("TREC_COVID.pickle", "rb") as f:
-            dataset = pickle.load(f)
-        self.query_id_to_qrels = dataset["query_id_to_qrels"]
-        self.query_id_to_query = dataset["query_id_to_query"]
-        self.allowed_pmids = set(dataset["pmids"])
+        self.reference_set = ReferenceSet.load(TREC_COVID_FOLDER)
+        self.query_id_to_query = self.reference_set.get_query_id_to_query()
+        self.allowed_pmids = self.reference_set.pmids
+        self.qrels = EncodedQrels.from_arrays(query_ids=self.reference_set.query_ids,
+                                              qrels_query_ids=self.reference_set.qrels_query_ids,
+                                              qrels_pmids=self.reference_set.qrels_pmids,
+                                              qrels_relevance=self.reference_set.qrels_relevance)
 
     def get_query_id_to_query(self) -> Dict[int, str]:
         return self.query_id_to_query
 
-
-    def _filter_pmids(self, query_id, pmids):
-        return [pmid for pmid in pmids if pmid in self.allowed_pmids]
-
     def evaluate(self, query_id_to_pmids: Dict[int, List[int]]) -> Dict[str, float]:
-        references = {
-            "query": [],
-            "q0": [],
-            "docid": [],
-            "rel": []
-        }
-        for query_id, pmid_to_score in self.query_id_to_qrels.items():
-            n = len(pmid_to_score)
-            references["query"].extend([query_id] * n)
-            references["q0"].extend(["0"] * n)
-            references["docid"].extend(pmid_to_score)
-            references["rel"].extend(pmid_to_score.values())
-
-        query_id_to_pmids = {query_id: self._filter_pmids(query_id, pmids) for query_id, pmids in query_id_to_pmids.items()}
-        df_run = _predictions_dict_to_df(query_id_to_pmids)
-        df_qrel = pd.DataFrame.from_dict(references)
-
-        trec_run = TrecRun()
-        trec_run.filename = "placeholder.file"
-        trec_run.run_data = df_run
-
-        trec_qrel = TrecQrel()
-        trec_qrel.filename = "placeholder.file"
-        trec_qrel.qrels_data = df_qrel
-
-        trec_eval = TrecEval(trec_run, trec_qrel)
-        return _trectools_object_to_dict(trec_eval)
+        return self.evaluate_encoded(EncodedRun.from_dict(query_id_to_pmids))
+
+    def evaluate_encoded(self, run: EncodedRun) -> Dict[str, float]:
+        run = run.filter(np.isin(run.docids, self.allowed_pmids))
+        return self.qrels.evaluate(run)
 
 
 class BioASQTrain2024Evaluator(RetrievalEvaluator):
@@ -134,68 +87,58 @@ class BioASQTrain2024Evaluator(RetrievalEvaluator):
     """
 
     def __init__(self, use_sample: bool = False):
-        with open("BioASQTrain2024.pickle", "rb") as f:
-            dataset = pickle.load(f)
-        self.query_id_to_query = dataset["query_id_to_query"]
-        self.query_id_to_relevant_pmids = dataset["query_id_to_pmids"]
+        self.reference_set = ReferenceSet.load(BIOASQ_FOLDER)
         if use_sample:
-            sampled_query_ids = dataset["sampled_query_ids"]
-            self.query_id_to_query = {query_id: self.query_id_to_query[query_id] for query_id in sampled_query_ids}
-            self.query_id_to_relevant_pmids = {query_id: self.query_id_to_relevant_pmids[query_id] for query_id in sampled_query_ids}
-        self.max_pmid = dataset["max_pmid"]
+            sampled_query_ids = np.asarray(self.reference_set.metadata["sampled_query_ids"], dtype=np.int64)
+            self.reference_set = self.reference_set.subset(sampled_query_ids)
+        self.query_id_to_query = self.reference_set.get_query_id_to_query()
+        self.max_pmid = self.reference_set.metadata["max_pmid"]
+        self.qrels = EncodedQrels.from_arrays(query_ids=self.reference_set.query_ids,
+                                              qrels_query_ids=self.reference_set.qrels_query_ids,
+                                              qrels_pmids=self.reference_set.qrels_pmids,
+                                              qrels_relevance=self.reference_set.qrels_relevance)
 
     def get_query_id_to_query(self) -> Dict[int, str]:
         return self.query_id_to_query
 
-    def _filter_pmids(self, pmids: List[int]) -> List[int]:
-        return [pmid for pmid in pmids if pmid <= self.max_pmid]
-
     def evaluate(self, query_id_to_pmids: Dict[int, List[int]]) -> Dict[str, float]:
-        references = {
-            "query": [],
-            "q0": [],
-            "docid": [],
-            "rel": []
-        }
-        for query_id, relevant_pmids in self.query_id_to_relevant_pmids.items():
-            pmids = query_id_to_pmids[query_id]
-            non_relevant_pmids = [pmid for pmid in pmids if pmid not in relevant_pmids]
-            n = len(relevant_pmids) + len(non_relevant_pmids)
-            references["query"].extend([query_id] * n)
-            references["q0"].extend(["0"] * n)
-            references["docid"].extend(relevant_pmids)
-            references["docid"].extend(non_relevant_pmids)
-            references["rel"].extend([1]*len(relevant_pmids))
-            references["rel"].extend([0] * len(non_relevant_pmids))
-
-        df_qrel = pd.DataFrame.from_dict(references)
-        query_id_to_pmids = {query_id: self._filter_pmids(pmids) for query_id, pmids in query_id_to_pmids.items()}
-        df_run = _predictions_dict_to_df(query_id_to_pmids)
-
-        trec_run = TrecRun()
-        trec_run.filename = "placeholder.file"
-        trec_run.run_data = df_run
-
-        trec_qrel = TrecQrel()
-        trec_qrel.filename = "placeholder.file"
-        trec_qrel.qrels_data = df_qrel
-
-        trec_eval = TrecEval(trec_run, trec_qrel)
-        return _trectools_object_to_dict(trec_eval)
+        return self.evaluate_encoded(EncodedRun.from_dict(query_id_to_pmids))
+
+    def evaluate_encoded(self, run: EncodedRun) -> Dict[str, float]:
+        # Retrieved PMIDs that are not relevant are considered judged non-relevant. This also includes PMIDs that are
+        # filtered out below because they were not yet in PubMed at the time of the BioASQ baseline:
+        segment = np.repeat(np.arange(len(run.query_ids)), run.lengths)
+        num_nonrelevant = np.bincount(segment[self.qrels.relevance(run) <= 0], minlength=len(run.query_ids))
+        run = run.filter(run.docids <= self.max_pmid)
+        return self.qrels.evaluate(run, unjudged_as_nonrelevant=True, num_nonrelevant=num_nonrelevant)
+
+
+TREC_COVID = "trec_covid"
+BIOASQ = "bioasq"
+BIOASQ_SAMPLE = "bioasq_sample"
+
+
+def create_evaluator(name: str) -> RetrievalEvaluator:
+    """
+    Creates an evaluator by name, so evaluators can be specified in YAML files and passed to worker processes.
+
+    :param name: One of "trec_covid", "bioasq", or "bioasq_sample" (the BioASQ evaluator using the sample of topics).
+    :return: A RetrievalEvaluator.
+    """
+    if name == TREC_COVID:
+        return TrecCovidEvaluator()
+    elif name == BIOASQ:
+        return BioASQTrain2024Evaluator(use_sample=False)
+    elif name == BIOASQ_SAMPLE:
+        return BioASQTrain2024Evaluator(use_sample=True)
+    else:
+        raise ValueError(f"Evaluator must be '{TREC_COVID}', '{BIOASQ}', or '{BIOASQ_SAMPLE}', not '{name}'")
 
 
 if __name__ == "__main__":
-    # with open("TREC_COVID.pickle", "rb") as f:
-    #     dataset = pickle.load(f)
-    # query_id_to_qrels = dataset["query_id_to_qrels"]
-    # query_id_to_pmids = {query_id: pmid_to_score.keys() for query_id, pmid_to_score in query_id_to_qrels.items()}
-    # evaluator = TrecCovidEvaluator()
-    # results = evaluator.evaluate(query_id_to_pmids)
-    # print(results)
-
-    with open("BioASQTrain2024.pickle", "rb") as f:
-        dataset = pickle.load(f)
-    query_id_to_pmids = dataset["query_id_to_pmids"]
+    reference_set = ReferenceSet.load(BIOASQ_FOLDER)
+    query_id_to_pmids = {query_id: reference_set.qrels_pmids[reference_set.qrels_query_ids == query_id].tolist()
+                         for query_id in reference_set.query_ids.tolist()}
     evaluator = BioASQTrain2024Evaluator()
     results = evaluator.evaluate(query_id_to_pmids)
-    print(results)
\ No newline at end of file
+    print(results)
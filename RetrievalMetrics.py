@@ -0,0 +1,271 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DEPTHS = [5, 10, 15, 20, 30, 100, 200, 500, 1000]
+MAP_DEPTH = 10000
+DEPTH = 1000
+GMEAN_MIN = .00001
+
+# PMIDs fit in 32 bits, so a (query, PMID) pair can be packed into a single 64-bit key:
+_KEY_SHIFT = np.int64(2 ** 32)
+
+
+def _segment_cumsum(values: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Cumulative sum that restarts at the start of every segment. Segments must be contiguous and non-empty.
+    """
+    cumsum = np.cumsum(values)
+    offsets = cumsum[starts] - values[starts]
+    return cumsum - np.repeat(offsets, lengths)
+
+
+@dataclass
+class EncodedRun:
+    """
+    A retrieval run encoded as flat arrays, so metrics can be computed for all queries at once.
+
+    Attributes:
+    -----------
+    query_ids : ndarray
+        The query IDs of the run, one per segment.
+    docids : ndarray
+        The retrieved PMIDs of all queries, concatenated in rank order.
+    lengths : ndarray
+        The number of retrieved PMIDs per query.
+    """
+    query_ids: np.ndarray
+    docids: np.ndarray
+    lengths: np.ndarray
+
+    @staticmethod
+    def from_dict(query_id_to_pmids: Dict[int, List[int]]) -> "EncodedRun":
+        query_ids = np.fromiter(query_id_to_pmids.keys(), dtype=np.int64, count=len(query_id_to_pmids))
+        lengths = np.fromiter((len(pmids) for pmids in query_id_to_pmids.values()),
+                              dtype=np.int64,
+                              count=len(query_id_to_pmids))
+        if lengths.sum() == 0:
+            docids = np.zeros(0, dtype=np.int64)
+        else:
+            docids = np.concatenate([np.asarray(pmids, dtype=np.int64) for pmids in query_id_to_pmids.values()])
+        return EncodedRun(query_ids=query_ids, docids=docids, lengths=lengths)
+
+    def filter(self, keep: np.ndarray) -> "EncodedRun":
+        """
+        Removes retrieved documents, keeping the ranking of the remaining ones.
+
+        :param keep: A boolean array of the same length as docids.
+        :return: A new EncodedRun.
+        """
+        segment = np.repeat(np.arange(len(self.query_ids)), self.lengths)
+        lengths = np.bincount(segment[keep], minlength=len(self.query_ids))
+        return EncodedRun(query_ids=self.query_ids, docids=self.docids[keep], lengths=lengths)
+
+
+class EncodedQrels:
+    """
+    Relevance judgements encoded as sorted integer arrays, so a run can be looked up against them with a single
+    vectorized search. Encoding is done once, after which any number of runs can be scored quickly.
+
+    Metrics follow the definitions used by trectools (with trec_eval=True), and the ranking of a run is the order in
+    which the PMIDs are provided.
+    """
+
+    def __init__(self, query_id_to_qrels: Dict[int, Dict[int, int]]):
+        """
+        :param query_id_to_qrels: A dictionary from query ID to a dictionary from PMID to relevance score. A score of 0
+        means judged non-relevant.
+        """
+        query_ids = np.fromiter(query_id_to_qrels.keys(), dtype=np.int64, count=len(query_id_to_qrels))
+        lengths = np.fromiter((len(qrels) for qrels in query_id_to_qrels.values()),
+                              dtype=np.int64,
+                              count=len(query_id_to_qrels))
+        docids = np.fromiter((pmid for qrels in query_id_to_qrels.values() for pmid in qrels),
+                             dtype=np.int64,
+                             count=lengths.sum())
+        rels = np.fromiter((rel for qrels in query_id_to_qrels.values() for rel in qrels.values()),
+                           dtype=np.int64,
+                           count=lengths.sum())
+        self._encode(query_ids, np.repeat(np.arange(len(query_ids), dtype=np.int64), lengths), docids, rels)
+
+    @staticmethod
+    def from_arrays(query_ids: np.ndarray,
+                    qrels_query_ids: np.ndarray,
+                    qrels_pmids: np.ndarray,
+                    qrels_relevance: np.ndarray) -> "EncodedQrels":
+        """
+        Encodes relevance judgements that are already stored as arrays, for example in a ReferenceSet.
+
+        :param query_ids: All query IDs, including those without judgements.
+        :param qrels_query_ids: The query ID of every judgement. Must be one of query_ids.
+        :param qrels_pmids: The PMID of every judgement.
+        :param qrels_relevance: The relevance score of every judgement.
+        :return: An EncodedQrels object.
+        """
+        query_ids = np.asarray(query_ids, dtype=np.int64)
+        order = np.argsort(query_ids, kind="stable")
+        query_index = order[np.searchsorted(query_ids, qrels_query_ids, sorter=order)]
+        qrels = EncodedQrels.__new__(EncodedQrels)
+        qrels._encode(query_ids,
+                      query_index.astype(np.int64),
+                      np.asarray(qrels_pmids, dtype=np.int64),
+                      np.asarray(qrels_relevance, dtype=np.int64))
+        return qrels
+
+    def _encode(self, query_ids: np.ndarray, query_index: np.ndarray, docids: np.ndarray, rels: np.ndarray):
+        self.query_ids = query_ids
+        self.query_id_to_index = {query_id: index for index, query_id in enumerate(query_ids.tolist())}
+
+        keys = query_index * _KEY_SHIFT + docids
+        order = np.argsort(keys, kind="stable")
+        # A sentinel at the end means every lookup lands on a valid position:
+        self.keys = np.append(keys[order], np.iinfo(np.int64).max)
+        self.rels = np.append(rels[order], -1)
+
+        n = len(self.query_ids)
+        self.num_relevant = np.bincount(query_index, weights=rels > 0, minlength=n).astype(np.int64)
+        self.num_nonrelevant = np.bincount(query_index, weights=rels == 0, minlength=n).astype(np.int64)
+
+        # Ideal DCG at every depth, using the relevance scores as gains:
+        relevant = rels > 0
+        ideal_query_index = query_index[relevant]
+        ideal_rels = rels[relevant]
+        order = np.lexsort((-ideal_rels, ideal_query_index))
+        ideal_query_index = ideal_query_index[order]
+        ideal_rels = ideal_rels[order]
+        starts = np.cumsum(self.num_relevant) - self.num_relevant
+        ideal_positions = np.arange(len(ideal_rels)) - np.repeat(starts, self.num_relevant)
+        ideal_gains = ideal_rels / np.log2(ideal_positions + 2)
+        self.ideal_dcg = {depth: np.bincount(ideal_query_index[ideal_positions < depth],
+                                             weights=ideal_gains[ideal_positions < depth],
+                                             minlength=n)
+                          for depth in DEPTHS}
+
+    def _run_query_index(self, run: EncodedRun) -> np.ndarray:
+        """
+        Maps the queries of a run to indices in the qrels. Queries not in the qrels get an index of their own, without
+        any judged documents.
+        """
+        run_query_index = np.fromiter((self.query_id_to_index.get(query_id, -1) for query_id in run.query_ids.tolist()),
+                                      dtype=np.int64,
+                                      count=len(run.query_ids))
+        missing = run_query_index == -1
+        run_query_index[missing] = len(self.query_ids) + np.arange(missing.sum())
+        return run_query_index
+
+    def relevance(self, run: EncodedRun) -> np.ndarray:
+        """
+        Looks up the relevance of every retrieved document.
+
+        :param run: The encoded run.
+        :return: An array of the same length as run.docids, with the relevance score, or -1 for unjudged documents.
+        """
+        query_index = np.repeat(self._run_query_index(run), run.lengths)
+        keys = query_index * _KEY_SHIFT + run.docids
+        idx = np.searchsorted(self.keys, keys)
+        return np.where(self.keys[idx] == keys, self.rels[idx], -1)
+
+    def evaluate(self,
+                 run: EncodedRun,
+                 unjudged_as_nonrelevant: bool = False,
+                 num_nonrelevant: Optional[np.ndarray] = None) -> Dict[str, float]:
+        """
+        Computes all evaluation metrics for all queries in one vectorized pass.
+
+        :param run: The encoded run.
+        :param unjudged_as_nonrelevant: If True, retrieved documents without a judgement are treated as judged
+        non-relevant (which affects bpref).
+        :param num_nonrelevant: Optional array with the number of judged non-relevant documents for every query in the
+        run, to use instead of the number in the qrels.
+        :return: A dictionary from metric name to metric value.
+        """
+        n_qrels = len(self.query_ids)
+        run_query_index = self._run_query_index(run)
+        n = n_qrels + int((run_query_index >= n_qrels).sum())
+
+        num_relevant = np.concatenate([self.num_relevant, np.zeros(n - n_qrels, dtype=np.int64)])
+        num_judged_nonrelevant = np.concatenate([self.num_nonrelevant, np.zeros(n - n_qrels, dtype=np.int64)])
+        if num_nonrelevant is not None:
+            num_judged_nonrelevant[run_query_index] = num_nonrelevant
+
+        non_empty = run.lengths > 0
+        lengths = run.lengths[non_empty]
+        segment_query_index = run_query_index[non_empty]
+        num_queries = len(lengths)
+        starts = np.cumsum(lengths) - lengths
+        query_index = np.repeat(segment_query_index, lengths)
+        positions = np.arange(len(run.docids)) - np.repeat(starts, lengths)
+        rels = self.relevance(run)
+        is_relevant = rels > 0
+
+        result = {}
+        result["num_ret"] = int(len(run.docids))
+        result["num_rel"] = int(self.num_relevant.sum())
+        result["num_rel_ret"] = int(is_relevant.sum())
+        result["num_q"] = num_queries
+        if num_queries == 0:
+            return result
+
+        in_run = np.zeros(n, dtype=bool)
+        in_run[segment_query_index] = True
+        has_relevant = num_relevant > 0
+        safe_num_relevant = np.maximum(num_relevant, 1)
+
+        # Average precision:
+        relevant_so_far = _segment_cumsum(is_relevant.astype(np.int64), starts, lengths)
+        selection = is_relevant & (positions < MAP_DEPTH)
+        ap = np.bincount(query_index[selection],
+                         weights=relevant_so_far[selection] / (positions[selection] + 1),
+                         minlength=n) / safe_num_relevant
+        ap_defined = in_run & has_relevant
+        result["map"] = float(ap[ap_defined].sum() / num_queries)
+        if np.all(ap_defined[in_run | has_relevant]):
+            aps = ap[ap_defined]
+            aps = np.where(aps == 0, GMEAN_MIN, aps)
+            result["gm_map"] = float(np.exp(np.mean(np.log(aps))))
+        else:
+            result["gm_map"] = float("nan")
+
+        # Binary preference, computed over the judged documents only:
+        judged = (rels >= 0) | unjudged_as_nonrelevant
+        judged_position = _segment_cumsum(judged.astype(np.int64), starts, lengths) - 1
+        is_nonrelevant = judged & ~is_relevant
+        nonrelevant_so_far = _segment_cumsum(is_nonrelevant.astype(np.int64), starts, lengths)
+        denominator = np.minimum(num_relevant, num_judged_nonrelevant)
+        selection = is_relevant & (judged_position < DEPTH)
+        selection_query_index = query_index[selection]
+        selection_num_relevant = num_relevant[selection_query_index]
+        selection_denominator = denominator[selection_query_index]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            contribution = (1.0 - np.minimum(nonrelevant_so_far[selection], selection_num_relevant) /
+                            selection_denominator) / selection_num_relevant
+        contribution = np.where(selection_denominator == 0, 0.0, contribution)
+        result["bpref"] = float(np.bincount(selection_query_index, weights=contribution, minlength=n).sum() /
+                                num_queries)
+
+        # R-precision:
+        selection = is_relevant & (positions < np.minimum(num_relevant[query_index], DEPTH))
+        rprec = np.bincount(query_index[selection], minlength=n) / safe_num_relevant
+        result["Rprec"] = float(rprec[in_run & has_relevant].sum() / num_queries)
+
+        # Reciprocal rank:
+        first_relevant = np.full(n, np.iinfo(np.int64).max)
+        selection = is_relevant & (positions < DEPTH)
+        np.minimum.at(first_relevant, query_index[selection], positions[selection])
+        found_relevant = first_relevant < np.iinfo(np.int64).max
+        result["recip_rank"] = float((1.0 / (first_relevant[found_relevant] + 1)).sum() / num_queries)
+
+        for depth in DEPTHS:
+            selection = is_relevant & (positions < depth)
+            result[f"P@{depth}"] = float(selection.sum() / depth / num_queries)
+
+        gains = np.where(is_relevant, rels, 0) / np.log2(positions + 2)
+        for depth in DEPTHS:
+            selection = is_relevant & (positions < depth)
+            dcg = np.bincount(query_index[selection], weights=gains[selection], minlength=n)
+            ideal_dcg = np.concatenate([self.ideal_dcg[depth], np.zeros(n - n_qrels)])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ndcg = np.where(ideal_dcg > 0, dcg / ideal_dcg, 0.0)
+            result[f"NDCG@{depth}"] = float(ndcg.sum() / num_queries)
+        return result
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from LexicalIndex import VECTOR
+from RetrievalMetrics import EncodedRun
+
+
+@dataclass(frozen=True)
+class RunConfig:
+    """
+    The settings that determine the outcome of a retrieval run. Two runs with the same configuration are assumed to
+    produce the same results, so a run only needs to be computed once.
+    """
+    evaluator: str
+    model_name: str
+    table_name: str
+    ef_search: int
+    limit: int = 1000
+    search_mode: str = VECTOR
+    # The build of the lexical index used by lexical and hybrid runs (see get_index_id in LexicalIndex):
+    lexical_index: str = ""
+
+    def config_hash(self) -> str:
+        config = asdict(self)
+        # Left out for vector runs, so runs stored before search modes were added keep their hash:
+        if config["search_mode"] == VECTOR:
+            del config["search_mode"]
+            del config["lexical_index"]
+        config_json = json.dumps(config, sort_keys=True)
+        return hashlib.sha256(config_json.encode("utf-8")).hexdigest()[:16]
+
+
+@dataclass
+class StoredRun:
+    config: RunConfig
+    run: EncodedRun
+    scores: np.ndarray
+    timing: Dict[str, float]
+
+    def to_dict(self) -> Dict[int, List[int]]:
+        """
+        :return: A dictionary from query ID to the ranked list of retrieved PMIDs.
+        """
+        ends = np.cumsum(self.run.lengths)
+        starts = ends - self.run.lengths
+        return {int(query_id): self.run.docids[start:end].tolist()
+                for query_id, start, end in zip(self.run.query_ids, starts, ends)}
+
+
+class RunStore:
+    """
+    Stores retrieval runs as Parquet files in a folder, one file per run configuration, named after the hash of the
+    configuration. Each file has one row per retrieved document (query_id, rank, pmid, score). The configuration and
+    timing information are stored in the file's metadata.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _file_name(self, config: RunConfig) -> str:
+        return os.path.join(self.folder, f"Run_{config.config_hash()}.parquet")
+
+    def contains(self, config: RunConfig) -> bool:
+        return os.path.isfile(self._file_name(config))
+
+    def save(self,
+             config: RunConfig,
+             query_id_to_pmids: Dict[int, List[int]],
+             query_id_to_scores: Dict[int, List[float]],
+             timing: Dict[str, float]):
+        """
+        Saves a run. The file is first written under a temporary name, so an interrupted write never leaves a file that
+        looks complete.
+
+        :param config: The configuration that produced the run.
+        :param query_id_to_pmids: A dictionary from query ID to a ranked list of retrieved PMIDs.
+        :param query_id_to_scores: A dictionary from query ID to the scores of the retrieved PMIDs.
+        :param timing: A dictionary with timing information, for example latency percentiles.
+        """
+        run = EncodedRun.from_dict(query_id_to_pmids)
+        scores = [score for query_id in query_id_to_pmids for score in query_id_to_scores[query_id]]
+        ranks = np.arange(len(run.docids)) - np.repeat(np.cumsum(run.lengths) - run.lengths, run.lengths)
+        table = pa.Table.from_arrays(
+            arrays=[pa.array(np.repeat(run.query_ids, run.lengths).astype(np.int32)),
+                    pa.array(ranks.astype(np.int32)),
+                    pa.array(run.docids.astype(np.int32)),
+                    pa.array(np.asarray(scores, dtype=np.float32))],
+            names=["query_id", "rank", "pmid", "score"]
+        )
+        metadata = {"config": json.dumps(asdict(config)),
+                    "timing": json.dumps(timing),
+                    "query_ids": json.dumps(run.query_ids.tolist())}
+        table = table.replace_schema_metadata(metadata)
+        file_name = self._file_name(config)
+        temp_file_name = file_name + ".tmp"
+        pq.write_table(table, temp_file_name)
+        os.replace(temp_file_name, file_name)
+
+    def load(self, config: RunConfig) -> Optional[StoredRun]:
+        """
+        Loads a run. The PMIDs are returned as an EncodedRun, which can be scored without any conversion.
+
+        :return: A StoredRun, or None if the run is not in the store.
+        """
+        file_name = self._file_name(config)
+        if not os.path.isfile(file_name):
+            return None
+        table = pq.read_table(file_name, memory_map=True)
+        metadata = {key.decode("utf-8"): value.decode("utf-8") for key, value in table.schema.metadata.items()}
+        # Rows are written in query order, so lengths can be derived from the stored query IDs. Queries without
+        # results have no rows, which is why the full list of query IDs is kept in the metadata:
+        query_ids = np.asarray(json.loads(metadata["query_ids"]), dtype=np.int64)
+        row_query_ids = table.column("query_id").to_numpy()
+        unique_query_ids, counts = np.unique(row_query_ids, return_counts=True)
+        query_id_to_count = dict(zip(unique_query_ids.tolist(), counts.tolist()))
+        lengths = np.array([query_id_to_count.get(query_id, 0) for query_id in query_ids.tolist()], dtype=np.int64)
+        run = EncodedRun(query_ids=query_ids,
+                         docids=table.column("pmid").to_numpy().astype(np.int64),
+                         lengths=lengths)
+        return StoredRun(config=config,
+                         run=run,
+                         scores=table.column("score").to_numpy(),
+                         timing=json.loads(metadata["timing"]))
+
+    def list_configs(self) -> List[RunConfig]:
+        """
+        :return: The configurations of all runs in the store.
+        """
+        configs = []
+        for file_name in sorted(os.listdir(self.folder)):
+            if file_name.startswith("Run_") and file_name.endswith(".parquet"):
+                metadata = pq.read_schema(os.path.join(self.folder, file_name)).metadata
+                config: Dict[str, Any] = json.loads(metadata[b"config"])
+                configs.append(RunConfig(**config))
+        return configs
@@ -3,7 +3,6 @@ import os
 import psycopg
 from pgvector.psycopg import register_vector
 
-from sentence_transformers import SentenceTransformer
 from TransformerEmbedder import TransformerEmbedder
 from dotenv import load_dotenv
 
@@ -69,6 +68,9 @@ def explore_short_abstracts():
 
     Conclusions: Studies on treatment of venous thrombosis or acute coronary syndrome have shown that patients treated with nOAC have an increased risk of GIB, compared with those who receive standard care. Better reporting of GIB events in future trials could allow stratification of patients for therapy with gastroprotective agents.
     """
+    # Imported here, so importing this module does not import torch:
+    from sentence_transformers import SentenceTransformer
+
     model = SentenceTransformer("Snowflake/snowflake-arctic-embed-s", trust_remote_code=True)
     e1 = model.encode(query, prompt_name="query")
     print(model.similarity(e1, e1))
@@ -0,0 +1,300 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List, Tuple, Iterator, Callable
+
+import psycopg
+
+SEARCH_METRICS_ENV_VAR = "RAGPLAYGROUND_SEARCH_METRICS"
+SLOW_SEARCH_MS_ENV_VAR = "RAGPLAYGROUND_SLOW_SEARCH_MS"
+
+METRIC_PREFIX = "ragplayground_search"
+
+# The phases of a search:
+EMBED = "embed"
+ANN_SEARCH = "ann_search"
+LEXICAL_SEARCH = "lexical_search"
+METADATA_JOIN = "metadata_join"
+RENDER = "render"
+TOTAL = "total"
+
+# Upper bounds (in seconds) of the histogram buckets:
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+@dataclass
+class SearchTracingSettings:
+    """
+    Settings for search tracing, from the optional 'search_tracing' section of a YAML file, or from environmental
+    variables: RAGPLAYGROUND_SEARCH_METRICS sets metrics_path, and RAGPLAYGROUND_SLOW_SEARCH_MS sets slow_search_ms.
+    Environmental variables take precedence.
+    """
+    metrics_path: Optional[str] = None
+    slow_search_ms: float = 500
+    explain_interval_seconds: float = 60
+    window_seconds: float = 300
+    slot_seconds: float = 10
+    write_interval_seconds: float = 30
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is not None:
+            for key, value in config.items():
+                setattr(self, key, value)
+        if os.getenv(SEARCH_METRICS_ENV_VAR):
+            self.metrics_path = os.getenv(SEARCH_METRICS_ENV_VAR)
+        if os.getenv(SLOW_SEARCH_MS_ENV_VAR):
+            self.slow_search_ms = float(os.getenv(SLOW_SEARCH_MS_ENV_VAR))
+
+
+class RollingHistogram:
+    """
+    A histogram of latencies over the last window_seconds. Observations are counted in slots of slot_seconds, and slots
+    that have left the window are dropped, so the histogram always reflects recent searches.
+    """
+
+    def __init__(self, window_seconds: float = 300, slot_seconds: float = 10):
+        self.window_seconds = window_seconds
+        self.slot_seconds = slot_seconds
+        self._slots: deque = deque()
+
+    def observe(self, seconds: float, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        slot_start = now - now % self.slot_seconds
+        if len(self._slots) == 0 or self._slots[-1][0] != slot_start:
+            self._slots.append((slot_start, [0] * (len(BUCKETS) + 1), [0.0]))
+        _, bucket_counts, total = self._slots[-1]
+        bucket_counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        total[0] += seconds
+        self._drop_old_slots(now)
+
+    def _drop_old_slots(self, now: float):
+        while len(self._slots) > 0 and self._slots[0][0] + self.slot_seconds <= now - self.window_seconds:
+            self._slots.popleft()
+
+    def get_bucket_counts(self, now: Optional[float] = None) -> Tuple[List[int], float]:
+        """
+        :return: The number of observations in each bucket in the window, and the sum of the observations.
+        """
+        self._drop_old_slots(time.monotonic() if now is None else now)
+        bucket_counts = [0] * (len(BUCKETS) + 1)
+        total = 0.0
+        for _, slot_counts, slot_total in self._slots:
+            bucket_counts = [count + slot_count for count, slot_count in zip(bucket_counts, slot_counts)]
+            total += slot_total[0]
+        return bucket_counts, total
+
+
+def summarize_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Summarizes a plan from EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON).
+
+    :return: A dictionary with the names of the indexes used by index scans, the tables read with sequential scans, the
+    shared buffers hit and read, and the execution time in milliseconds.
+    """
+    index_names = []
+    seq_scan_tables = []
+
+    def walk(node: Dict[str, Any]):
+        if "Index Name" in node:
+            index_names.append(node["Index Name"])
+        if node["Node Type"] == "Seq Scan":
+            seq_scan_tables.append(node["Relation Name"])
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan["Plan"])
+    return {"index_names": index_names,
+            "seq_scan_tables": seq_scan_tables,
+            "shared_hit_blocks": plan["Plan"].get("Shared Hit Blocks", 0),
+            "shared_read_blocks": plan["Plan"].get("Shared Read Blocks", 0),
+            "execution_ms": plan.get("Execution Time", 0.0)}
+
+
+def explain_search(conn: psycopg.Connection, statement: str, params: Optional[Tuple] = None) -> Dict[str, Any]:
+    """
+    Runs a search again with EXPLAIN (ANALYZE, BUFFERS), and summarizes the plan, including the access method (for
+    example 'hnsw') of each index used.
+    """
+    plan = conn.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", params).fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    summary = summarize_plan(plan[0])
+    rows = conn.execute("""
+        SELECT relname, amname
+        FROM pg_class
+        INNER JOIN pg_am
+            ON pg_am.oid = pg_class.relam
+        WHERE relname = ANY(%s)
+        """, (summary["index_names"],)).fetchall()
+    summary["index_types"] = sorted(set(amname for _, amname in rows))
+    return summary
+
+
+class SearchTrace:
+    """
+    The timings of the phases of a single search. Returned by SearchTracer.start().
+    """
+
+    def __init__(self):
+        self.phase_seconds: Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    def elapsed_seconds(self) -> float:
+        return time.perf_counter() - self._start
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Times a phase of the search. Use as a context manager. A phase that is entered more than once is summed.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + time.perf_counter() - start
+
+
+class SearchTracer:
+    """
+    Records the time spent in each phase of a search (embed, ann_search, lexical_search, metadata_join, render) in
+    rolling histograms, which are written to a metrics file in the Prometheus text format. Searches slower than
+    slow_search_ms are logged with their breakdown, and the ANN query of a slow search is run again with EXPLAIN
+    (ANALYZE, BUFFERS), at most once per explain_interval_seconds, to log whether it used the HNSW index or fell back to
+    a sequential scan.
+
+    Safe to use from multiple threads.
+
+    :param labels: Labels added to the metrics, for example the table name.
+    """
+
+    def __init__(self, settings: Optional[SearchTracingSettings] = None, **labels: str):
+        self.settings = settings if settings is not None else SearchTracingSettings()
+        self.labels = labels
+        self._histograms: Dict[str, RollingHistogram] = {}
+        self._plan_counts = {"index": 0, "seq_scan": 0}
+        self._lock = threading.Lock()
+        self._last_explain = float("-inf")
+        self._last_write = time.monotonic()
+
+    def start(self) -> SearchTrace:
+        return SearchTrace()
+
+    def finish(self,
+               trace: SearchTrace,
+               conn: Optional[psycopg.Connection] = None,
+               statement: Optional[str] = None,
+               params: Optional[Tuple] = None,
+               connect: Optional[Callable[[], psycopg.Connection]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Records the timings of a search.
+
+        :param conn: The connection the ANN query ran on. If provided with the statement and its parameters, the query
+            is explained if the search was slow.
+        :param connect: Opens a new connection. If provided instead of conn, the query of a slow search is explained on
+            a background thread with its own connection, so the caller does not wait for the explain.
+        :return: The plan summary if the query was explained on conn, or None.
+        """
+        total_seconds = trace.elapsed_seconds()
+        now = time.monotonic()
+        with self._lock:
+            for name, seconds in list(trace.phase_seconds.items()) + [(TOTAL, total_seconds)]:
+                if name not in self._histograms:
+                    self._histograms[name] = RollingHistogram(self.settings.window_seconds, self.settings.slot_seconds)
+                self._histograms[name].observe(seconds, now)
+            explain = (total_seconds * 1000 >= self.settings.slow_search_ms and
+                       (conn is not None or connect is not None) and
+                       now - self._last_explain >= self.settings.explain_interval_seconds)
+            if explain:
+                self._last_explain = now
+        plan_summary = None
+        if total_seconds * 1000 >= self.settings.slow_search_ms:
+            breakdown = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in trace.phase_seconds.items())
+            logging.warning(f"Slow search: {total_seconds * 1000:.1f} ms ({breakdown})")
+            if explain and conn is None:
+                threading.Thread(target=self._explain_in_background,
+                                 args=(connect, statement, params),
+                                 daemon=True).start()
+            elif explain:
+                plan_summary = self._explain(conn, statement, params)
+        if self.settings.metrics_path is not None and now - self._last_write >= self.settings.write_interval_seconds:
+            self.write_metrics()
+        return plan_summary
+
+    def _explain(self, conn: psycopg.Connection, statement: str, params: Optional[Tuple]) -> Optional[Dict[str, Any]]:
+        try:
+            plan_summary = explain_search(conn, statement, params)
+        except psycopg.Error as e:
+            logging.warning(f"Could not explain the slow search: {e}")
+            return None
+        if len(plan_summary["seq_scan_tables"]) > 0:
+            logging.warning(f"Slow search used a sequential scan on {', '.join(plan_summary['seq_scan_tables'])}: "
+                            f"{plan_summary['execution_ms']:.1f} ms, {plan_summary['shared_read_blocks']} blocks "
+                            f"read, {plan_summary['shared_hit_blocks']} blocks hit")
+        else:
+            logging.warning(f"Slow search used {', '.join(plan_summary['index_types']) or 'no'} index scans: "
+                            f"{plan_summary['execution_ms']:.1f} ms, {plan_summary['shared_read_blocks']} blocks "
+                            f"read, {plan_summary['shared_hit_blocks']} blocks hit")
+        with self._lock:
+            self._plan_counts["seq_scan" if len(plan_summary["seq_scan_tables"]) > 0 else "index"] += 1
+        return plan_summary
+
+    def _explain_in_background(self,
+                               connect: Callable[[], psycopg.Connection],
+                               statement: str,
+                               params: Optional[Tuple]):
+        try:
+            with connect() as conn:
+                self._explain(conn, statement, params)
+        except psycopg.Error as e:
+            logging.warning(f"Could not connect to explain the slow search: {e}")
+
+    def write_metrics(self):
+        """
+        Writes the rolling histograms and the counts of explained plans to the metrics file. The file is replaced
+        atomically, so a scraper never sees a partial file.
+        """
+        if self.settings.metrics_path is None:
+            return
+        # The counts are over the window, so they can go down, and are written as gauges rather than a histogram:
+        metric = f"{METRIC_PREFIX}_window_latency_seconds"
+        lines = [f"# HELP {metric} Search latency per phase over the last {self.settings.window_seconds:g} seconds",
+                 f"# TYPE {metric} gauge"]
+        with self._lock:
+            self._last_write = time.monotonic()
+            for name, histogram in sorted(self._histograms.items()):
+                bucket_counts, total = histogram.get_bucket_counts()
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + [float("inf")], bucket_counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{metric}_bucket{self._format_labels(phase=name, le=le)} {cumulative}")
+                lines.append(f"{metric}_sum{self._format_labels(phase=name)} {total}")
+                lines.append(f"{metric}_count{self._format_labels(phase=name)} {cumulative}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_explained_plans_total counter")
+            for plan, plan_count in self._plan_counts.items():
+                lines.append(f"{METRIC_PREFIX}_explained_plans_total{self._format_labels(plan=plan)} {plan_count}")
+        temp_file_name = f"{self.settings.metrics_path}.{os.getpid()}.tmp"
+        with open(temp_file_name, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_file_name, self.settings.metrics_path)
+
+    def _format_labels(self, **extra: str) -> str:
+        labels = list(self.labels.items()) + list(extra.items())
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def open_search_tracer(config: Optional[Dict[str, Any]] = None, **labels: str) -> SearchTracer:
+    """
+    Creates a search tracer. The metrics file is only written if a path is set in the configuration or in the
+    RAGPLAYGROUND_SEARCH_METRICS environmental variable.
+
+    :param config: The 'search_tracing' section of the YAML file, if any.
+    :param labels: Labels added to the metrics, for example the table name.
+    """
+    return SearchTracer(SearchTracingSettings(config), **labels)
@@ -0,0 +1,219 @@
+import json
+import os
+import re
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import List, Dict, Any, Optional, Tuple
+
+import psycopg
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SQLITE = "sqlite"
+POSTGRES = "postgres"
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+# The values of a shard that, when changed, require the shard to be embedded again (besides its row count):
+SHARD_COLUMNS = ["source_checksum", "embedding_model", "embed_document_prompt"]
+
+
+class ShardLeaseQueue(ABC):
+    """
+    A table of shards (PMID ranges) that workers lease one at a time. A lease expires unless the worker renews it with
+    heartbeats, so the shard of a worker that died is handed out again. Workers on different machines can share the
+    queue when the table is in Postgres, or in a SQLite file on a shared drive.
+
+    Lease expiry times use the clocks of the workers, so these should be synchronized (for example using NTP), with a
+    lease duration much longer than the clock differences.
+
+    The same SQL is used for both databases, with %s placeholders. Subclasses provide the connection.
+    """
+
+    # Added to the subquery that selects a shard to lease, so concurrent workers do not wait for each other:
+    skip_locked = ""
+
+    def __init__(self, table: str):
+        if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_.]*", table) is None:
+            raise ValueError(f"Invalid queue table name '{table}'")
+        self.table = table
+
+    @abstractmethod
+    def _execute(self, statement: str, parameters: Tuple = ()) -> List[tuple]:
+        """
+        Executes a statement in its own transaction, and returns the rows it returned.
+        """
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def create_table(self):
+        self._execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} (
+                shard_id INTEGER PRIMARY KEY,
+                pmid_start INTEGER,
+                pmid_end INTEGER,
+                row_count INTEGER,
+                status TEXT,
+                worker TEXT,
+                lease_expires DOUBLE PRECISION,
+                attempts INTEGER,
+                seconds DOUBLE PRECISION,
+                entry TEXT,
+                source_checksum TEXT,
+                embedding_model TEXT,
+                embed_document_prompt TEXT
+            )
+        """)
+
+    def sync_shards(self,
+                    shards: List[Tuple[int, int, int, int, str]],
+                    embedding_model: str,
+                    embed_document_prompt: Optional[str]) -> Dict[str, int]:
+        """
+        Makes the table match the shards in the corpus. New shards are added, shards whose articles, model, or prompt
+        changed are handed out again, and shards that no longer exist are removed.
+
+        :param shards: Tuples of shard ID, first PMID, last PMID, row count, and the checksum of the articles (see
+            compute_source_checksum).
+        :return: The number of added, reset, and removed shards.
+        """
+        rows = self._execute(f"SELECT shard_id, row_count, {', '.join(SHARD_COLUMNS)} FROM {self.table}")
+        existing = {row[0]: row[1:] for row in rows}
+        counts = {"added": 0, "reset": 0, "removed": 0}
+        for shard_id, pmid_start, pmid_end, row_count, source_checksum in shards:
+            values = (row_count, source_checksum, embedding_model, embed_document_prompt)
+            if shard_id not in existing:
+                self._execute(f"""
+                    INSERT INTO {self.table} (shard_id, pmid_start, pmid_end, row_count, {', '.join(SHARD_COLUMNS)},
+                        status, attempts)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 0)
+                """, (shard_id, pmid_start, pmid_end) + values + (PENDING,))
+                counts["added"] += 1
+            elif existing[shard_id] != values:
+                self._execute(f"""
+                    UPDATE {self.table}
+                    SET row_count = %s, source_checksum = %s, embedding_model = %s, embed_document_prompt = %s,
+                        status = %s, worker = NULL, entry = NULL
+                    WHERE shard_id = %s
+                """, values + (PENDING, shard_id))
+                counts["reset"] += 1
+        shard_ids = {shard[0] for shard in shards}
+        for shard_id in existing:
+            if shard_id not in shard_ids:
+                self._execute(f"DELETE FROM {self.table} WHERE shard_id = %s", (shard_id,))
+                counts["removed"] += 1
+        return counts
+
+    def claim(self, worker: str, lease_seconds: float) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Leases the first shard that is pending, or whose lease has expired.
+
+        :return: A tuple of shard ID, first PMID, last PMID, and row count, or None if there is no shard to lease.
+        """
+        now = time.time()
+        available = f"(status = '{PENDING}' OR (status = '{LEASED}' AND lease_expires < %s))"
+        rows = self._execute(f"""
+            UPDATE {self.table}
+            SET status = '{LEASED}', worker = %s, lease_expires = %s, attempts = attempts + 1
+            WHERE shard_id = (
+                SELECT shard_id FROM {self.table} WHERE {available} ORDER BY shard_id LIMIT 1 {self.skip_locked}
+            ) AND {available}
+            RETURNING shard_id, pmid_start, pmid_end, row_count
+        """, (worker, now + lease_seconds, now, now))
+        return rows[0] if len(rows) > 0 else None
+
+    def heartbeat(self, shard_id: int, worker: str, lease_seconds: float) -> bool:
+        """
+        Renews a lease.
+
+        :return: False if the worker no longer holds the lease, because it expired and another worker took it.
+        """
+        rows = self._execute(f"""
+            UPDATE {self.table} SET lease_expires = %s
+            WHERE shard_id = %s AND worker = %s AND status = '{LEASED}'
+            RETURNING shard_id
+        """, (time.time() + lease_seconds, shard_id, worker))
+        return len(rows) > 0
+
+    def complete(self, shard_id: int, worker: str, seconds: float, entry: Dict[str, Any]) -> bool:
+        """
+        Marks a leased shard as done.
+
+        :param seconds: The time the worker spent on the shard.
+        :param entry: The manifest entry of the shard.
+        :return: False if the worker no longer holds the lease.
+        """
+        rows = self._execute(f"""
+            UPDATE {self.table} SET status = '{DONE}', seconds = %s, entry = %s
+            WHERE shard_id = %s AND worker = %s AND status = '{LEASED}'
+            RETURNING shard_id
+        """, (seconds, json.dumps(entry), shard_id, worker))
+        return len(rows) > 0
+
+    def get_status_counts(self) -> Dict[str, int]:
+        counts = {PENDING: 0, LEASED: 0, DONE: 0}
+        counts.update(dict(self._execute(f"SELECT status, COUNT(*) FROM {self.table} GROUP BY status")))
+        return counts
+
+    def get_completed(self) -> List[Tuple[str, int, float, Dict[str, Any]]]:
+        """
+        :return: For each completed shard a tuple of the worker, row count, seconds, and manifest entry.
+        """
+        rows = self._execute(f"SELECT worker, row_count, seconds, entry FROM {self.table} WHERE status = '{DONE}'")
+        return [(worker, row_count, seconds, json.loads(entry)) for worker, row_count, seconds, entry in rows]
+
+
+class SqliteShardLeaseQueue(ShardLeaseQueue):
+    def __init__(self, sqlite_path: str, table: str):
+        super().__init__(table)
+        # Autocommit, so each statement is its own transaction. Waits for other workers holding the write lock:
+        self.connection = sqlite3.connect(sqlite_path, timeout=60, isolation_level=None)
+
+    def _execute(self, statement: str, parameters: Tuple = ()) -> List[tuple]:
+        return self.connection.execute(statement.replace("%s", "?"), parameters).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+class PostgresShardLeaseQueue(ShardLeaseQueue):
+    skip_locked = "FOR UPDATE SKIP LOCKED"
+
+    def __init__(self, table: str):
+        super().__init__(table)
+        if os.getenv("POSTGRES_SERVER") is None:
+            raise Exception("Must set environmental variables POSTGRES_SERVER, POSTGRES_USER, POSTGRES_PASSWORD, and "
+                            "POSTGRES_DATABASE when using a Postgres work queue.")
+        self.connection = psycopg.connect(host=os.getenv("POSTGRES_SERVER"),
+                                          user=os.getenv("POSTGRES_USER"),
+                                          password=os.getenv("POSTGRES_PASSWORD"),
+                                          dbname=os.getenv("POSTGRES_DATABASE"),
+                                          autocommit=True)
+
+    def _execute(self, statement: str, parameters: Tuple = ()) -> List[tuple]:
+        cursor = self.connection.execute(statement, parameters)
+        return cursor.fetchall() if cursor.description is not None else []
+
+    def close(self):
+        self.connection.close()
+
+
+def open_shard_lease_queue(backend: str, table: str, sqlite_path: Optional[str] = None) -> ShardLeaseQueue:
+    """
+    :param backend: "sqlite" or "postgres".
+    :param table: The name of the lease table. For Postgres, this can include the schema.
+    :param sqlite_path: The path to the SQLite file holding the table. Only used for SQLite.
+    """
+    if backend == SQLITE:
+        return SqliteShardLeaseQueue(sqlite_path, table)
+    elif backend == POSTGRES:
+        return PostgresShardLeaseQueue(table)
+    else:
+        raise ValueError(f"backend must be '{SQLITE}' or '{POSTGRES}', not '{backend}'")
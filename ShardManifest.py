@@ -0,0 +1,108 @@
+import datetime
+import hashlib
+import json
+import os
+from typing import Dict, Any, List, Optional
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def shard_file_name(pmid_start: int, pmid_end: int, prefix: str = "EmbeddingVectors") -> str:
+    return f"{prefix}_pmid{pmid_start:09d}_{pmid_end:09d}.parquet"
+
+
+def compute_source_checksum(records: List[tuple]) -> str:
+    """
+    Computes a checksum of the records a shard is created from, so a shard is redone when any of its articles was
+    added, deleted, or changed.
+
+    :param records: The records as returned by fetch_pubmed_abstracts_by_pmid_range.
+    """
+    digest = hashlib.sha256()
+    for pmid, text, publication_date in records:
+        digest.update(f"{pmid}\t{publication_date}\t{text}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def compute_file_checksum(file_name: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as file:
+        for block in iter(lambda: file.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def add_file_details(file_name: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    :return: A copy of the manifest entry with the size and checksum of the shard file, and the current time.
+    """
+    return dict(entry,
+                file_size=os.path.getsize(file_name),
+                file_checksum=compute_file_checksum(file_name),
+                created_at=datetime.datetime.now().isoformat(timespec="seconds"))
+
+
+class ShardManifest:
+    """
+    Records the Parquet shards in a folder, with the PMID range, row count, and checksums of each shard, and the model
+    and prompt it was embedded with. A shard is only added after its file has been completely written, so a shard that
+    is in the manifest and matches its checksum is complete.
+
+    :param folder: The folder holding the shards. The manifest is stored in this folder as manifest.json.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.file_name = os.path.join(folder, MANIFEST_FILE_NAME)
+        self.shards: Dict[str, Dict[str, Any]] = {}
+        if os.path.isfile(self.file_name):
+            with open(self.file_name) as file:
+                self.shards = json.load(file)["shards"]
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.file_name)
+
+    def is_valid(self, shard_name: str, expected: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        Checks whether a shard is in the manifest, and its file is present and unchanged.
+
+        :param shard_name: The file name of the shard, without folder.
+        :param expected: Values the manifest entry must have, for example the source checksum and the model.
+        """
+        entry = self.shards.get(shard_name)
+        if entry is None:
+            return False
+        if expected is not None and any(entry.get(key) != value for key, value in expected.items()):
+            return False
+        file_name = os.path.join(self.folder, shard_name)
+        return (os.path.isfile(file_name) and
+                os.path.getsize(file_name) == entry["file_size"] and
+                compute_file_checksum(file_name) == entry["file_checksum"])
+
+    def add(self, shard_name: str, entry: Dict[str, Any]):
+        """
+        Adds a shard whose file has been written. The file size and checksum are added to the entry.
+        """
+        self.shards[shard_name] = add_file_details(os.path.join(self.folder, shard_name), entry)
+
+    def remove(self, shard_name: str):
+        """
+        Removes a shard from the manifest, and deletes its file.
+        """
+        self.shards.pop(shard_name, None)
+        file_name = os.path.join(self.folder, shard_name)
+        if os.path.isfile(file_name):
+            os.remove(file_name)
+
+    def get_shard_names(self) -> List[str]:
+        """
+        :return: The file names of all shards, ordered by PMID.
+        """
+        return sorted(self.shards.keys(), key=lambda shard_name: self.shards[shard_name]["pmid_start"])
+
+    def save(self):
+        # Written under a temporary name first, so a crash never leaves a partial manifest:
+        temp_file_name = f"{self.file_name}.tmp"
+        with open(temp_file_name, "w") as file:
+            json.dump({"shards": self.shards}, file, indent=1)
+        os.replace(temp_file_name, self.file_name)
@@ -1,14 +1,40 @@
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from shiny import App, Inputs, Outputs, Session, render, ui, reactive
-from sentence_transformers import SentenceTransformer
 import psycopg
 from pgvector.psycopg import register_vector
 from dotenv import load_dotenv
 
+# SearchTracing.py, LexicalIndex.py, and PrewarmRelations.py are in the root of the repository. Run the app with the
+# root on the PYTHONPATH, or copy the files to this folder when deploying:
+from SearchTracing import open_search_tracer, EMBED, ANN_SEARCH, LEXICAL_SEARCH, METADATA_JOIN, RENDER
+from LexicalIndex import LexicalIndex, reciprocal_rank_fusion, VECTOR, LEXICAL, HYBRID
+from PrewarmRelations import get_relations, create_extension, prewarm_relations
+
 load_dotenv()
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s %(levelname)-8s %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S")
+
+VECTOR_SCHEMA = "public"
+VECTOR_TABLE = "vectors_snowflake_arctic_m_partitioned"
+RESULT_COUNT = 25
+# In hybrid mode, the fused results are taken from this many results of each search:
+HYBRID_CANDIDATES = 100
+
+
+def _load_embedding_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer("Snowflake/snowflake-arctic-embed-m-v1.5", trust_remote_code=True)
+
+
+# Importing sentence_transformers and loading the model takes several seconds. It is done in the background, so the
+# page is served right away. The first search waits for the model if it is not loaded yet:
+embedding_model_future = ThreadPoolExecutor(max_workers=1).submit(_load_embedding_model)
 
-embedding_model = SentenceTransformer("Snowflake/snowflake-arctic-embed-m-v1.5", trust_remote_code=True)
 conn = psycopg.connect(host=os.getenv("ECP_RDS_HOST"),
                        user=os.getenv("ECP_RDS_USER"),
                        password=os.getenv("ECP_RDS_PASSWORD"),
@@ -16,6 +42,71 @@ conn = psycopg.connect(host=os.getenv("ECP_RDS_HOST"),
 register_vector(conn)
 conn.execute("SET hnsw.ef_search = 25")
 
+
+def _connect() -> psycopg.Connection:
+    """
+    Opens a new connection in autocommit mode, for work that should not wait for, or hold up, the searches on conn.
+    """
+    return psycopg.connect(host=os.getenv("ECP_RDS_HOST"),
+                           user=os.getenv("ECP_RDS_USER"),
+                           password=os.getenv("ECP_RDS_PASSWORD"),
+                           dbname=os.getenv("ECP_RDS_DBNAME"),
+                           autocommit=True)
+
+
+def _prewarm_vector_table():
+    """
+    Reads the indexes and tables of all partitions of the vector table into shared buffers with pg_prewarm, so the
+    first searches after a restart of the database are not slow.
+    """
+    with _connect() as prewarm_conn:
+        if not create_extension(prewarm_conn, "pg_prewarm"):
+            return
+        relations = get_relations(prewarm_conn, VECTOR_SCHEMA, VECTOR_TABLE)
+        start = time.perf_counter()
+        pages = prewarm_relations(prewarm_conn, relations, "buffer")
+        logging.info(f"Prewarmed {len(relations)} indexes and partitions ({pages} pages) in "
+                     f"{time.perf_counter() - start:.1f} seconds")
+
+
+# The app only accepts requests after this module has been loaded, so prewarming here delays serving until the indexes
+# are in memory:
+if os.getenv("PREWARM_ON_STARTUP", "false").lower() == "true":
+    _prewarm_vector_table()
+
+# Logs slow searches with the time per phase, and whether the ANN query used the HNSW index. Rolling latency histograms
+# are written to the file in the RAGPLAYGROUND_SEARCH_METRICS environmental variable, if set:
+tracer = open_search_tracer(table=VECTOR_TABLE)
+
+# The lexical and hybrid search modes are offered if the LEXICAL_INDEX_PATH environmental variable points to a SQLite
+# database with the lexical index built by BuildLexicalIndex:
+lexical_index = None
+if os.getenv("LEXICAL_INDEX_PATH"):
+    lexical_index = LexicalIndex(os.getenv("LEXICAL_INDEX_PATH"))
+
+ANN_SQL = f"""
+        SELECT embedding <=> %s AS similarity,
+            pmid
+        FROM {VECTOR_SCHEMA}.{VECTOR_TABLE}
+        ORDER BY embedding <=> %s
+        LIMIT %s;
+        """
+
+SCORE_LABELS = {VECTOR: "Semantic distance", LEXICAL: "BM25 score", HYBRID: "Fusion score"}
+
+METADATA_SQL = """
+        SELECT pmid,
+            title,
+            authors,
+            journal_name,
+            year,
+            volume,
+            issue,
+            pagination
+        FROM public.pubmed_articles
+        WHERE pmid = ANY(%s);
+        """
+
 app_ui = ui.page_fluid(
     ui.panel_title("PubMed Vector Search"),
     ui.row(
@@ -24,7 +115,12 @@ app_ui = ui.page_fluid(
                            placeholder="Enter your search text here. Full natural language sentences are best",
                            width="100%",
                            height="100px"),
-        ui.column(2, ui.input_action_button("search", "Search"))
+        ui.column(2, ui.input_action_button("search", "Search")),
+        ui.column(4, ui.input_radio_buttons("search_mode",
+                                            None,
+                                            {VECTOR: "Semantic", LEXICAL: "Keywords (BM25)", HYBRID: "Hybrid"},
+                                            selected=VECTOR,
+                                            inline=True)) if lexical_index is not None else None
     ),
     ui.output_ui("search_results_output")
  )
@@ -32,40 +128,53 @@ app_ui = ui.page_fluid(
 
 def server(input: Inputs, output: Outputs, session: Session):
     search_results = reactive.value([])
+    # The trace of the last search, finished when its results have been rendered:
+    search_trace = {"trace": None, "params": None}
 
     @reactive.effect
     @reactive.event(input.search)
     def _():
         query = input.query()
-        query_embedding = embedding_model.encode(query, prompt_name="query").tolist()
-        sql = """
-                SELECT embedding <=> %s AS similarity,
-                    pubmed_articles.pmid,
-                    title,
-                    authors,
-                    journal_name,
-                    year,
-                    volume,
-                    issue,
-                    pagination
-                FROM public.vectors_snowflake_arctic_m_partitioned vectors
-                INNER JOIN public.pubmed_articles
-                    ON pubmed_articles.pmid = vectors.pmid
-                ORDER BY embedding <=> %s
-                LIMIT 25;
-                """
-        embedding_str = f"[{','.join(map(str, query_embedding))}]"
-        result = conn.execute(sql, (embedding_str, embedding_str))
-        similar_rows = result.fetchall()
-        search_results.set([{"similarity" : row[0],
-                             "pmid": row[1],
-                             "title":row[2],
-                             "authors": row[3],
-                             "journal": row[4],
-                             "year": row[5],
-                             "volume": row[6],
-                             "issue": row[7],
-                             "pagination": row[8]} for row in similar_rows])
+        search_mode = input.search_mode() if lexical_index is not None else VECTOR
+        trace = tracer.start()
+        similar_rows = []
+        params = None
+        if search_mode in [VECTOR, HYBRID]:
+            with trace.phase(EMBED):
+                query_embedding = embedding_model_future.result().encode(query, prompt_name="query").tolist()
+            embedding_str = f"[{','.join(map(str, query_embedding))}]"
+            params = (embedding_str, embedding_str, RESULT_COUNT if search_mode == VECTOR else HYBRID_CANDIDATES)
+            # The nearest neighbors are found first, and their metadata fetched separately, so both can be timed:
+            with trace.phase(ANN_SEARCH):
+                similar_rows = conn.execute(ANN_SQL, params).fetchall()
+        if search_mode == VECTOR:
+            scored_pmids = [(pmid, similarity) for similarity, pmid in similar_rows]
+        else:
+            with trace.phase(LEXICAL_SEARCH):
+                lexical_rows = lexical_index.search(query,
+                                                    limit=RESULT_COUNT if search_mode == LEXICAL else HYBRID_CANDIDATES)
+            if search_mode == LEXICAL:
+                scored_pmids = lexical_rows
+            else:
+                scored_pmids = reciprocal_rank_fusion([[row[1] for row in similar_rows],
+                                                       [row[0] for row in lexical_rows]],
+                                                      limit=RESULT_COUNT)
+        with trace.phase(METADATA_JOIN):
+            pmids = [pmid for pmid, _ in scored_pmids]
+            pmid_to_article = {row[0]: row for row in conn.execute(METADATA_SQL, (pmids,)).fetchall()}
+        search_trace["trace"] = trace
+        search_trace["params"] = params
+        search_results.set([{"score": score,
+                             "score_label": SCORE_LABELS[search_mode],
+                             "pmid": pmid,
+                             "title": pmid_to_article[pmid][1],
+                             "authors": pmid_to_article[pmid][2],
+                             "journal": pmid_to_article[pmid][3],
+                             "year": pmid_to_article[pmid][4],
+                             "volume": pmid_to_article[pmid][5],
+                             "issue": pmid_to_article[pmid][6],
+                             "pagination": pmid_to_article[pmid][7]}
+                            for pmid, score in scored_pmids if pmid in pmid_to_article])
 
     @output
     @render.ui
@@ -73,28 +182,43 @@ def server(input: Inputs, output: Outputs, session: Session):
         if not search_results:
             return ui.p("No results found.")
 
-        return ui.tags.ul(
-            *[
-                ui.tags.div(
-                    ui.h5(
-                        ui.a(
-                            f"{article['title']}",
-                            href=f"https://pubmed.ncbi.nlm.nih.gov/{article['pmid']}/",
-                            target="_blank"
-                        )
-                    ),
-                    ui.p(f"Authors: {article['authors']}"),
-                    ui.p(
-                        f"{article['journal']}, Vol. {article['volume']} (Issue {article['issue']}), "
-                        f"pp. {article['pagination']}, {article['year']}, PMID: {article['pmid']}"
-                    ),
-                    ui.p(f"Semantic distance: {article['similarity']:.3f}"),
-                    ui.hr()
-                )
-                for article in search_results.get()
-            ]
-        )
+        trace = search_trace["trace"]
+        if trace is None:
+            return _render_results(search_results.get())
+        with trace.phase(RENDER):
+            results_ui = _render_results(search_results.get())
+        # Only the nearest-neighbor query can be explained, so lexical searches are not. The query of a slow search is
+        # explained on a background thread with its own connection, so the page is not held up by running it again:
+        if search_trace["params"] is None:
+            tracer.finish(trace)
+        else:
+            tracer.finish(trace, statement=ANN_SQL, params=search_trace["params"], connect=_connect)
+        search_trace["trace"] = None
+        return results_ui
+
 
+def _render_results(articles):
+    return ui.tags.ul(
+        *[
+            ui.tags.div(
+                ui.h5(
+                    ui.a(
+                        f"{article['title']}",
+                        href=f"https://pubmed.ncbi.nlm.nih.gov/{article['pmid']}/",
+                        target="_blank"
+                    )
+                ),
+                ui.p(f"Authors: {article['authors']}"),
+                ui.p(
+                    f"{article['journal']}, Vol. {article['volume']} (Issue {article['issue']}), "
+                    f"pp. {article['pagination']}, {article['year']}, PMID: {article['pmid']}"
+                ),
+                ui.p(f"{article['score_label']}: {article['score']:.3f}"),
+                ui.hr()
+            )
+            for article in articles
+        ]
+    )
 
 
 app = App(app_ui, server, debug=False)
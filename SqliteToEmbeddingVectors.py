@@ -1,66 +1,272 @@
+import glob
 import logging
+import multiprocessing
 import os
 import sys
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Optional, Dict, Any, Tuple, Set
 
 import yaml
 import pyarrow as pa
 import pyarrow.parquet as pq
 from numpy import ndarray
 
-from PubMedSqliteIterator import fetch_pubmed_abstracts_for_embedding
+from AutotuneEmbedding import read_tuned_settings
+from EmbeddingTransform import EmbeddingTransform, TRANSFORM_FILE_NAME, SCALE_COLUMN, PCA, FLOAT32
+from PubMedSqliteIterator import fetch_pubmed_abstracts_for_embedding, fetch_pubmed_abstracts_by_pmid_range
+from ShardManifest import ShardManifest, shard_file_name, compute_source_checksum
+from TokenizedCorpus import TokenCache
 from TransformerEmbedder import TransformerEmbedder
 from SqliteToEmbeddingVectorsSettings import SqliteToEmbeddingVectorsSettings
+from Instrumentation import timer
 from Logging import open_log
+from Profiling import open_profiler
 
 def store_in_parquet(pmids: List[int],
                      embeddings: ndarray,
                      publication_dates: List[int],
-                     file_name: str):
+                     file_name: str,
+                     scales: Optional[ndarray] = None):
+    """
+    Writes the embeddings to a Parquet file, with one column per dimension in the dtype of the embeddings. The file is
+    written atomically.
+
+    :param scales: The per-vector scales of int8 embeddings, as returned by EmbeddingTransform.encode().
+    """
     pmid_array = pa.array(pmids)
     pub_date_array = pa.array(publication_dates)
     embedding_arrays = [pa.array(embeddings[:, i]) for i in range(embeddings.shape[1])]
+    names = ["pmid", "pub_date"] + [f"embedding_{i}" for i in range(embeddings.shape[1])]
+    if scales is not None:
+        embedding_arrays.append(pa.array(scales))
+        names.append(SCALE_COLUMN)
 
     table = pa.Table.from_arrays(
         arrays=[pmid_array, pub_date_array] + embedding_arrays,
-        names=["pmid", "pub_date"] + [f"embedding_{i}" for i in range(embeddings.shape[1])]
+        names=names
     )
-    pq.write_table(table, file_name)
+    # Written under a temporary name first, so a crash never leaves a partial file under the final name:
+    temp_file_name = f"{file_name}.tmp"
+    with timer("parquet_write", items=len(pmids)):
+        pq.write_table(table, temp_file_name)
+    os.replace(temp_file_name, file_name)
+
+
+def get_transform(settings: SqliteToEmbeddingVectorsSettings,
+                  embedder: TransformerEmbedder) -> Optional[EmbeddingTransform]:
+    """
+    Loads the transform saved in the Parquet folder, or creates it if this is the first run. A PCA projection is
+    fitted on the first pca_sample_size articles.
+    """
+    if settings.dimension_reduction is None and settings.output_dtype == FLOAT32:
+        return None
+    file_name = os.path.join(settings.parquet_folder, TRANSFORM_FILE_NAME)
+    if os.path.isfile(file_name):
+        transform = EmbeddingTransform.load(file_name)
+        if ((transform.method, transform.dimensions, transform.output_dtype) !=
+                (settings.dimension_reduction, settings.output_dimensions, settings.output_dtype)):
+            raise ValueError(f"The vectors in {settings.parquet_folder} were created with different dimension "
+                             f"reduction settings. Use a new parquet_folder")
+        return transform
+    sample = None
+    if settings.dimension_reduction == PCA:
+        logging.info(f"Fitting PCA with {settings.output_dimensions} components")
+        for records in fetch_pubmed_abstracts_for_embedding(settings.sqlite_path, settings.pca_sample_size):
+            sample = embedder.embed_documents([record[1] for record in records])
+            break
+    transform = EmbeddingTransform.fit(sample,
+                                       method=settings.dimension_reduction,
+                                       dimensions=settings.output_dimensions,
+                                       output_dtype=settings.output_dtype)
+    transform.save(file_name)
+    return transform
+
+
+def create_embedder(settings: SqliteToEmbeddingVectorsSettings, warm_up: bool = True) -> TransformerEmbedder:
+    return TransformerEmbedder(model_name=settings.embedding_model,
+                               embed_document_prompt=settings.embed_document_prompt,
+                               embed_query_prompt=settings.embed_query_prompt,
+                               embedding_batch_size=settings.embedding_batch_size,
+                               warm_up=warm_up,
+                               backend=settings.backend,
+                               quantize=settings.quantize,
+                               intra_op_threads=settings.intra_op_threads,
+                               token_budget=settings.token_budget,
+                               max_token_budget=settings.max_token_budget,
+                               max_memory_mb=settings.max_memory_mb)
+
+
+def embed_and_store(embedder: TransformerEmbedder,
+                    transform: Optional[EmbeddingTransform],
+                    records: List[tuple],
+                    file_name: str,
+                    tokens: Optional[Tuple[List[ndarray], ndarray]] = None):
+    """
+    :param tokens: The token IDs and lengths of the records, as returned by TokenCache.get(). If None, the texts are
+        tokenized.
+    """
+    if tokens is None:
+        logging.info("  Embedding")
+        embeddings = embedder.embed_documents([record[1] for record in records])
+    else:
+        logging.info("  Embedding cached token IDs")
+        embeddings = embedder.embed_token_ids(*tokens)
+    scales = None
+    if transform is not None:
+        embeddings, scales = transform.encode(embeddings)
+
+    logging.info("  Storing in Parquet")
+    pmids = [int(record[0]) for record in records]
+    publication_dates = [record[2] for record in records]
+    store_in_parquet(pmids=pmids,
+                     embeddings=embeddings,
+                     publication_dates=publication_dates,
+                     file_name=file_name,
+                     scales=scales)
+
+
+def create_shard_entry(settings: SqliteToEmbeddingVectorsSettings,
+                       pmid_start: int,
+                       pmid_end: int,
+                       records: List[tuple]) -> Dict[str, Any]:
+    """
+    :return: The manifest entry of a shard, without the file details.
+    """
+    return {"pmid_start": pmid_start,
+            "pmid_end": pmid_end,
+            "row_count": len(records),
+            "source_checksum": compute_source_checksum(records),
+            "embedding_model": settings.embedding_model,
+            "embed_document_prompt": settings.embed_document_prompt}
+
+
+# The embedder and transform of a replica process:
+_replica_embedder: Optional[TransformerEmbedder] = None
+_replica_transform: Optional[EmbeddingTransform] = None
+
+
+def _init_replica(settings: SqliteToEmbeddingVectorsSettings, transform: Optional[EmbeddingTransform]):
+    global _replica_embedder, _replica_transform
+    open_log(settings.log_path)
+    _replica_embedder = create_embedder(settings)
+    _replica_transform = transform
+
+
+def _embed_and_store_in_replica(records: List[tuple],
+                                file_name: str,
+                                tokens: Optional[Tuple[List[ndarray], ndarray]]):
+    embed_and_store(_replica_embedder, _replica_transform, records, file_name, tokens)
+
+
+def add_completed_shards(manifest: ShardManifest,
+                         futures: Dict[Future, Tuple[str, Dict[str, Any]]],
+                         done: Set[Future]):
+    """
+    Adds the shards of the completed futures to the manifest, and removes the futures. Raises the first error.
+    """
+    error = None
+    for future in done:
+        shard_name, entry = futures.pop(future)
+        if future.exception() is None:
+            manifest.add(shard_name, entry)
+        elif error is None:
+            error = future.exception()
+    manifest.save()
+    if error is not None:
+        raise error
+
+
+def open_token_cache(settings: SqliteToEmbeddingVectorsSettings) -> Optional[TokenCache]:
+    if settings.token_folder is None:
+        return None
+    return TokenCache(settings.token_folder, settings.embedding_model)
+
+
+def apply_tuned_settings(settings: SqliteToEmbeddingVectorsSettings):
+    tuned_settings = read_tuned_settings(settings.autotune_path,
+                                         embedding_model=settings.embedding_model,
+                                         backend=settings.backend,
+                                         quantize=settings.quantize)
+    if tuned_settings is not None:
+        logging.info(f"Using tuned settings from {settings.autotune_path}: {tuned_settings}")
+        for key, value in tuned_settings.items():
+            setattr(settings, key, value)
+
 
 def main(args: List[str]):
     with open(args[0]) as file:
         config = yaml.safe_load(file)
     settings = SqliteToEmbeddingVectorsSettings(config)
     open_log(settings.log_path)
-    embedder = TransformerEmbedder(model_name=settings.embedding_model,
-                                   embed_document_prompt=settings.embed_document_prompt,
-                                   embed_query_prompt=settings.embed_query_prompt,
-                                   embedding_batch_size=settings.embedding_batch_size)
+    if settings.autotune_path is not None:
+        apply_tuned_settings(settings)
+    if settings.replicas > 1 and settings.intra_op_threads is None:
+        # Otherwise each replica uses all cores, and they compete for them:
+        settings.intra_op_threads = max(1, (os.cpu_count() or 1) // settings.replicas)
 
     os.makedirs(settings.parquet_folder, exist_ok=True)
+    profiler = open_profiler("SqliteToEmbeddingVectors", config.get("profiling"))
 
-    total_count = 0
-
-    for records in fetch_pubmed_abstracts_for_embedding(settings.sqlite_path, settings.batch_size):
-        file_name = f"EmbeddingVectors{total_count + 1}_{total_count + len(records)}.parquet"
-        file_name = os.path.join(settings.parquet_folder, file_name)
-        if not os.path.isfile(file_name):
-            logging.info(f"- Processing records {total_count + 1} to {total_count + len(records)}")
-
-            logging.info("  Embedding")
-            abstracts = [record[1] for record in records]
-            embeddings = embedder.embed_documents(abstracts)
-
-            logging.info("  Storing in Parquet")
-            pmids = [int(record[0]) for record in records]
-            publication_dates = [record[2] for record in records]
+    # With replicas, this embedder is only loaded if a PCA projection needs to be fitted:
+    embedder = create_embedder(settings, warm_up=settings.replicas == 1)
+    transform = get_transform(settings, embedder)
+    if settings.replicas == 1:
+        executor = None
+    else:
+        logging.info(f"Embedding with {settings.replicas} replicas of {settings.intra_op_threads} threads each")
+        embedder = None
+        executor = ProcessPoolExecutor(max_workers=settings.replicas,
+                                       mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_replica,
+                                       initargs=(settings, transform))
+    manifest = ShardManifest(settings.parquet_folder)
+    token_cache = open_token_cache(settings)
+    for file_name in glob.glob(os.path.join(settings.parquet_folder, "*.tmp")):
+        # Left behind by a crash:
+        os.remove(file_name)
+    futures: Dict[Future, Tuple[str, Dict[str, Any]]] = {}
+    seen_shard_names = set()
+    embedded_count = 0
 
-            store_in_parquet(pmids=pmids,
-                             embeddings=embeddings,
-                             publication_dates=publication_dates,
-                             file_name=file_name)
+    try:
+        for pmid_start, pmid_end, records in fetch_pubmed_abstracts_by_pmid_range(settings.sqlite_path,
+                                                                                  settings.pmids_per_shard):
+            with profiler.batch():
+                shard_name = shard_file_name(pmid_start, pmid_end)
+                seen_shard_names.add(shard_name)
+                entry = create_shard_entry(settings, pmid_start, pmid_end, records)
+                if manifest.is_valid(shard_name, entry):
+                    continue
+                logging.info(f"- Processing PMIDs {pmid_start} to {pmid_end} ({len(records)} records)")
+                embedded_count += 1
+                file_name = os.path.join(settings.parquet_folder, shard_name)
+                tokens = token_cache.get(entry) if token_cache is not None else None
+                if executor is None:
+                    embed_and_store(embedder, transform, records, file_name, tokens)
+                    manifest.add(shard_name, entry)
+                    manifest.save()
+                else:
+                    # Limit the number of shards waiting in memory:
+                    if len(futures) >= 2 * settings.replicas:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        add_completed_shards(manifest, futures, done)
+                    future = executor.submit(_embed_and_store_in_replica, records, file_name, tokens)
+                    futures[future] = (shard_name, entry)
+    finally:
+        if executor is not None:
+            # Shards that were completed before a failure are still recorded, so they are not redone:
+            done, _ = wait(futures)
+            add_completed_shards(manifest, futures, done)
+            executor.shutdown()
 
-        total_count = total_count + len(records)
+    # Shards whose articles have all been deleted:
+    stale_shard_names = [shard_name for shard_name in manifest.shards if shard_name not in seen_shard_names]
+    for shard_name in stale_shard_names:
+        manifest.remove(shard_name)
+    manifest.save()
+    logging.info(f"Embedded {embedded_count} shards, {len(seen_shard_names) - embedded_count} were already up to "
+                 f"date, and {len(stale_shard_names)} were removed")
+    profiler.close()
 
 
 if __name__ == "__main__":
@@ -1,17 +1,40 @@
 from dataclasses import dataclass
 from typing import Optional, Dict, Any
 
+from EmbeddingTransform import TRUNCATE, PCA, FLOAT32, FLOAT16, INT8
+from ShardLeaseQueue import SQLITE, POSTGRES
+from TransformerEmbedder import TORCH_BACKEND, ONNX_BACKEND
+
 
 @dataclass
 class SqliteToEmbeddingVectorsSettings:
     sqlite_path: str
     log_path: str
     parquet_folder: str
-    batch_size: int
+    pmids_per_shard: int
     embedding_model: str
     embed_document_prompt: Optional[str]
     embed_query_prompt: Optional[str]
     embedding_batch_size: int
+    backend: str = TORCH_BACKEND
+    quantize: bool = False
+    intra_op_threads: Optional[int] = None
+    replicas: int = 1
+    autotune_path: Optional[str] = None
+    token_folder: Optional[str] = None
+    token_budget: Optional[int] = None
+    max_token_budget: Optional[int] = None
+    max_memory_mb: Optional[float] = None
+    dimension_reduction: Optional[str] = None
+    output_dimensions: Optional[int] = None
+    pca_sample_size: int = 10000
+    output_dtype: str = FLOAT32
+    queue_backend: str = SQLITE
+    queue_sqlite_path: Optional[str] = None
+    queue_table: str = "embedding_shard_leases"
+    lease_seconds: float = 600
+    heartbeat_seconds: float = 60
+    poll_seconds: float = 10
 
     def __init__(self, config: Optional[Dict[str, Any]] = None):
         if config is None:
@@ -24,4 +47,31 @@ class SqliteToEmbeddingVectorsSettings:
             setattr(self, key, value)
         model = config["model"]
         for key, value in model.items():
-            setattr(self, key, value)
\ No newline at end of file
+            setattr(self, key, value)
+        output = config.get("output") or {}
+        for key, value in output.items():
+            setattr(self, key, value)
+        work_queue = config.get("work_queue") or {}
+        for key, value in work_queue.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.backend not in [TORCH_BACKEND, ONNX_BACKEND]:
+            raise ValueError(f"model.backend must be '{TORCH_BACKEND}' or '{ONNX_BACKEND}', not '{self.backend}'")
+        if self.quantize and self.backend != ONNX_BACKEND:
+            raise ValueError(f"model.quantize is only supported by the '{ONNX_BACKEND}' backend")
+        if self.replicas < 1:
+            raise ValueError("model.replicas must be at least 1")
+        if self.max_memory_mb is not None and self.token_budget is None:
+            raise ValueError("model.max_memory_mb requires model.token_budget")
+        if self.dimension_reduction not in [None, TRUNCATE, PCA]:
+            raise ValueError(f"output.dimension_reduction must be '{TRUNCATE}', '{PCA}', or empty")
+        if self.dimension_reduction is not None and self.output_dimensions is None:
+            raise ValueError("output.output_dimensions must be set when reducing dimensions")
+        if self.output_dtype not in [FLOAT32, FLOAT16, INT8]:
+            raise ValueError(f"output.output_dtype must be '{FLOAT32}', '{FLOAT16}', or '{INT8}'")
+        if self.queue_backend not in [SQLITE, POSTGRES]:
+            raise ValueError(f"work_queue.queue_backend must be '{SQLITE}' or '{POSTGRES}'")
+        if self.heartbeat_seconds >= self.lease_seconds:
+            raise ValueError("work_queue.heartbeat_seconds must be less than work_queue.lease_seconds")
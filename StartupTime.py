@@ -0,0 +1,94 @@
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Dict, Any, Tuple
+
+# Entry points that do not embed anything should start in less than this many seconds:
+TARGET_SECONDS = 1.0
+
+_MAIN_GUARD = 'if __name__ == "__main__":'
+
+# Modules that should only be imported when a model is actually loaded:
+_HEAVY_MODULES = ["torch", "sentence_transformers", "transformers"]
+
+
+def find_entry_points() -> List[str]:
+    """
+    Finds the entry points: the modules in the repository root that can be run as a script, except this one. Found
+    rather than listed, so scripts added later are measured too.
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    entry_points = []
+    for file_name in sorted(glob.glob(os.path.join(folder, "*.py"))):
+        module = os.path.splitext(os.path.basename(file_name))[0]
+        if module == "StartupTime":
+            continue
+        with open(file_name, encoding="utf-8") as file:
+            if any(line.startswith(_MAIN_GUARD) for line in file):
+                entry_points.append(module)
+    return entry_points
+
+
+def _parse_import_times(stderr: str, top_n: int) -> List[Tuple[str, float]]:
+    """
+    Parses the output of python -X importtime, and returns the modules imported directly by the entry point with the
+    highest cumulative time (in seconds).
+    """
+    import_times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented by two spaces per level. The entry point itself is at level 0:
+        name = name[1:]
+        if (len(name) - len(name.lstrip())) // 2 != 1:
+            continue
+        import_times.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(import_times, key=lambda import_time: import_time[1], reverse=True)[:top_n]
+
+
+def measure_startup(module: str, repeats: int = 3, top_n: int = 5) -> Dict[str, Any]:
+    """
+    Measures how long it takes to start a new Python process and import an entry point, which is the time before its
+    main function can start.
+
+    :param module: The name of the entry point module.
+    :param repeats: The number of times to measure. The median is reported.
+    :param top_n: The number of slowest imports to report.
+    :return: A dictionary with the median wall time in seconds, the slowest imports, and whether any of the heavy
+    modules (torch, sentence_transformers) were imported.
+    """
+    code = (f"import sys; import {module}; "
+            f"print(any(name in sys.modules for name in {_HEAVY_MODULES}))")
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                 capture_output=True,
+                                 text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+    return {"module": module,
+            "seconds": statistics.median(seconds),
+            "imports_heavy_modules": process.stdout.strip() == "True",
+            "slowest_imports": _parse_import_times(process.stderr, top_n)}
+
+
+def main(args: List[str]):
+    modules = args if len(args) > 0 else find_entry_points()
+    for module in modules:
+        result = measure_startup(module)
+        status = "OK" if result["seconds"] < TARGET_SECONDS else "ABOVE TARGET"
+        heavy = ", imports torch/sentence_transformers" if result["imports_heavy_modules"] else ""
+        print(f"{module}: {result['seconds']:.2f} seconds ({status}{heavy})")
+        for name, import_seconds in result["slowest_imports"]:
+            print(f"    {name}: {import_seconds:.3f} seconds")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
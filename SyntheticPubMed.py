@@ -0,0 +1,340 @@
+import gzip
+import logging
+import math
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
+from xml.sax.saxutils import escape
+
+import numpy as np
+import yaml
+
+from Logging import open_log
+
+# Real PubMed vocabulary is roughly Zipfian. The most frequent words are taken from this list, the long tail is made of
+# random syllables:
+_COMMON_WORDS = [
+    "the", "of", "and", "in", "to", "a", "with", "for", "was", "were", "patients", "is", "by", "on", "that", "as",
+    "are", "study", "from", "at", "or", "treatment", "this", "be", "an", "results", "between", "we", "these", "cells",
+    "disease", "clinical", "associated", "after", "increased", "analysis", "risk", "using", "data", "not", "expression",
+    "which", "group", "compared", "than", "but", "effect", "both", "significantly", "higher", "cancer", "methods",
+    "conclusions", "background", "has", "two", "cell", "protein", "may", "levels", "showed", "all", "during", "years",
+    "model", "gene", "function", "also", "factors", "significant", "therapy", "have", "control", "health", "response",
+    "time", "its", "age", "high", "infection", "studies", "observed", "patient", "activity", "outcomes", "blood",
+    "human", "identified", "role", "children", "tumor", "mice", "however", "growth", "care", "reduced", "potential",
+]
+_SYLLABLES = ["ab", "ac", "al", "an", "ar", "bi", "bro", "car", "cy", "de", "di", "en", "ep", "er", "fi", "gen", "hy",
+              "in", "ka", "lo", "ma", "me", "mi", "mo", "na", "ne", "ni", "no", "ol", "on", "or", "os", "pa", "pe",
+              "phy", "po", "pro", "ra", "re", "ri", "ro", "sa", "se", "si", "ta", "te", "ti", "to", "tra", "tu", "um",
+              "ur", "va", "ve", "vi", "xy", "zo"]
+_ABSTRACT_LABELS = ["BACKGROUND", "OBJECTIVE", "METHODS", "RESULTS", "CONCLUSIONS"]
+_MESH_TERMS = [
+    "Humans", "Female", "Male", "Adult", "Middle Aged", "Aged", "Animals", "Adolescent", "Child", "Young Adult",
+    "Mice", "Retrospective Studies", "Treatment Outcome", "Risk Factors", "Prospective Studies", "Cohort Studies",
+    "Rats", "Child, Preschool", "Infant", "Cross-Sectional Studies", "Aged, 80 and over", "Time Factors",
+    "Surveys and Questionnaires", "Prognosis", "Signal Transduction", "Cell Line, Tumor", "Mice, Inbred C57BL",
+    "Follow-Up Studies", "Pregnancy", "Incidence", "Prevalence", "Severity of Illness Index", "Disease Models, Animal",
+    "Apoptosis", "Cell Proliferation", "Infant, Newborn", "Case-Control Studies", "Brain", "Mutation",
+    "Quality of Life",
+]
+_CHEMICALS = ["Biomarkers", "RNA, Messenger", "Antineoplastic Agents", "Anti-Bacterial Agents", "Glucose", "Insulin",
+              "Reactive Oxygen Species", "Tumor Necrosis Factor-alpha", "Cytokines", "DNA", "Calcium", "Oxygen",
+              "Water", "Sodium Chloride", "Interleukin-6", "Ethanol", "Cholesterol", "Proteins"]
+_PUBLICATION_TYPES = [("D016428", "Journal Article"), ("D016454", "Review"),
+                      ("D016449", "Randomized Controlled Trial"), ("D002363", "Case Reports"),
+                      ("D013485", "Research Support, Non-U.S. Gov't"), ("D017418", "Meta-Analysis")]
+_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+_SEASONS = ["Spring", "Summer", "Fall", "Winter"]
+
+
+@dataclass
+class SyntheticPubMedSettings:
+    """
+    Settings for generating a synthetic PubMed corpus, from the 'synthetic' section of a YAML file. Lengths and counts
+    are drawn per article: abstract lengths (in words) from a log-normal distribution, the other counts from Poisson
+    distributions.
+    """
+    seed: int = 42
+    file_prefix: str = "pubmed25n"
+    first_pmid: int = 30000000
+    baseline_files: int = 2
+    articles_per_baseline_file: int = 1000
+    update_files: int = 1
+    articles_per_update_file: int = 200
+    # Fraction of the articles in update files that are revisions of existing articles:
+    revised_fraction: float = 0.5
+    deletions_per_update_file: int = 20
+    abstract_words_mean: float = 220
+    abstract_words_sd: float = 90
+    missing_abstract_fraction: float = 0.15
+    structured_abstract_fraction: float = 0.3
+    title_words_mean: float = 14
+    mesh_terms_mean: float = 10
+    # Articles that are not yet indexed for MEDLINE have no MeSH terms:
+    missing_mesh_fraction: float = 0.2
+    keywords_mean: float = 3
+    chemicals_mean: float = 2
+    authors_mean: float = 6
+    collective_author_fraction: float = 0.02
+    # Fraction of articles with a MedlineDate (for example '1998 Dec-1999 Jan') instead of Year/Month/Day:
+    medline_date_fraction: float = 0.05
+    # Fraction of articles with a PMID version other than 1, which are skipped when parsing:
+    other_version_fraction: float = 0.01
+    vocabulary_size: int = 20000
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is not None:
+            for key, value in config.items():
+                setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.baseline_files < 1:
+            raise ValueError("synthetic.baseline_files must be at least 1")
+        if self.deletions_per_update_file > self.articles_per_baseline_file * self.baseline_files:
+            raise ValueError("synthetic.deletions_per_update_file cannot exceed the number of baseline articles")
+
+
+class _TextGenerator:
+    def __init__(self, rng: np.random.Generator, vocabulary_size: int):
+        self.rng = rng
+        vocabulary = list(_COMMON_WORDS)
+        while len(vocabulary) < vocabulary_size:
+            syllable_count = rng.integers(2, 6)
+            vocabulary.append("".join(rng.choice(_SYLLABLES, size=syllable_count)))
+        self.vocabulary = np.asarray(vocabulary, dtype=object)
+        weights = 1.0 / (np.arange(len(vocabulary)) + 2.7)
+        # Sampling by bisecting the cumulative distribution is much faster than rng.choice(p=...) for small samples:
+        self.cumulative_probabilities = np.cumsum(weights / weights.sum())
+
+    def words(self, count: int) -> List[str]:
+        indices = np.searchsorted(self.cumulative_probabilities,
+                                  self.rng.random(count) * self.cumulative_probabilities[-1])
+        return self.vocabulary[indices].tolist()
+
+    def sentences(self, word_count: int) -> str:
+        words = self.words(word_count)
+        sentences = []
+        start = 0
+        while start < len(words):
+            end = start + int(self.rng.integers(8, 30))
+            sentence = " ".join(words[start:end])
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+            start = end
+        return " ".join(sentences)
+
+    def name(self) -> str:
+        return "".join(self.rng.choice(_SYLLABLES, size=int(self.rng.integers(2, 4)))).capitalize()
+
+
+class _ArticleWriter:
+    def __init__(self, settings: SyntheticPubMedSettings, rng: np.random.Generator):
+        self.settings = settings
+        self.rng = rng
+        self.text = _TextGenerator(rng, settings.vocabulary_size)
+        sd = settings.abstract_words_sd / settings.abstract_words_mean
+        self.abstract_sigma = math.sqrt(math.log(1 + sd ** 2))
+        self.abstract_mu = math.log(settings.abstract_words_mean) - self.abstract_sigma ** 2 / 2
+        self.journals = [(self.text.name() + " " + self.text.name(), self.text.name()[:4] + ". " + self.text.name())
+                         for _ in range(200)]
+
+    def _poisson(self, mean: float) -> int:
+        return int(self.rng.poisson(mean))
+
+    def _pub_date(self) -> str:
+        year = int(self.rng.integers(1950, 2026))
+        if self.rng.random() < self.settings.medline_date_fraction:
+            variant = self.rng.integers(4)
+            if variant == 0:
+                medline_date = f"{year} {_MONTHS[self.rng.integers(11)]}-{_MONTHS[11]}"
+            elif variant == 1:
+                medline_date = f"{year} Dec-{year + 1} Jan"
+            elif variant == 2:
+                medline_date = f"{year} {_SEASONS[self.rng.integers(4)]}"
+            else:
+                medline_date = f"{year}-{year + 1}"
+            return f"<MedlineDate>{medline_date}</MedlineDate>"
+        variant = self.rng.integers(4)
+        if variant == 0:
+            return f"<Year>{year}</Year>"
+        if variant == 1:
+            return f"<Year>{year}</Year><Season>{_SEASONS[self.rng.integers(4)]}</Season>"
+        if variant == 2:
+            return f"<Year>{year}</Year><Month>{_MONTHS[self.rng.integers(12)]}</Month>"
+        return (f"<Year>{year}</Year><Month>{_MONTHS[self.rng.integers(12)]}</Month>"
+                f"<Day>{self.rng.integers(1, 29)}</Day>")
+
+    def _abstract(self) -> str:
+        if self.rng.random() < self.settings.missing_abstract_fraction:
+            return ""
+        word_count = max(10, int(self.rng.lognormal(self.abstract_mu, self.abstract_sigma)))
+        if self.rng.random() < self.settings.structured_abstract_fraction:
+            section_words = max(2, word_count // len(_ABSTRACT_LABELS))
+            sections = "".join(f'<AbstractText Label="{label}" NlmCategory="{label}">'
+                               f"{escape(self.text.sentences(section_words))}</AbstractText>"
+                               for label in _ABSTRACT_LABELS)
+        else:
+            sections = f"<AbstractText>{escape(self.text.sentences(word_count))}</AbstractText>"
+        return f"<Abstract>{sections}</Abstract>"
+
+    def _authors(self) -> str:
+        authors = []
+        for _ in range(self._poisson(self.settings.authors_mean)):
+            if self.rng.random() < self.settings.collective_author_fraction:
+                authors.append(f'<Author ValidYN="Y"><CollectiveName>{self.text.name()} Study Group</CollectiveName>'
+                               "</Author>")
+            else:
+                fore_name = self.text.name()
+                authors.append(f'<Author ValidYN="Y"><LastName>{self.text.name()}</LastName>'
+                               f"<ForeName>{fore_name}</ForeName><Initials>{fore_name[0]}</Initials></Author>")
+        if len(authors) == 0:
+            return ""
+        return f'<AuthorList CompleteYN="Y">{"".join(authors)}</AuthorList>'
+
+    def _mesh_terms(self) -> str:
+        if self.rng.random() < self.settings.missing_mesh_fraction:
+            return ""
+        count = min(self._poisson(self.settings.mesh_terms_mean), len(_MESH_TERMS))
+        if count == 0:
+            return ""
+        headings = "".join(f'<MeshHeading><DescriptorName UI="D{index:06d}" MajorTopicYN="N">'
+                           f"{escape(_MESH_TERMS[index])}</DescriptorName></MeshHeading>"
+                           for index in self.rng.choice(len(_MESH_TERMS), size=count, replace=False))
+        return f"<MeshHeadingList>{headings}</MeshHeadingList>"
+
+    def _chemicals(self) -> str:
+        count = min(self._poisson(self.settings.chemicals_mean), len(_CHEMICALS))
+        if count == 0:
+            return ""
+        chemicals = "".join(f'<Chemical><RegistryNumber>0</RegistryNumber><NameOfSubstance UI="D{index:06d}">'
+                            f"{escape(_CHEMICALS[index])}</NameOfSubstance></Chemical>"
+                            for index in self.rng.choice(len(_CHEMICALS), size=count, replace=False))
+        return f"<ChemicalList>{chemicals}</ChemicalList>"
+
+    def _keywords(self) -> str:
+        count = self._poisson(self.settings.keywords_mean)
+        if count == 0:
+            return ""
+        keywords = "".join(f'<Keyword MajorTopicYN="N">{" ".join(self.text.words(int(self.rng.integers(1, 4))))}'
+                           "</Keyword>"
+                           for _ in range(count))
+        return f'<KeywordList Owner="NOTNLM">{keywords}</KeywordList>'
+
+    def _publication_types(self) -> str:
+        types = [_PUBLICATION_TYPES[0]]
+        if self.rng.random() < 0.3:
+            types.append(_PUBLICATION_TYPES[int(self.rng.integers(1, len(_PUBLICATION_TYPES)))])
+        return "<PublicationTypeList>" + "".join(f'<PublicationType UI="{ui}">{name}</PublicationType>'
+                                                 for ui, name in types) + "</PublicationTypeList>"
+
+    def article(self, pmid: int, version: int) -> str:
+        journal_title, iso_abbreviation = self.journals[int(self.rng.integers(len(self.journals)))]
+        title = self.text.sentences(max(3, self._poisson(self.settings.title_words_mean)))
+        first_page = int(self.rng.integers(1, 2000))
+        return (f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM">'
+                f'<PMID Version="{version}">{pmid}</PMID>'
+                f'<Article PubModel="Print"><Journal><ISSN IssnType="Print">0000-0000</ISSN>'
+                f'<JournalIssue CitedMedium="Print"><Volume>{self.rng.integers(1, 200)}</Volume>'
+                f"<Issue>{self.rng.integers(1, 13)}</Issue><PubDate>{self._pub_date()}</PubDate></JournalIssue>"
+                f"<Title>{journal_title}</Title><ISOAbbreviation>{iso_abbreviation}</ISOAbbreviation></Journal>"
+                f"<ArticleTitle>{escape(title)}</ArticleTitle>"
+                f"<Pagination><MedlinePgn>{first_page}-{first_page + self.rng.integers(1, 20)}</MedlinePgn>"
+                f"</Pagination>{self._abstract()}{self._authors()}<Language>eng</Language>"
+                f"{self._publication_types()}</Article>"
+                f"<MedlineJournalInfo><Country>United States</Country><MedlineTA>{iso_abbreviation}</MedlineTA>"
+                f"</MedlineJournalInfo>{self._chemicals()}{self._mesh_terms()}{self._keywords()}</MedlineCitation>"
+                f"<PubmedData><PublicationStatus>ppublish</PublicationStatus><ArticleIdList>"
+                f'<ArticleId IdType="pubmed">{pmid}</ArticleId></ArticleIdList></PubmedData></PubmedArticle>\n')
+
+
+def _write_file(file_path: str, articles: List[str], delete_pmids: List[int]):
+    temp_file_path = f"{file_path}.tmp"
+    with gzip.open(temp_file_path, "wt", encoding="utf-8", compresslevel=1) as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2025//EN" '
+                '"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_250101.dtd">\n'
+                "<PubmedArticleSet>\n")
+        f.writelines(articles)
+        if len(delete_pmids) > 0:
+            f.write("<DeleteCitation>\n")
+            f.writelines(f'<PMID Version="1">{pmid}</PMID>\n' for pmid in delete_pmids)
+            f.write("</DeleteCitation>\n")
+        f.write("</PubmedArticleSet>\n")
+    os.replace(temp_file_path, file_path)
+
+
+def generate_corpus(settings: SyntheticPubMedSettings, xml_folder: str) -> Dict[str, int]:
+    """
+    Writes synthetic baseline and update files in the PubMed XML format. The baseline files contain new articles, the
+    update files (numbered after the baseline files) contain new articles, revisions of existing articles, and
+    deletions. The output is deterministic given the seed.
+
+    :param settings: The settings of the synthetic corpus.
+    :param xml_folder: The folder to write the xml.gz files to.
+    :return: A dictionary with the number of files, articles, and deleted articles, and the number of articles that
+    should be in the database after processing all files.
+    """
+    os.makedirs(xml_folder, exist_ok=True)
+    rng = np.random.default_rng(settings.seed)
+    writer = _ArticleWriter(settings, rng)
+    next_pmid = settings.first_pmid
+    # PMIDs (with version 1) that are currently in the corpus:
+    live_pmids = []
+    deleted_count = 0
+    article_count = 0
+
+    def new_articles(count: int) -> List[str]:
+        nonlocal next_pmid
+        articles = []
+        for _ in range(count):
+            if rng.random() < settings.other_version_fraction:
+                articles.append(writer.article(next_pmid, 2))
+            else:
+                articles.append(writer.article(next_pmid, 1))
+                live_pmids.append(next_pmid)
+            next_pmid += 1
+        return articles
+
+    file_count = settings.baseline_files + settings.update_files
+    for file_number in range(1, file_count + 1):
+        file_name = f"{settings.file_prefix}{file_number:04d}.xml.gz"
+        logging.info(f"Generating {file_name}")
+        if file_number <= settings.baseline_files:
+            articles = new_articles(settings.articles_per_baseline_file)
+            delete_pmids = []
+        else:
+            revised_count = min(int(settings.articles_per_update_file * settings.revised_fraction), len(live_pmids))
+            chosen = rng.choice(len(live_pmids),
+                                size=revised_count + min(settings.deletions_per_update_file,
+                                                         len(live_pmids) - revised_count),
+                                replace=False)
+            revised_pmids = [live_pmids[index] for index in chosen[:revised_count]]
+            delete_pmids = sorted(live_pmids[index] for index in chosen[revised_count:])
+            articles = [writer.article(pmid, 1) for pmid in revised_pmids]
+            articles.extend(new_articles(settings.articles_per_update_file - revised_count))
+            deleted = set(delete_pmids)
+            live_pmids = [pmid for pmid in live_pmids if pmid not in deleted]
+            deleted_count += len(delete_pmids)
+        article_count += len(articles)
+        _write_file(os.path.join(xml_folder, file_name), articles, delete_pmids)
+    counts = {"files": file_count,
+              "articles": article_count,
+              "deleted": deleted_count,
+              "expected_rows": len(live_pmids)}
+    logging.info(f"Generated {counts}")
+    return counts
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    open_log(config["system"]["log_path"])
+    generate_corpus(SyntheticPubMedSettings(config.get("synthetic")), config["system"]["xml_folder"])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
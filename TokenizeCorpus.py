@@ -0,0 +1,89 @@
+import glob
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Optional, Dict, Any, Tuple
+
+import yaml
+
+from Logging import open_log
+from PubMedSqliteIterator import fetch_pubmed_abstracts_by_pmid_range
+from ShardManifest import ShardManifest
+from SqliteToEmbeddingVectors import create_shard_entry, add_completed_shards
+from TokenizeCorpusSettings import TokenizeCorpusSettings
+from TokenizedCorpus import get_token_folder, token_shard_file_name, write_token_shard
+from TransformerEmbedder import TransformerEmbedder
+
+# The embedder of a tokenizer process. Only its tokenizer is loaded, not the model:
+_embedder: Optional[TransformerEmbedder] = None
+
+
+def _init_tokenizer(settings: TokenizeCorpusSettings):
+    global _embedder
+    open_log(settings.log_path)
+    _embedder = TransformerEmbedder(model_name=settings.embedding_model,
+                                    embed_document_prompt=settings.embed_document_prompt,
+                                    backend=settings.backend)
+
+
+def _tokenize_shard(records: List[tuple], file_name: str):
+    input_ids = _embedder.tokenize_documents([record[1] for record in records])
+    write_token_shard([int(record[0]) for record in records], input_ids, file_name)
+
+
+def main(args: List[str]):
+    with open(args[0]) as file:
+        config = yaml.safe_load(file)
+    settings = TokenizeCorpusSettings(config)
+    open_log(settings.log_path)
+
+    folder = get_token_folder(settings.token_folder, settings.embedding_model)
+    os.makedirs(folder, exist_ok=True)
+    manifest = ShardManifest(folder)
+    for file_name in glob.glob(os.path.join(folder, "*.tmp")):
+        # Left behind by a crash:
+        os.remove(file_name)
+    num_workers = settings.num_workers if settings.num_workers is not None else os.cpu_count() or 1
+    logging.info(f"Tokenizing with {num_workers} processes into {folder}")
+    executor = ProcessPoolExecutor(max_workers=num_workers,
+                                   mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_tokenizer,
+                                   initargs=(settings,))
+    futures: Dict[Future, Tuple[str, Dict[str, Any]]] = {}
+    seen_shard_names = set()
+    tokenized_count = 0
+
+    try:
+        for pmid_start, pmid_end, records in fetch_pubmed_abstracts_by_pmid_range(settings.sqlite_path,
+                                                                                  settings.pmids_per_shard):
+            shard_name = token_shard_file_name(pmid_start, pmid_end)
+            seen_shard_names.add(shard_name)
+            entry = create_shard_entry(settings, pmid_start, pmid_end, records)
+            if manifest.is_valid(shard_name, entry):
+                continue
+            tokenized_count += 1
+            # Limit the number of shards waiting in memory:
+            if len(futures) >= 2 * num_workers:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                add_completed_shards(manifest, futures, done)
+            futures[executor.submit(_tokenize_shard, records, os.path.join(folder, shard_name))] = (shard_name, entry)
+    finally:
+        done, _ = wait(futures)
+        add_completed_shards(manifest, futures, done)
+        executor.shutdown()
+
+    stale_shard_names = [shard_name for shard_name in manifest.shards if shard_name not in seen_shard_names]
+    for shard_name in stale_shard_names:
+        manifest.remove(shard_name)
+    manifest.save()
+    logging.info(f"Tokenized {tokenized_count} shards, {len(seen_shard_names) - tokenized_count} were already up to "
+                 f"date, and {len(stale_shard_names)} were removed")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise Exception("Must provide path to yaml file as argument")
+    else:
+        main(sys.argv[1:])
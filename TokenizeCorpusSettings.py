@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+
+from TransformerEmbedder import TORCH_BACKEND, ONNX_BACKEND
+
+
+@dataclass
+class TokenizeCorpusSettings:
+    sqlite_path: str
+    token_folder: str
+    log_path: str
+    pmids_per_shard: int
+    embedding_model: str
+    embed_document_prompt: Optional[str]
+    num_workers: Optional[int] = None
+    backend: str = TORCH_BACKEND
+
+    def __init__(self, config: Optional[Dict[str, Any]] = None):
+        if config is None:
+            return
+        system = config["system"]
+        for key, value in system.items():
+            setattr(self, key, value)
+        processing = config["processing"]
+        for key, value in processing.items():
+            setattr(self, key, value)
+        model = config["model"]
+        for key, value in model.items():
+            setattr(self, key, value)
+        self.__post_init__()
+
+    def __post_init__(self):
+        if self.backend not in [TORCH_BACKEND, ONNX_BACKEND]:
+            raise ValueError(f"model.backend must be '{TORCH_BACKEND}' or '{ONNX_BACKEND}', not '{self.backend}'")
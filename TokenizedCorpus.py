@@ -0,0 +1,84 @@
+import itertools
+import os
+from typing import List, Sequence, Tuple, Optional, Dict, Any
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from numpy import ndarray
+
+from Instrumentation import timer, count
+from ShardManifest import ShardManifest, shard_file_name
+
+TOKEN_SHARD_PREFIX = "TokenIds"
+
+
+def get_token_folder(token_folder: str, model_name: str) -> str:
+    """
+    :return: The folder holding the token IDs of a model. Each model (tokenizer) gets its own folder.
+    """
+    return os.path.join(token_folder, model_name.replace("/", "__"))
+
+
+def token_shard_file_name(pmid_start: int, pmid_end: int) -> str:
+    return shard_file_name(pmid_start, pmid_end, prefix=TOKEN_SHARD_PREFIX)
+
+
+def write_token_shard(pmids: List[int], input_ids: List[Sequence[int]], file_name: str):
+    """
+    Writes the token IDs of a shard to a Parquet file, as a list column, together with the number of tokens of each
+    document. The file is written atomically.
+    """
+    lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int32, count=len(input_ids))
+    offsets = np.zeros(len(input_ids) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.int32, count=int(offsets[-1]))
+    table = pa.Table.from_arrays(
+        arrays=[pa.array(pmids, type=pa.int64()),
+                pa.ListArray.from_arrays(pa.array(offsets), pa.array(values)),
+                pa.array(lengths)],
+        names=["pmid", "input_ids", "length"]
+    )
+    temp_file_name = f"{file_name}.tmp"
+    with timer("parquet_write", items=len(pmids)):
+        pq.write_table(table, temp_file_name)
+    os.replace(temp_file_name, file_name)
+
+
+def read_token_shard(file_name: str) -> Tuple[ndarray, List[ndarray], ndarray]:
+    """
+    :return: A tuple of 3: the PMIDs, the token IDs of each document, and the number of tokens of each document.
+    """
+    table = pq.read_table(file_name)
+    input_ids = table.column("input_ids").combine_chunks()
+    offsets = input_ids.offsets.to_numpy()
+    values = input_ids.values.to_numpy()[offsets[0]:offsets[-1]]
+    return (table.column("pmid").to_numpy(),
+            np.split(values, offsets[1:-1] - offsets[0]),
+            table.column("length").to_numpy())
+
+
+class TokenCache:
+    """
+    Looks up the token IDs of shards written by TokenizeCorpus, so they do not have to be tokenized again.
+
+    :param token_folder: The token_folder used by TokenizeCorpus.
+    :param model_name: The embedding model. The token IDs are only used if they were created with its tokenizer.
+    """
+
+    def __init__(self, token_folder: str, model_name: str):
+        self.manifest = ShardManifest(get_token_folder(token_folder, model_name))
+
+    def get(self, entry: Dict[str, Any]) -> Optional[Tuple[List[ndarray], ndarray]]:
+        """
+        :param entry: The manifest entry of the shard, which must match the entry of the token shard, so the token IDs
+            are only used if the articles, the model, and the prompt are unchanged.
+        :return: The token IDs and the number of tokens of each document, or None if the shard is not in the cache.
+        """
+        shard_name = token_shard_file_name(entry["pmid_start"], entry["pmid_end"])
+        if not self.manifest.is_valid(shard_name, entry):
+            count("token_cache", result="miss")
+            return None
+        count("token_cache", result="hit")
+        _, input_ids, lengths = read_token_shard(os.path.join(self.manifest.folder, shard_name))
+        return input_ids, lengths
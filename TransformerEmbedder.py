@@ -1,9 +1,68 @@
-from typing import List, Optional
+import json
+import logging
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Dict, Any, TYPE_CHECKING
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+import numpy as np
 from numpy import ndarray
-from sentence_transformers import SentenceTransformer
+
+from AdaptiveBatching import AdaptiveBatcher
+from EmbeddingTransform import EmbeddingTransform
+from Instrumentation import timer
+
+if TYPE_CHECKING:
+    # Importing sentence_transformers (and torch) takes seconds, so it is only imported when the model is loaded:
+    from sentence_transformers import SentenceTransformer
+    from OnnxSentenceEncoder import OnnxSentenceEncoder
+
+MODEL_CACHE_ENV_VAR = "RAGPLAYGROUND_MODEL_CACHE"
+# Where ONNX exports are kept if no model cache folder is set:
+DEFAULT_ONNX_CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".cache", "ragplayground")
+
+# The files of a saved SentenceTransformer model with the prompts and the maximum sequence length:
+SENTENCE_TRANSFORMERS_CONFIG_FILE_NAME = "config_sentence_transformers.json"
+SENTENCE_BERT_CONFIG_FILE_NAME = "sentence_bert_config.json"
+
+
+@dataclass
+class Tokenization:
+    """
+    What is needed to tokenize documents the way the model does.
+    """
+    tokenizer: Any
+    prompts: Dict[str, str]
+    default_prompt_name: Optional[str]
+    max_seq_length: int
+
+
+def _read_model_file(model_name_or_path: str, file_name: str) -> Optional[Dict[str, Any]]:
+    """
+    Reads a JSON file of a saved model, or downloads it from the Hugging Face Hub.
+
+    :return: The contents of the file, or None if the model does not have it.
+    """
+    if os.path.isdir(model_name_or_path):
+        file_path = os.path.join(model_name_or_path, file_name)
+        if not os.path.isfile(file_path):
+            return None
+    else:
+        from huggingface_hub import hf_hub_download
+        from huggingface_hub.utils import EntryNotFoundError
+
+        try:
+            file_path = hf_hub_download(model_name_or_path, file_name)
+        except EntryNotFoundError:
+            return None
+    with open(file_path) as file:
+        return json.load(file)
+
+TORCH_BACKEND = "torch"
+ONNX_BACKEND = "onnx"
 
 
 class TransformerEmbedder:
@@ -12,16 +71,37 @@ class TransformerEmbedder:
 
         The `TransformerEmbedder` class utilizes the `SentenceTransformer` model to encode texts (documents or queries) into vector embeddings. This is useful for various natural language processing tasks such as semantic search, clustering, and classification.
 
+        The model is not loaded until it is first used, so creating an embedder is cheap. Call `warm_up()` to load it in
+        a background thread while doing other work. If a model cache folder is set (or the RAGPLAYGROUND_MODEL_CACHE
+        environmental variable), the model is saved there in safetensors format after the first download, and later
+        loaded from there, which avoids contacting the Hugging Face Hub and memory-maps the weights.
+
+        With backend="onnx", the model is exported to ONNX once (in the model cache folder), optionally quantized to
+        int8, and run with ONNX Runtime, which is usually considerably faster on CPUs than PyTorch.
+
         Attributes:
         -----------
         model : SentenceTransformer
-            The transformer model used for generating embeddings.
+            The transformer model used for generating embeddings. Loaded on first access.
         embed_document_prompt : Optional[str]
             The prompt used by the model when embedding documents. If None, the model's default document embedding prompt is used.
         embed_query_prompt : Optional[str]
             The prompt used by the model when embedding queries. Defaults to "query".
         embedding_batch_size : int
             The batch size for embedding texts. Larger batch sizes may improve throughput but require more memory.
+        backend : str
+            "torch" to run the model with PyTorch, or "onnx" to run it with ONNX Runtime.
+        quantize : bool
+            Use dynamic int8 quantization. Only used by the ONNX backend.
+        intra_op_threads : Optional[int]
+            The number of threads used within an operator by PyTorch or ONNX Runtime. If None, the library default is
+            used (one thread per physical core).
+        transform : Optional[EmbeddingTransform]
+            If provided, the dimensions of all embeddings are reduced with this transform. Use the transform the
+            document vectors were stored with, so queries and documents are in the same space.
+        batcher : Optional[AdaptiveBatcher]
+            If token_budget is provided, documents are batched by a number of tokens instead of embedding_batch_size,
+            and the budget is adapted to keep the memory use of the process under max_memory_mb.
 
         Methods:
         --------
@@ -50,24 +130,273 @@ class TransformerEmbedder:
             --------
             List[float]
                 A list representing the embedding vector for the query.
+
+        embed_queries(queries: List[str]) -> ndarray:
+            Generates embeddings for a list of query strings in a single batched call.
+
+            Parameters:
+            -----------
+            queries : List[str]
+                The query strings to be embedded.
+
+            Returns:
+            --------
+            ndarray
+                A NumPy array of embeddings corresponding to the input queries.
         """
     def __init__(self,
                  model_name: str = "Snowflake/snowflake-arctic-embed-s",
                  embed_document_prompt: Optional[str] = None,
                  embed_query_prompt: Optional[str] = "query",
-                 embedding_batch_size: int = 32):
-        self.model = SentenceTransformer(model_name, trust_remote_code=True)
+                 embedding_batch_size: int = 32,
+                 warm_up: bool = False,
+                 model_cache_folder: Optional[str] = None,
+                 backend: str = TORCH_BACKEND,
+                 quantize: bool = False,
+                 intra_op_threads: Optional[int] = None,
+                 transform: Optional[EmbeddingTransform] = None,
+                 token_budget: Optional[int] = None,
+                 max_token_budget: Optional[int] = None,
+                 max_memory_mb: Optional[float] = None):
+        if backend not in [TORCH_BACKEND, ONNX_BACKEND]:
+            raise ValueError(f"backend must be '{TORCH_BACKEND}' or '{ONNX_BACKEND}', not '{backend}'")
+        self.model_name = model_name
         self.embed_document_prompt = embed_document_prompt
         self.embed_query_prompt = embed_query_prompt
         self.embedding_batch_size = embedding_batch_size
+        self.backend = backend
+        self.quantize = quantize
+        self.intra_op_threads = intra_op_threads
+        self.transform = transform
+        self.batcher = None
+        if token_budget is not None:
+            self.batcher = AdaptiveBatcher(token_budget, max_memory_mb=max_memory_mb, max_token_budget=max_token_budget)
+        if model_cache_folder is None:
+            model_cache_folder = os.getenv(MODEL_CACHE_ENV_VAR)
+        self.model_cache_folder = model_cache_folder
+        self._model: Optional["SentenceTransformer"] = None
+        self._tokenization: Optional[Tokenization] = None
+        self._model_lock = threading.Lock()
+        if warm_up:
+            self.warm_up()
+
+    @property
+    def model(self) -> "SentenceTransformer":
+        if self._model is None:
+            # If the model is being loaded in the background, this waits for it to finish:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    def warm_up(self):
+        """
+        Starts loading the model in a background thread. The first call that needs the model waits for it.
+        """
+        threading.Thread(target=lambda: self.model, name="ModelWarmUp", daemon=True).start()
+
+    def _get_cache_path(self) -> Optional[str]:
+        if self.model_cache_folder is None:
+            return None
+        return os.path.join(self.model_cache_folder, self.model_name.replace("/", "__"))
+
+    def _load_model(self) -> "SentenceTransformer":
+        with timer("model_load", model=self.model_name, backend=self.backend) as load_timer:
+            if self.backend == ONNX_BACKEND:
+                model = self._load_onnx_model()
+            else:
+                model = self._load_torch_model()
+        logging.info(f"Loaded model {self.model_name} ({self.backend}) in {load_timer.seconds:.1f} seconds")
+        # encode() tokenizes each batch by calling the model's tokenize method, so wrapping it times tokenization
+        # separately from the forward pass:
+        self._tokenize = model.tokenize
+        model.tokenize = self._timed_tokenize
+        return model
+
+    def _load_torch_model(self) -> "SentenceTransformer":
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if self.intra_op_threads is not None:
+            torch.set_num_threads(self.intra_op_threads)
+        cache_path = self._get_cache_path()
+        if cache_path is not None and os.path.isdir(cache_path):
+            return SentenceTransformer(cache_path, trust_remote_code=True)
+        model = SentenceTransformer(self.model_name, trust_remote_code=True)
+        if cache_path is not None:
+            self._save_to_cache(model, cache_path)
+        return model
+
+    def _get_onnx_folder(self) -> str:
+        cache_folder = self.model_cache_folder if self.model_cache_folder is not None else DEFAULT_ONNX_CACHE_FOLDER
+        return os.path.join(cache_folder, self.model_name.replace("/", "__") + "__onnx")
+
+    def _load_onnx_model(self) -> "OnnxSentenceEncoder":
+        from OnnxSentenceEncoder import (OnnxSentenceEncoder, export_to_onnx, quantize_onnx_model, CONFIG_FILE_NAME,
+                                         QUANTIZED_ONNX_FILE_NAME)
+
+        folder = self._get_onnx_folder()
+        if not os.path.isfile(os.path.join(folder, CONFIG_FILE_NAME)):
+            # Export from the saved PyTorch model if there is one, to avoid downloading it again:
+            cache_path = self._get_cache_path()
+            export_to_onnx(cache_path if cache_path is not None and os.path.isdir(cache_path) else self.model_name,
+                           folder)
+        if self.quantize and not os.path.isfile(os.path.join(folder, QUANTIZED_ONNX_FILE_NAME)):
+            quantize_onnx_model(folder)
+        return OnnxSentenceEncoder(folder, quantized=self.quantize, intra_op_threads=self.intra_op_threads)
+
+    @staticmethod
+    def _save_to_cache(model: "SentenceTransformer", cache_path: str):
+        # Saved under a temporary name first, so an interrupted save never leaves a folder that looks complete:
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        model.save(temp_path, safe_serialization=True)
+        try:
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # Another process saved the model first:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    def _timed_tokenize(self, texts):
+        with timer("tokenize", items=len(texts)):
+            return self._tokenize(texts)
 
     def embed_documents(self, texts: List[str]) -> ndarray:
         texts = [text if text is not None else "" for text in texts]
-        embeddings = self.model.encode(texts,
-                                       batch_size=self.embedding_batch_size,
-                                       prompt_name=self.embed_document_prompt)
-        return embeddings
+        if self.batcher is not None and len(texts) > 0:
+            return self.embed_token_ids(self.tokenize_documents(texts))
+        with timer("embed", items=len(texts)):
+            embeddings = self.model.encode(texts,
+                                           batch_size=self.embedding_batch_size,
+                                           prompt_name=self.embed_document_prompt)
+        return self._reduce(embeddings)
+
+    @property
+    def tokenization(self) -> Tokenization:
+        """
+        The tokenizer, prompts, and maximum sequence length of the model. If the model has not been loaded, only these
+        are loaded, which takes a fraction of the time and memory, so processes that only tokenize do not load the
+        model.
+        """
+        if self._model is not None:
+            return Tokenization(tokenizer=self._model.tokenizer,
+                                prompts=self._model.prompts or {},
+                                default_prompt_name=self._model.default_prompt_name,
+                                max_seq_length=self._model.max_seq_length)
+        if self._tokenization is None:
+            with self._model_lock:
+                if self._tokenization is None:
+                    self._tokenization = self._load_tokenization()
+        return self._tokenization
+
+    def _load_tokenization(self) -> Tokenization:
+        from transformers import AutoTokenizer
+        from OnnxSentenceEncoder import CONFIG_FILE_NAME
+
+        folder = self._get_onnx_folder()
+        if self.backend == ONNX_BACKEND and os.path.isfile(os.path.join(folder, CONFIG_FILE_NAME)):
+            with open(os.path.join(folder, CONFIG_FILE_NAME)) as file:
+                config = json.load(file)
+            return Tokenization(tokenizer=AutoTokenizer.from_pretrained(folder),
+                                prompts=config["prompts"] or {},
+                                default_prompt_name=config["default_prompt_name"],
+                                max_seq_length=config["max_seq_length"])
+        cache_path = self._get_cache_path()
+        model_name_or_path = cache_path if cache_path is not None and os.path.isdir(cache_path) else self.model_name
+        bert_config = _read_model_file(model_name_or_path, SENTENCE_BERT_CONFIG_FILE_NAME) or {}
+        if bert_config.get("max_seq_length") is None:
+            # The model then derives it from its configuration, so the model is needed after all:
+            model = self.model
+            return Tokenization(tokenizer=model.tokenizer,
+                                prompts=model.prompts or {},
+                                default_prompt_name=model.default_prompt_name,
+                                max_seq_length=model.max_seq_length)
+        config = _read_model_file(model_name_or_path, SENTENCE_TRANSFORMERS_CONFIG_FILE_NAME) or {}
+        return Tokenization(tokenizer=AutoTokenizer.from_pretrained(model_name_or_path, trust_remote_code=True),
+                            prompts=config.get("prompts") or {},
+                            default_prompt_name=config.get("default_prompt_name"),
+                            max_seq_length=bert_config["max_seq_length"])
+
+    def _get_prompt(self, prompt_name: Optional[str]) -> str:
+        tokenization = self.tokenization
+        if prompt_name is None:
+            prompt_name = tokenization.default_prompt_name
+        return tokenization.prompts.get(prompt_name, "") if prompt_name is not None else ""
+
+    def tokenize_documents(self, texts: List[str]) -> List[List[int]]:
+        """
+        Tokenizes documents the way embed_documents does, including the document prompt, special tokens, and
+        truncation to the maximum sequence length of the model. The result can be stored and passed to
+        embed_token_ids later.
+        """
+        tokenization = self.tokenization
+        prompt = self._get_prompt(self.embed_document_prompt)
+        texts = [prompt + (text if text is not None else "") for text in texts]
+        with timer("tokenize", items=len(texts)):
+            return tokenization.tokenizer(texts, truncation=True, max_length=tokenization.max_seq_length)["input_ids"]
+
+    def embed_token_ids(self, input_ids: List[Sequence[int]], lengths: Optional[Sequence[int]] = None) -> ndarray:
+        """
+        Embeds documents that were tokenized by tokenize_documents, skipping tokenization. Texts of similar length are
+        batched together, using the token budget if there is one, and embedding_batch_size otherwise.
+
+        :param input_ids: The token IDs of each document.
+        :param lengths: The number of tokens of each document, if known.
+        :return: The embeddings, in the order of input_ids.
+        """
+        if lengths is None:
+            lengths = [len(ids) for ids in input_ids]
+        if self.batcher is not None:
+            batches = self.batcher.batches(lengths)
+        else:
+            order = np.argsort(-np.asarray(lengths), kind="stable")
+            batches = (order[start:start + self.embedding_batch_size].tolist()
+                       for start in range(0, len(order), self.embedding_batch_size))
+        pad_token_id = self.model.tokenizer.pad_token_id or 0
+        embeddings = None
+        for batch in batches:
+            max_length = max(len(input_ids[i]) for i in batch)
+            padded_ids = np.full((len(batch), max_length), pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(batch), max_length), dtype=np.int64)
+            for row, i in enumerate(batch):
+                padded_ids[row, :len(input_ids[i])] = input_ids[i]
+                attention_mask[row, :len(input_ids[i])] = 1
+            with timer("embed", items=len(batch)):
+                batch_embeddings = self._embed_padded(padded_ids, attention_mask)
+            if embeddings is None:
+                embeddings = np.empty((len(input_ids), batch_embeddings.shape[1]), dtype=batch_embeddings.dtype)
+            embeddings[batch] = batch_embeddings
+        if embeddings is None:
+            return self.embed_documents([])
+        return self._reduce(embeddings)
+
+    def _embed_padded(self, input_ids: ndarray, attention_mask: ndarray) -> ndarray:
+        if self.backend == ONNX_BACKEND:
+            return self.model.embed_token_ids(input_ids, attention_mask)
+        import torch
+        from sentence_transformers.util import batch_to_device
+
+        features = {"input_ids": torch.from_numpy(input_ids), "attention_mask": torch.from_numpy(attention_mask)}
+        if "token_type_ids" in self.model.tokenizer.model_input_names:
+            features["token_type_ids"] = torch.zeros_like(features["input_ids"])
+        prompt = self._get_prompt(self.embed_document_prompt)
+        if prompt != "":
+            # Used by models whose pooling excludes the prompt, as in SentenceTransformer.encode:
+            features["prompt_length"] = len(self.model.tokenizer(prompt)["input_ids"]) - 1
+        features = batch_to_device(features, self.model.device)
+        with torch.no_grad():
+            embeddings = self.model.forward(features)["sentence_embedding"]
+        return embeddings.float().cpu().numpy()
 
     def embed_query(self, query: str) -> List[float]:
         embedding = self.model.encode(query, prompt_name=self.embed_query_prompt)
-        return embedding.tolist()
+        return self._reduce(embedding).tolist()
+
+    def embed_queries(self, queries: List[str]) -> ndarray:
+        with timer("embed", items=len(queries)):
+            embeddings = self.model.encode(queries,
+                                           batch_size=self.embedding_batch_size,
+                                           prompt_name=self.embed_query_prompt)
+        return self._reduce(embeddings)
+
+    def _reduce(self, embeddings: ndarray) -> ndarray:
+        return embeddings if self.transform is None else self.transform.reduce(embeddings)